@@ -2,13 +2,14 @@ import os
 import logging
 from flask import Flask, request, current_app
 from config import Config
-from flask_sqlalchemy import SQLAlchemy
+from app.database import SQLAlchemy, create_replicas
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_moment import Moment
 from logging.handlers import RotatingFileHandler, SMTPHandler
 from elasticsearch import Elasticsearch
+from redis import Redis
 
 db = SQLAlchemy()
 migrate = Migrate()
@@ -30,6 +31,41 @@ def create_app(config_class=Config):
     moment.init_app(app)
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
         if app.config['ELASTICSEARCH_URL'] else None
+    app.redis = Redis.from_url(app.config['REDIS_URL']) \
+        if app.config['REDIS_URL'] else None
+    app.replicas = create_replicas(app)
+    
+    from app.timeline import create_timeline
+    app.timeline = create_timeline(app)
+    from app.cache import create_cache
+    from app.search import create_search_backend
+    app.search_backend = create_search_backend(app)
+    app.search_cache = create_cache(app, app.config['CACHE_BACKEND'], 'search',
+                                    app.config['SEARCH_CACHE_SIZE'],
+                                    app.config['SEARCH_CACHE_TTL'])
+    app.user_cache = create_cache(app, app.config['CACHE_BACKEND'], 'users',
+                                  app.config['USER_CACHE_SIZE'],
+                                  app.config['USER_CACHE_TTL'])
+    app.page_cache = create_cache(app, app.config['PAGE_CACHE_BACKEND'], 'pages',
+                                  app.config['PAGE_CACHE_SIZE'],
+                                  app.config['PAGE_CACHE_TTL'],
+                                  app.config['PAGE_CACHE_MEMORY_TTL'])
+    app.fragment_cache = create_cache(app, app.config['FRAGMENT_CACHE_BACKEND'], 'fragments',
+                                      app.config['FRAGMENT_CACHE_SIZE'],
+                                      app.config['FRAGMENT_CACHE_TTL'],
+                                      app.config['FRAGMENT_CACHE_MEMORY_TTL'])
+    from app.indexing import create_indexer
+    app.indexer = create_indexer(app)
+    from app.passwords import PasswordHasher
+    app.password_hasher = PasswordHasher(app)
+    from app.email import create_mailer
+    app.mailer = create_mailer(app)
+    from app.presence import create_last_seen
+    app.last_seen = create_last_seen(app)
+    from app.fragments import render_posts
+    app.add_template_global(render_posts)
+    from app.instrument import create_instrumentation
+    app.instrumentation = create_instrumentation(app)
     
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -40,6 +76,12 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
     
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api')
+    
+    from app.email import load_email_templates
+    app.email_templates = load_email_templates(app)
+    
     if not app.debug and not app.testing:
         # Mail Handling
         if app.config['MAIL_SERVER']:
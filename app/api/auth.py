@@ -0,0 +1,37 @@
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
+from app.database import identify_client
+from app.models import User, load_user
+from app.api.errors import error_response
+
+# email and password, only to get a token
+basic_auth = HTTPBasicAuth()
+# Authorization: Bearer <token> on every other call
+token_auth = HTTPTokenAuth()
+
+
+@basic_auth.verify_password
+def verify_password(email, password):
+    user = User.query.filter_by(email=email).first()
+    if user and user.check_password(password):
+        return user
+
+
+@basic_auth.error_handler
+def basic_auth_error(status):
+    return error_response(status)
+
+
+@token_auth.verify_token
+def verify_token(token):
+    # tokens are checked by signature, the user comes from the user cache
+    # token clients send no session cookie, so read-your-writes follows the user
+    id = User.verify_api_token(token) if token else None
+    if id is None:
+        return None
+    identify_client(f'user:{id}')
+    return load_user(str(id))
+
+
+@token_auth.error_handler
+def token_auth_error(status):
+    return error_response(status)
@@ -0,0 +1,66 @@
+from flask import current_app, jsonify, request, url_for
+from app import db
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request, error_response
+from app.api.serializers import post_query, posts_page, paginated_posts, per_page, \
+    timeline_posts
+from app.models import Posts, followers
+from app.search import query_index
+from app.export import FORMATS, export_response
+
+
+@bp.route('/timeline', methods=['GET'])
+@token_auth.login_required
+def get_timeline():
+    # posts of followed users and the user's own, the same set as followed_posts(),
+    # read from the materialized timeline like the blog page when there is one
+    user = token_auth.current_user()
+    if current_app.timeline:
+        return jsonify(timeline_posts(user, 'api.get_timeline'))
+    user_id = user.id
+    followed = db.select([followers.c.followed_id]).where(followers.c.follower_id == user_id)
+    query = post_query().filter(db.or_(Posts.user_id == user_id, Posts.user_id.in_(followed)))
+    return jsonify(paginated_posts(query, 'api.get_timeline'))
+
+
+@bp.route('/explore', methods=['GET'])
+def get_explore():
+    return jsonify(paginated_posts(post_query(), 'api.get_explore'))
+
+
+@bp.route('/search', methods=['GET'])
+@token_auth.login_required
+def search():
+    # search results are ranked, so they are paged by number instead of cursor
+    q = request.args.get('q', '').strip()
+    if not q:
+        return bad_request('q is required')
+    page = max(request.args.get('page', 1, type=int), 1)
+    limit = per_page()
+    ids, total = query_index(Posts.__tablename__, q, page, limit)
+    rows = {row.id: row for row in post_query().filter(Posts.id.in_(ids))} if ids else {}
+    data = posts_page([rows[id] for id in ids if id in rows])
+    data['total'] = total
+    data['next'] = url_for('api.search', q=q, page=page + 1, limit=limit) \
+        if total > page * limit else None
+    data['prev'] = url_for('api.search', q=q, page=page - 1, limit=limit) \
+        if page > 1 else None
+    return jsonify(data)
+
+
+@bp.route('/export/posts', methods=['GET'])
+@token_auth.login_required
+def export_posts():
+    # streamed NDJSON or CSV (?format=csv) of the caller's posts, optionally
+    # gzipped (?gzip=1), ?all=1 exports every post and is open to ADMINS only
+    user = token_auth.current_user()
+    format = request.args.get('format', 'ndjson')
+    if format not in FORMATS:
+        return bad_request(f"format must be one of {', '.join(FORMATS)}")
+    compress = request.args.get('gzip', type=int) == 1
+    if request.args.get('all', type=int) == 1:
+        if user.email not in current_app.config['ADMINS']:
+            return error_response(403)
+        return export_response(format, compress=compress)
+    return export_response(format, user_id=user.id, compress=compress)
@@ -0,0 +1,23 @@
+import gzip
+from flask import current_app, request
+from app.api import bp
+
+
+@bp.after_request
+def compress_and_tag(response):
+    # weak ETag of the uncompressed body so clients can revalidate with
+    # If-None-Match, then gzip large bodies for clients that accept it
+    # streamed exports are left alone, tagging them would read the whole body
+    if request.method not in ('GET', 'HEAD') or response.status_code != 200 \
+            or response.direct_passthrough or response.is_streamed:
+        return response
+    response.add_etag(weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.make_conditional(request)
+    response.vary.add('Accept-Encoding')
+    if response.status_code == 200 and request.accept_encodings['gzip'] > 0 \
+            and response.content_length >= current_app.config['API_GZIP_MIN_SIZE']:
+        response.set_data(gzip.compress(response.get_data(),
+                                        current_app.config['API_GZIP_LEVEL']))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
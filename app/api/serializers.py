@@ -0,0 +1,89 @@
+from flask import current_app, request, url_for
+from app import db
+from app.models import User, Posts, _chunks
+from app.pagination import CursorPagination, paginate_cursor, request_cursors
+from app.timeline import query_timeline
+
+# the columns the api reads, rows are turned into dicts without building ORM
+# objects or loading relationships
+POST_COLUMNS = (Posts.id, Posts.body, Posts.timestamp, Posts.user_id)
+USER_COLUMNS = (User.id, User.email, User.email_digest, User.first_name, User.last_name,
+                User.tagline, User.about_me, User.last_seen,
+                User.followers_count, User.followed_count, User.posts_count)
+
+
+def post_query():
+    return db.session.query(*POST_COLUMNS)
+
+
+def user_query():
+    return db.session.query(*USER_COLUMNS)
+
+
+def _timestamp(value):
+    return value.isoformat() + 'Z' if value else None
+
+
+def post_dict(row):
+    return {'id': row.id, 'body': row.body, 'timestamp': _timestamp(row.timestamp),
+            'author_id': row.user_id}
+
+
+def user_dict(row, following=None):
+    data = {'id': row.id, 'email': row.email, 'first_name': row.first_name,
+            'last_name': row.last_name, 'tagline': row.tagline, 'about_me': row.about_me,
+            'last_seen': _timestamp(row.last_seen), 'avatar': User.avatar(row, 128),
+            'followers_count': row.followers_count, 'followed_count': row.followed_count,
+            'posts_count': row.posts_count}
+    if following is not None:
+        data['following'] = following
+    return data
+
+
+def users_by_id(ids):
+    # {id: row} of the users that exist
+    rows = {}
+    for chunk in _chunks(set(ids)):
+        rows.update((row.id, row) for row in user_query().filter(User.id.in_(chunk)))
+    return rows
+
+
+def posts_page(posts):
+    # a list of posts with each of their authors once, keyed by id
+    authors = users_by_id(row.user_id for row in posts)
+    return {'posts': [post_dict(row) for row in posts],
+            'users': {str(id): user_dict(row) for id, row in authors.items()}}
+
+
+def per_page():
+    limit = request.args.get('limit', current_app.config['API_POSTS_PER_PAGE'], type=int)
+    return max(1, min(limit, current_app.config['API_MAX_PER_PAGE']))
+
+
+def paginated_posts(query, endpoint, **url_args):
+    # a newest-first page of a post_query() listing with before=/after= cursor
+    # links, like paginate_posts in cursor mode
+    limit = per_page()
+    before, after = request_cursors()
+    page = paginate_cursor(query, Posts, limit, before=before, after=after)
+    return _page_data(page, endpoint, limit, **url_args)
+
+
+def timeline_posts(user, endpoint):
+    # a page of the user's materialized timeline, shaped like paginated_posts
+    # and paged by the same cursors, the rows of its ids are read in one query
+    limit = per_page()
+    before, after = request_cursors()
+    ids, has_prev, has_next = query_timeline(user, limit, before, after)
+    rows = {row.id: row for row in post_query().filter(Posts.id.in_(ids))} if ids else {}
+    page = CursorPagination([rows[id] for id in ids if id in rows], has_prev, has_next)
+    return _page_data(page, endpoint, limit)
+
+
+def _page_data(page, endpoint, limit, **url_args):
+    data = posts_page(page.items)
+    data['next'] = url_for(endpoint, before=page.next_cursor, limit=limit, **url_args) \
+        if page.has_next else None
+    data['prev'] = url_for(endpoint, after=page.prev_cursor, limit=limit, **url_args) \
+        if page.has_prev else None
+    return data
@@ -0,0 +1,14 @@
+from flask import current_app, jsonify
+from app import db
+from app.api import bp
+from app.api.auth import basic_auth
+
+
+@bp.route('/tokens', methods=['POST'])
+@basic_auth.login_required
+def get_token():
+    expires_in = current_app.config['API_TOKEN_EXPIRES']
+    token = basic_auth.current_user().get_api_token(expires_in)
+    # check_password may have upgraded the stored hash
+    db.session.commit()
+    return jsonify({'token': token, 'expires_in': expires_in})
@@ -0,0 +1,65 @@
+from flask import current_app, jsonify, request
+from app import db
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request, error_response
+from app.api.serializers import user_dict, users_by_id, post_query, paginated_posts
+from app.models import Posts
+
+
+@bp.route('/users/<int:id>', methods=['GET'])
+@token_auth.login_required
+def get_user(id):
+    viewer = token_auth.current_user()
+    row = users_by_id([id]).get(id)
+    if row is None:
+        return error_response(404)
+    following = viewer.is_following(row) if id != viewer.id else None
+    return jsonify(user_dict(row, following))
+
+
+@bp.route('/users', methods=['GET'])
+@token_auth.login_required
+def get_users():
+    # many users in one call, ?ids=1,2,3, in the order asked for
+    try:
+        ids = [int(id) for id in request.args.get('ids', '').split(',') if id.strip()]
+    except ValueError:
+        return bad_request('ids must be a comma separated list of user ids')
+    if not ids:
+        return bad_request('ids is required')
+    if len(ids) > current_app.config['API_MAX_BULK']:
+        return bad_request(f"at most {current_app.config['API_MAX_BULK']} ids per call")
+    viewer = token_auth.current_user()
+    rows = users_by_id(ids)
+    following = viewer.following_status([id for id in rows if id != viewer.id])
+    return jsonify({
+        'users': [user_dict(rows[id], following.get(id)) for id in dict.fromkeys(ids)
+                  if id in rows],
+        'missing': [id for id in dict.fromkeys(ids) if id not in rows]})
+
+
+@bp.route('/users/<int:id>/posts', methods=['GET'])
+@token_auth.login_required
+def get_user_posts(id):
+    if id not in users_by_id([id]):
+        return error_response(404)
+    return jsonify(paginated_posts(post_query().filter(Posts.user_id == id),
+                                   'api.get_user_posts', id=id))
+
+
+@bp.route('/users/<int:id>/follow', methods=['POST', 'DELETE'])
+@token_auth.login_required
+def follow(id):
+    viewer = token_auth.current_user()
+    if id not in users_by_id([id]):
+        return error_response(404)
+    if id == viewer.id:
+        return bad_request('you cannot follow yourself')
+    user = viewer.model()
+    if request.method == 'POST':
+        user.follow_many([id])
+    else:
+        user.unfollow_many([id])
+    db.session.commit()
+    return jsonify({'id': id, 'following': request.method == 'POST'})
@@ -1,15 +1,21 @@
-from flask import render_template, current_app
-from app.email import send_email
+from flask import current_app
+from app.email import templated_email, send_bulk_email
+from app.models import User
+
+def reset_password_email(user):
+    # rendered by the mail workers rather than the request, the token is
+    # signed here so templates have no way to mint one
+    return templated_email('[Microblog] Reset Your Password',
+                           sender=current_app.config['ADMINS'][0],
+                           recipients=[user.email],
+                           template='email/reset_password',
+                           user={'id': user.id, 'first_name': user.first_name},
+                           token=User.reset_password_token(user.id))
 
 def send_password_reset_email(user):
-    token = user.get_reset_password_token()
-    send_email('[Microblog] Reset Your Password',
-               sender=current_app.config['ADMINS'][0],
-               recipients=[user.email],
-               text_body=render_template('email/reset_password.txt',
-                                         user=user,
-                                         token=token
-                                         ),
-               html_body=render_template('email/reset_password.html',
-                                         user=user,
-                                         token=token))
\ No newline at end of file
+    current_app.mailer.send(reset_password_email(user))
+
+def send_password_reset_emails(users, chunk_size=500, progress=None):
+    # reset emails for many users in one pass, returns throughput metrics
+    return send_bulk_email((reset_password_email(user) for user in users),
+                           chunk_size=chunk_size, progress=progress)
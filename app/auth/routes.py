@@ -21,8 +21,9 @@ def login():
         if user is None or not user.check_password(form.password.data):
             flash('Invalid username or password', 'warning')
             return redirect(url_for('auth.login'))
-        # proceed to login
+        # proceed to login, saving the password hash if check_password upgraded it
         login_user(user, remember=form.remember_me.data)
+        db.session.commit()
         flash('Successfully logged in!', 'success')
         # redirect logins from @login_required decorator to relative path ?next=/index
         next_page = request.args.get('next')
@@ -44,7 +45,8 @@ def register():
         return redirect(url_for('main.index'))
     form = RegistrationForm()
     if form.validate_on_submit():
-        user = User(email=form.email.data, first_name=form.first_name.data, last_name=form.last_name.data)
+        user = User(first_name=form.first_name.data, last_name=form.last_name.data)
+        user.set_email(form.email.data)
         user.set_password(form.password.data)
         db.session.add(user)
         db.session.commit()
@@ -0,0 +1,129 @@
+import pickle
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class MemoryCache(object):
+    # per-process cache with LRU eviction and a TTL on every entry
+    # embedding a generation in a key invalidates every entry built with the
+    # old value, generations are bounded like the entries: one is forgotten a
+    # TTL after its last bump, when every entry built with an older value has
+    # expired, or sooner to stay under max_size, which moves every name not
+    # kept to a new base value
+    # values come from one counter, so a forgotten one is never handed out again
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generations = OrderedDict()  # name -> (value, forget after)
+        self._counter = 0
+        self._base = 0  # generation of names not kept
+        self._longest_ttl = ttl
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._longest_ttl = max(self._longest_ttl, ttl or self.ttl)
+            self.entries[key] = (time() + (ttl or self.ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self.entries.pop(key, None)
+
+    def generation(self, name):
+        with self._lock:
+            return self._generation(name)
+
+    def generations_of(self, names):
+        with self._lock:
+            return [self._generation(name) for name in names]
+
+    def bump(self, name):
+        with self._lock:
+            now = time()
+            self._counter += 1
+            self.generations[name] = (self._counter, now + self._longest_ttl)
+            self.generations.move_to_end(name)
+            # the oldest bumps come first
+            while next(iter(self.generations.values()))[1] < now:
+                self.generations.popitem(last=False)
+            if len(self.generations) > self.max_size:
+                while len(self.generations) > self.max_size:
+                    self.generations.popitem(last=False)
+                self._counter += 1
+                self._base = self._counter
+            return self.generations[name][0]
+
+    def _generation(self, name):
+        generation = self.generations.get(name)
+        return generation[0] if generation is not None else self._base
+
+
+class RedisCache(object):
+    # cache shared by every worker through Redis, entries expire after the TTL
+    # and LRU eviction is left to the server's maxmemory-policy
+
+    def __init__(self, redis, prefix, ttl):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.redis.get(f'{self.prefix}:{key}')
+        return pickle.loads(value) if value is not None else None
+
+    def get_many(self, keys):
+        # one round trip for a whole page of entries
+        if not keys:
+            return []
+        values = self.redis.mget([f'{self.prefix}:{key}' for key in keys])
+        return [pickle.loads(value) if value is not None else None for value in values]
+
+    def set(self, key, value, ttl=None):
+        self.redis.setex(f'{self.prefix}:{key}', ttl or self.ttl, pickle.dumps(value))
+
+    def delete(self, key):
+        self.redis.delete(f'{self.prefix}:{key}')
+
+    def generation(self, name):
+        return int(self.redis.get(f'{self.prefix}:generation:{name}') or 0)
+
+    def generations_of(self, names):
+        if not names:
+            return []
+        values = self.redis.mget([f'{self.prefix}:generation:{name}' for name in names])
+        return [int(value or 0) for value in values]
+
+    def bump(self, name):
+        return self.redis.incr(f'{self.prefix}:generation:{name}')
+
+
+def create_cache(app, backend, prefix, max_size, ttl, memory_ttl=None):
+    # build a cache on backend, 'memory', 'redis' or None to disable it
+    # memory_ttl caps the lifetime of per-process entries, for caches whose
+    # invalidations are not seen by the other workers
+    if backend == 'memory':
+        return MemoryCache(max_size, min(ttl, memory_ttl or ttl))
+    if backend == 'redis':
+        return RedisCache(app.redis, prefix, ttl)
+    return None
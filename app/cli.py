@@ -0,0 +1,128 @@
+import click
+from flask import current_app
+
+
+def register(app):
+    @app.cli.group()
+    def timeline():
+        """Materialized timeline commands."""
+        pass
+
+    @timeline.command()
+    @click.option('--user', 'email', help='Only rebuild the timeline of this user.')
+    def rebuild(email):
+        """Rebuild timelines from the followers and posts tables."""
+        from app.models import User
+        if not current_app.timeline:
+            raise click.ClickException('TIMELINE_BACKEND is not configured.')
+        users = User.query.filter_by(email=email) if email else User.query
+        count = 0
+        for user in users:
+            current_app.timeline.rebuild(user.id)
+            count += 1
+        click.echo(f'Rebuilt {count} timelines.')
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command()
+    @click.option('--chunk-size', default=1000, show_default=True,
+                  help='Rows read from the database and sent per _bulk request.')
+    @click.option('--workers', default=4, show_default=True,
+                  help='Concurrent _bulk requests.')
+    @click.option('--in-place', is_flag=True,
+                  help='Write into the live index instead of a new index behind an alias.')
+    @click.option('--keep-old', is_flag=True,
+                  help='Keep the previous index after the alias is switched.')
+    def reindex(chunk_size, workers, in_place, keep_old):
+        """Rebuild the posts search index from the database."""
+        from app.models import Posts
+        if not current_app.elasticsearch:
+            raise click.ClickException('ELASTICSEARCH_URL is not configured.')
+
+        def progress(count, elapsed):
+            click.echo(f'\r{count} documents, {count / max(elapsed, 1e-6):.0f} docs/s',
+                       nl=False)
+
+        total = Posts.reindex(chunk_size=chunk_size, workers=workers,
+                              use_alias=not in_place, keep_old=keep_old,
+                              progress=progress)
+        click.echo(f'\nReindexed {total} documents.')
+
+    @app.cli.group()
+    def users():
+        """User maintenance commands."""
+        pass
+
+    @users.command()
+    def recount():
+        """Recompute follower, following and post counts of every user."""
+        from app import db
+        from app.models import User
+        count = User.recount()
+        db.session.commit()
+        click.echo(f'Recounted {count} users.')
+
+    @users.command('send-reset')
+    @click.option('--email', 'emails', multiple=True, help='Only send to this user, repeatable.')
+    @click.option('--all', 'everyone', is_flag=True, help='Send to every user.')
+    @click.option('--chunk-size', default=500, show_default=True,
+                  help='Users loaded and emails rendered at a time.')
+    def send_reset(emails, everyone, chunk_size):
+        """Send password reset emails, e.g. to force resets after an incident."""
+        from app import db
+        from app.auth.email import send_password_reset_emails
+        from app.models import User
+        if not emails and not everyone:
+            raise click.ClickException('Pass --all or at least one --email.')
+
+        def users():
+            # primary key chunks of plain rows, so memory stays flat
+            last_id = 0
+            while True:
+                query = db.session.query(User.id, User.email, User.first_name).filter(
+                    User.id > last_id)
+                if emails:
+                    query = query.filter(User.email.in_(emails))
+                rows = query.order_by(User.id).limit(chunk_size).all()
+                if not rows:
+                    return
+                last_id = rows[-1].id
+                yield from rows
+
+        def progress(count, elapsed):
+            click.echo(f'\r{count} emails, {count / max(elapsed, 1e-6):.0f} emails/s', nl=False)
+
+        stats = send_password_reset_emails(users(), chunk_size=chunk_size, progress=progress)
+        click.echo(f"\nSent {stats['emails']} emails in {stats['seconds']:.1f}s "
+                   f"({stats['per_second']:.0f} emails/s, {stats['render_seconds']:.1f}s rendering, "
+                   f"{stats['failed']} failed).")
+
+    @app.cli.group()
+    def posts():
+        """Post commands."""
+        pass
+
+    @posts.command()
+    @click.option('--user', 'email', help='Only export the posts of this user.')
+    @click.option('--format', type=click.Choice(['ndjson', 'csv']), default='ndjson',
+                  show_default=True)
+    @click.option('--gzip', 'compress', is_flag=True, help='Gzip the output.')
+    @click.option('--output', default='-', help='File to write, standard output by default.')
+    @click.option('--chunk-size', default=1000, show_default=True,
+                  help='Posts read from the database at a time.')
+    def export(email, format, compress, output, chunk_size):
+        """Export posts as NDJSON or CSV, streamed at constant memory."""
+        from app.export import export_posts
+        from app.models import User
+        user_id = None
+        if email:
+            user = User.query.filter_by(email=email).first()
+            if user is None:
+                raise click.ClickException(f'User {email} not found.')
+            user_id = user.id
+        with click.open_file(output, 'wb') as f:
+            for chunk in export_posts(format, user_id, chunk_size, compress):
+                f.write(chunk)
@@ -0,0 +1,123 @@
+import os
+import random
+from time import time
+from flask import current_app, request, session, g, has_request_context
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from app.sqlite import connection_class
+
+
+class RoutingSession(SignallingSession):
+    # sends the reads of GET requests to a replica picked for the request,
+    # everything else goes to the primary
+    # once a session writes, by flush or by executing DML, its remaining reads go
+    # to the primary too so it sees its own changes
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or not _is_read(clause):
+            self.info['wrote'] = True
+        elif self.info.get('replica') and not self.info.get('wrote'):
+            return self.db.get_engine(self.app, bind=self.info['replica'])
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    # Flask-SQLAlchemy with replica routing and the DATABASE_POOL_* settings
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # SQLALCHEMY_ENGINE_OPTIONS still win, in memory SQLite databases keep
+        # the pool Flask-SQLAlchemy picks for them
+        options.setdefault('pool_pre_ping', app.config['DATABASE_POOL_PRE_PING'])
+        if sa_url.drivername.startswith('sqlite'):
+            if app.config['SQLITE_PROFILE'] and sa_url.database not in (None, '', ':memory:'):
+                # pooled connections with the pragmas and write queue of app/sqlite.py
+                path = os.path.join(app.root_path, sa_url.database)
+                connect_args = options.setdefault('connect_args', {})
+                connect_args.setdefault('factory', connection_class(path, app.config))
+                connect_args.setdefault('check_same_thread', False)
+                options.setdefault('poolclass', QueuePool)
+                options.setdefault('pool_size', app.config['DATABASE_POOL_SIZE'])
+                options.setdefault('max_overflow', app.config['DATABASE_MAX_OVERFLOW'])
+        else:
+            options.setdefault('pool_size', app.config['DATABASE_POOL_SIZE'])
+            options.setdefault('max_overflow', app.config['DATABASE_MAX_OVERFLOW'])
+            options.setdefault('pool_timeout', app.config['DATABASE_POOL_TIMEOUT'])
+            options.setdefault('pool_recycle', app.config['DATABASE_POOL_RECYCLE'])
+        return super(SQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+
+
+def _is_read(clause):
+    return getattr(clause, 'is_select', False) and \
+        getattr(clause, '_for_update_arg', None) is None
+
+
+def create_replicas(app):
+    # register DATABASE_REPLICA_URLS as binds replica0, replica1, ... and route
+    # GET requests to one of them, returns the bind names
+    # after committing a change a client reads from the primary for
+    # DATABASE_REPLICA_STICKY_SECONDS, so it sees what it wrote however far
+    # behind the replicas are, browsers are remembered in their session and
+    # clients named by identify_client in app.sticky_clients
+    from app import db
+    from app.cache import create_cache
+    urls = app.config['DATABASE_REPLICA_URLS']
+    if not urls:
+        return []
+    app.sticky_clients = create_cache(app, 'redis' if app.redis else 'memory', 'primary',
+                                      app.config['DATABASE_REPLICA_STICKY_CLIENTS'],
+                                      app.config['DATABASE_REPLICA_STICKY_SECONDS'])
+    if not event.contains(db.session, 'after_commit', _stick_to_primary):
+        event.listen(db.session, 'after_commit', _stick_to_primary)
+    binds = app.config['SQLALCHEMY_BINDS'] = dict(app.config['SQLALCHEMY_BINDS'] or {})
+    replicas = []
+    for i, url in enumerate(urls):
+        binds[f'replica{i}'] = url
+        replicas.append(f'replica{i}')
+    app.before_request(_route_reads)
+    app.teardown_request(_forget_route)
+    return replicas
+
+
+def _route_reads():
+    from app import db
+    if request.method in ('GET', 'HEAD') and session.get('_primary_until', 0) < time():
+        db.session.info['replica'] = random.choice(current_app.replicas)
+
+
+def _forget_route(exc):
+    from app import db
+    db.session.info.pop('replica', None)
+    db.session.info.pop('wrote', None)
+
+
+def identify_client(key):
+    # name the client of a request that has no session cookie, e.g. the user of
+    # an api token, so its writes keep its reads on the primary too
+    # call it before the request's first query
+    from app import db
+    if not current_app.replicas:
+        return
+    g.replica_client = key
+    if current_app.sticky_clients.get(key):
+        db.session.info.pop('replica', None)
+
+
+def _stick_to_primary(db_session):
+    if not db_session.info.pop('wrote', False):
+        return
+    db_session.info.pop('replica', None)
+    if has_request_context() and current_app.replicas:
+        if g.get('replica_client'):
+            # no cookie for clients that did not send one
+            current_app.sticky_clients.set(g.replica_client, True)
+        else:
+            session['_primary_until'] = \
+                time() + current_app.config['DATABASE_REPLICA_STICKY_SECONDS']
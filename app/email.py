@@ -1,16 +1,301 @@
-from threading import Thread
+import atexit
+import os
+import smtplib
+from collections import namedtuple
+from itertools import groupby, islice
+from queue import Queue, Empty
+from threading import Thread, Lock
+from time import time, sleep
 from flask_mail import Message
-from flask import current_app
+from flask import current_app, request, has_request_context
+from werkzeug.urls import url_parse
 from app import mail
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
-        
+# a message rendered by the mail pipeline from email/<template>.txt and .html,
+# base_url is the site address url_for(_external=True) builds links with
+TemplatedEmail = namedtuple('TemplatedEmail',
+                            ['subject', 'sender', 'recipients', 'template', 'context', 'base_url'])
+
+
+class SyncMailer(object):
+    # sends each message inside the request, on its own SMTP connection
+
+    def __init__(self, app):
+        self.app = app
+        self.sent = 0
+
+    def send(self, msg):
+        for msg in render_messages([msg]):
+            mail.send(msg)
+            self.sent += 1
+
+    def send_many(self, messages):
+        with mail.connect() as connection:
+            for msg in render_messages(messages):
+                connection.send(msg)
+                self.sent += 1
+
+    def flush(self, timeout=None):
+        return True
+
+
+class ThreadMailer(object):
+    # hands messages to a fixed pool of worker threads through a bounded queue,
+    # a full queue blocks the sender instead of piling up threads
+    # each worker keeps its SMTP connection open and sends whatever is queued
+    # in batches over it, the connection is closed after idle_timeout seconds
+
+    def __init__(self, app):
+        self.app = app
+        self.workers = app.config['MAIL_WORKERS']
+        self.batch_size = app.config['MAIL_BATCH_SIZE']
+        self.idle_timeout = app.config['MAIL_IDLE_TIMEOUT']
+        self.max_retries = app.config['MAIL_MAX_RETRIES']
+        self.retry_backoff = app.config['MAIL_RETRY_BACKOFF']
+        self.queue = Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        self.sent = 0
+        self.failed = 0
+        self._lock = Lock()
+        self._pid = None
+
+    def send(self, msg):
+        self._ensure_workers()
+        self.queue.put(msg)
+
+    def send_many(self, messages):
+        for msg in messages:
+            self.send(msg)
+
+    def flush(self, timeout=None):
+        # wait for queued messages to be sent, returns False on timeout
+        deadline = None if timeout is None else time() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time() > deadline:
+                return False
+            sleep(0.01)
+        return True
+
+    def _ensure_workers(self):
+        # threads do not survive a fork, so gunicorn workers start their own
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for _ in range(self.workers):
+                Thread(target=self._run, daemon=True).start()
+            atexit.register(self.flush, timeout=self.idle_timeout)
+
+    def _run(self):
+        connection = None
+        while True:
+            try:
+                # wait forever while disconnected, hang up once idle
+                batch = [self.queue.get(timeout=self.idle_timeout if connection else None)]
+            except Empty:
+                connection = _close(connection)
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            with self.app.app_context():
+                connection = self._send(connection, render_messages(batch))
+            for _ in batch:
+                self.queue.task_done()
+
+    def _send(self, connection, batch):
+        # returns the connection to reuse for the next batch
+        failures = 0
+        while batch:
+            try:
+                if connection is None:
+                    connection = mail.connect().__enter__()
+                connection.send(batch[0])
+                self._count(sent=1)
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+                    ConnectionError, TimeoutError):
+                # dropped or refused connection, reconnect and send the rest
+                connection = _close(connection)
+                failures += 1
+                if failures > self.max_retries:
+                    self.app.logger.error('Gave up sending %d emails', len(batch), exc_info=True)
+                    self._count(failed=len(batch))
+                    return None
+                self.app.logger.warning('SMTP connection failed', exc_info=True)
+                # a connection the server timed out is replaced at once
+                if failures > 1:
+                    sleep(self.retry_backoff * 2 ** (failures - 2))
+                continue
+            except Exception:
+                # refused recipients and the like only lose this message
+                self.app.logger.error('Could not send email to %s', batch[0].recipients,
+                                      exc_info=True)
+                self._count(failed=1)
+            batch = batch[1:]
+        return connection
+
+    def _count(self, sent=0, failed=0):
+        with self._lock:
+            self.sent += sent
+            self.failed += failed
+
+
+class RQMailer(object):
+    # durable mode, messages become rq jobs run by `rq worker blog-mail`
+    # each job sends up to batch_size messages over one SMTP connection
+
+    def __init__(self, app):
+        from rq import Queue as RQueue
+        self.app = app
+        self.batch_size = app.config['MAIL_BATCH_SIZE']
+        self.max_retries = app.config['MAIL_MAX_RETRIES']
+        self.retry_backoff = app.config['MAIL_RETRY_BACKOFF']
+        self.queue = RQueue(app.config['MAIL_QUEUE'], connection=app.redis)
+
+    def send(self, msg):
+        self.send_many([msg])
+
+    def send_many(self, messages):
+        from rq import Retry
+        retry = Retry(max=self.max_retries, interval=[
+            self.retry_backoff * 2 ** attempt for attempt in range(self.max_retries)])
+        for i in range(0, len(messages), self.batch_size):
+            self.queue.enqueue('app.tasks.send_messages',
+                               [message_to_dict(msg) for msg in messages[i:i + self.batch_size]],
+                               retry=retry)
+
+    def flush(self, timeout=None):
+        return True
+
+
+def create_mailer(app):
+    # MAIL_MODE picks 'sync', 'thread' or 'rq'
+    mode = app.config['MAIL_MODE']
+    if mode == 'rq':
+        return RQMailer(app)
+    if mode == 'thread':
+        return ThreadMailer(app)
+    return SyncMailer(app)
+
+
+def _close(connection):
+    if connection is not None:
+        try:
+            connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass
+    return None
+
+
+def message_to_dict(msg):
+    # the parts of a message needed to rebuild it in an rq worker
+    if isinstance(msg, TemplatedEmail):
+        return msg._asdict()
+    return {'subject': msg.subject, 'sender': msg.sender, 'recipients': msg.recipients,
+            'body': msg.body, 'html': msg.html}
+
+
+def send_messages(messages):
+    # send a list of message dicts over one SMTP connection, used by rq jobs
+    items = [TemplatedEmail(**values) if 'template' in values else Message(**values)
+             for values in messages]
+    with mail.connect() as connection:
+        for msg in render_messages(items):
+            connection.send(msg)
+
+
+def load_email_templates(app):
+    # compile the email templates once, rendering them skips the loader lookups
+    env = app.jinja_env
+    return {name: env.get_template(name)
+            for name in env.list_templates() if name.startswith('email/')}
+
+
+def render_messages(items):
+    # turn queued items into messages, rendering the templated ones with a
+    # url_for that builds external links for their base_url
+    # only an app context is needed, the sync mailer renders inside a live
+    # request and pushing another one would run its teardown handlers early
+    messages = []
+    for base_url, group in groupby(items, key=lambda item: getattr(item, 'base_url', None)):
+        url_for = external_url_for(base_url)
+        for item in group:
+            if not isinstance(item, TemplatedEmail):
+                messages.append(item)
+                continue
+            try:
+                messages.append(_render(item, url_for))
+            except Exception:
+                current_app.logger.error('Could not render %s for %s', item.template,
+                                         item.recipients, exc_info=True)
+    return messages
+
+
+def external_url_for(base_url=None):
+    # url_for building absolute links to base_url, by default the site set by
+    # SERVER_NAME, APPLICATION_ROOT and PREFERRED_URL_SCHEME
+    config = current_app.config
+    url = url_parse(base_url or f"{config['PREFERRED_URL_SCHEME']}://"
+                                f"{config['SERVER_NAME'] or 'localhost'}{config['APPLICATION_ROOT']}")
+    adapter = current_app.url_map.bind(url.netloc, script_name=url.path or '/',
+                                       url_scheme=url.scheme)
+
+    def url_for(endpoint, _external=True, **values):
+        return adapter.build(endpoint, values, force_external=True)
+    return url_for
+
+
+def _render(email, url_for):
+    templates = current_app.email_templates
+    context = dict(email.context, url_for=url_for)
+    msg = Message(email.subject, sender=email.sender, recipients=email.recipients)
+    msg.body = templates[f'{email.template}.txt'].render(context)
+    msg.html = templates[f'{email.template}.html'].render(context)
+    return msg
+
+
+def templated_email(subject, sender, recipients, template, **context):
+    # the context has to be plain data, it may travel through rq
+    base_url = current_app.config['MAIL_BASE_URL'] or \
+        (request.host_url if has_request_context() else None)
+    return TemplatedEmail(subject, sender, recipients, template, context, base_url)
+
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email,
-           args=(current_app._get_current_object(), msg)).start()
\ No newline at end of file
+    current_app.mailer.send(msg)
+
+
+def send_bulk_email(emails, chunk_size=500, progress=None):
+    # render and send many templated emails in one pass, e.g. forced password
+    # resets, and return throughput metrics
+    # emails are rendered here in chunks and handed to the mailer, which delivers
+    # them over its persistent connections, rq jobs are only enqueued
+    app = current_app._get_current_object()
+    emails = iter(emails)
+    stats = {'emails': 0, 'failed': 0, 'render_seconds': 0.0}
+    sent, failed = getattr(app.mailer, 'sent', 0), getattr(app.mailer, 'failed', 0)
+    started = time()
+    while True:
+        chunk = list(islice(emails, chunk_size))
+        if not chunk:
+            break
+        rendered = time()
+        messages = chunk if isinstance(app.mailer, RQMailer) else render_messages(chunk)
+        stats['render_seconds'] += time() - rendered
+        app.mailer.send_many(messages)
+        stats['emails'] += len(messages)
+        stats['failed'] += len(chunk) - len(messages)
+        if progress:
+            progress(stats['emails'], time() - started)
+    app.mailer.flush()
+    # delivery failures are only known to mailers sending in this process
+    stats['failed'] += getattr(app.mailer, 'failed', 0) - failed
+    if hasattr(app.mailer, 'sent'):
+        stats['emails'] = app.mailer.sent - sent
+    stats['seconds'] = time() - started
+    stats['per_second'] = stats['emails'] / max(stats['seconds'], 1e-6)
+    return stats
@@ -0,0 +1,81 @@
+import csv
+import io
+import json
+import zlib
+from flask import current_app, stream_with_context
+from app import db
+from app.models import User, Posts
+
+# export format -> mimetype
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+FIELDS = ('id', 'timestamp', 'author', 'body')
+
+
+def post_chunks(user_id=None, chunk_size=1000):
+    # every post, or the posts of one user, in id order as lists of plain rows
+    # read in primary key chunks, so memory stays flat however big the table
+    query = db.session.query(Posts.id, Posts.timestamp, User.email, Posts.body).outerjoin(
+        User, User.id == Posts.user_id)
+    if user_id is not None:
+        query = query.filter(Posts.user_id == user_id)
+    last_id = 0
+    while True:
+        rows = query.filter(Posts.id > last_id).order_by(Posts.id).limit(chunk_size).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        yield rows
+
+
+def _timestamp(value):
+    return value.isoformat() + 'Z' if value else None
+
+
+def _ndjson(chunks):
+    for rows in chunks:
+        yield ''.join(json.dumps({'id': row.id, 'timestamp': _timestamp(row.timestamp),
+                                  'author': row.email, 'body': row.body}) + '\n'
+                      for row in rows).encode('utf-8')
+
+
+def _csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for rows in chunks:
+        writer.writerows((row.id, _timestamp(row.timestamp), row.email, row.body)
+                         for row in rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    # a header alone when there are no posts
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_stream(chunks, level=6):
+    # gzip a stream of bytes as it is produced
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_posts(format='ndjson', user_id=None, chunk_size=1000, compress=False):
+    # generator of the encoded export, one piece per chunk of posts
+    encode = _csv if format == 'csv' else _ndjson
+    stream = encode(post_chunks(user_id, chunk_size))
+    return gzip_stream(stream) if compress else stream
+
+
+def export_response(format, user_id=None, compress=False, name='posts'):
+    # streamed download, the request context stays open while it is written
+    stream = export_posts(format, user_id, current_app.config['EXPORT_CHUNK_SIZE'], compress)
+    filename = f"{name}.{format}{'.gz' if compress else ''}"
+    response = current_app.response_class(
+        stream_with_context(stream),
+        mimetype='application/gzip' if compress else FORMATS[format])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -0,0 +1,26 @@
+from flask import current_app, render_template
+from markupsafe import Markup
+
+
+def render_posts(posts):
+    # render the post cards of a listing, reusing cached html when available
+    # a card shows the post body, which never changes, and its author, so the key
+    # is the post id plus a version of the author bumped by invalidate_users in
+    # app/models.py, the timestamp is rendered by moment.js in the browser
+    posts = list(posts)
+    cache = current_app.fragment_cache
+    if cache is None:
+        return Markup(''.join(_render(post) for post in posts))
+    authors = list({post.user_id for post in posts})
+    versions = dict(zip(authors, cache.generations_of([f'author:{id}' for id in authors])))
+    keys = [f'post:{post.id}:{versions[post.user_id]}' for post in posts]
+    cards = cache.get_many(keys)
+    for i, card in enumerate(cards):
+        if card is None:
+            cards[i] = _render(posts[i])
+            cache.set(keys[i], cards[i])
+    return Markup(''.join(cards))
+
+
+def _render(post):
+    return render_template('main/_post.html', post=post)
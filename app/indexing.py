@@ -0,0 +1,249 @@
+import atexit
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+from queue import Queue, Empty
+from threading import Thread, Lock
+from time import time, sleep
+from flask import current_app
+from app import db
+from app.search import bulk_index, invalidate_search
+
+
+class SyncIndexer(object):
+    # sends each commit's changes as one _bulk request inside the request
+
+    def __init__(self, app):
+        self.app = app
+
+    def put(self, actions):
+        # runs in the committing request, which already has an app context
+        failed = bulk_index(actions)
+        if failed:
+            self.app.logger.error('Search indexing failed for %d documents', len(failed))
+
+    def flush(self, timeout=None):
+        return True
+
+
+class ThreadIndexer(object):
+    # collects changes in memory and sends them from a background thread,
+    # a batch is sent once it reaches batch_size or flush_interval seconds pass
+    # failed batches are retried with exponential backoff before being dropped
+
+    def __init__(self, app):
+        self.app = app
+        self.batch_size = app.config['SEARCH_INDEX_BATCH_SIZE']
+        self.flush_interval = app.config['SEARCH_INDEX_FLUSH_INTERVAL']
+        self.max_retries = app.config['SEARCH_INDEX_MAX_RETRIES']
+        self.retry_backoff = app.config['SEARCH_INDEX_RETRY_BACKOFF']
+        self.queue = Queue()
+        self._lock = Lock()
+        self._pid = None
+
+    def put(self, actions):
+        self._ensure_worker()
+        for action in actions:
+            self.queue.put(action)
+
+    def flush(self, timeout=None):
+        # wait for queued changes to be sent, returns False on timeout
+        deadline = None if timeout is None else time() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time() > deadline:
+                return False
+            sleep(0.01)
+        return True
+
+    def _ensure_worker(self):
+        # threads do not survive a fork, so gunicorn workers start their own
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            Thread(target=self._run, daemon=True).start()
+            atexit.register(self.flush, timeout=self.flush_interval * 5)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time(), 0)))
+                except Empty:
+                    break
+            self._send(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    def _send(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.app.app_context():
+                    batch = bulk_index(batch)
+            except Exception:
+                self.app.logger.warning('Search indexing request failed', exc_info=True)
+            if not batch:
+                return
+            sleep(self.retry_backoff * 2 ** attempt)
+        self.app.logger.error('Search indexing gave up on %d documents', len(batch))
+
+
+class RQIndexer(object):
+    # durable mode, each commit's changes become rq jobs run by `rq worker`
+    # jobs are split into batch_size chunks and retried by rq on failure
+
+    def __init__(self, app):
+        from rq import Queue as RQueue
+        self.app = app
+        self.batch_size = app.config['SEARCH_INDEX_BATCH_SIZE']
+        self.max_retries = app.config['SEARCH_INDEX_MAX_RETRIES']
+        self.retry_backoff = app.config['SEARCH_INDEX_RETRY_BACKOFF']
+        self.queue = RQueue(app.config['SEARCH_INDEX_QUEUE'], connection=app.redis)
+
+    def put(self, actions):
+        from rq import Retry
+        retry = Retry(max=self.max_retries, interval=[
+            self.retry_backoff * 2 ** attempt for attempt in range(self.max_retries)])
+        for i in range(0, len(actions), self.batch_size):
+            self.queue.enqueue('app.tasks.index_documents',
+                               actions[i:i + self.batch_size], retry=retry)
+
+    def flush(self, timeout=None):
+        return True
+
+
+def create_indexer(app):
+    # pick the indexing pipeline, None when search is not configured
+    # embedded backends are cheap to update so they are always written in-line
+    if not app.search_backend:
+        return None
+    if not app.search_backend.remote:
+        return SyncIndexer(app)
+    mode = app.config['SEARCH_INDEX_MODE']
+    if mode == 'rq':
+        return RQIndexer(app)
+    if mode == 'thread':
+        return ThreadIndexer(app)
+    return SyncIndexer(app)
+
+
+def reindex(model, chunk_size=1000, workers=4, use_alias=True, keep_old=False,
+            progress=None):
+    # rebuild the search index of a model from the database, returns the row count
+    # rows are streamed in primary key chunks as plain tuples, so no ORM objects
+    # pile up in the identity map, and each chunk is sent as a _bulk request
+    # from a pool of worker threads
+    # with use_alias the rows go into a fresh versioned index, and the alias named
+    # after the table is switched over atomically once it is complete, so searches
+    # keep hitting the old index during the rebuild
+    # commits made meanwhile are indexed into the old index, so the ids they
+    # logged to search_changes are copied into the new one from the current
+    # rows before the swap, and once more after it for the commits in between
+    app = current_app._get_current_object()
+    es = app.elasticsearch
+    alias = model.__tablename__
+    target = f'{alias}-{datetime.utcnow():%Y%m%d%H%M%S}' if use_alias else alias
+    if use_alias:
+        # refreshing while bulk loading is wasted work, it is switched back on below
+        es.indices.create(index=target, body={'settings': {'refresh_interval': '-1'}})
+    columns = [getattr(model, field) for field in model.__searchable__]
+
+    def send(actions):
+        for attempt in range(app.config['SEARCH_INDEX_MAX_RETRIES'] + 1):
+            try:
+                failed = bulk_index(actions)
+            except Exception:
+                app.logger.warning('Reindex bulk request failed', exc_info=True)
+                failed = actions
+            if not failed:
+                return
+            actions = failed
+            sleep(app.config['SEARCH_INDEX_RETRY_BACKOFF'] * 2 ** attempt)
+        raise RuntimeError(f'Reindex of {alias} failed for {len(actions)} documents')
+
+    def send_from_worker(actions):
+        # popping an app context removes the session of its thread, so only
+        # the pool threads push one
+        with app.app_context():
+            send(actions)
+
+    def replay(since):
+        # index the current rows of the ids logged since then into target
+        from app.models import search_changes
+        changes = search_changes.c
+        # a fresh transaction, so commits made since the last read are seen
+        db.session.rollback()
+        ids = sorted(db.session.execute(db.select([changes.object_id]).distinct().where(
+            changes.index_name == alias).where(changes.timestamp >= since)).scalars())
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            rows = {row[0]: row[1:] for row in db.session.query(model.id, *columns).filter(
+                model.id.in_(chunk))}
+            send([('index', target, id, dict(zip(model.__searchable__, rows[id])))
+                  if id in rows else ('delete', target, id, None) for id in chunk])
+
+    # a commit logs its entries before it commits, so look back a gap timeout
+    # for the ones that were still in flight
+    lookback = timedelta(seconds=app.config['SEARCH_CHANGE_GAP_TIMEOUT'])
+    try:
+        total = 0
+        last_id = 0
+        started = time()
+        since = datetime.utcnow() - lookback
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            while True:
+                rows = db.session.query(model.id, *columns).filter(
+                    model.id > last_id).order_by(model.id).limit(chunk_size).all()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                actions = [('index', target, row[0], dict(zip(model.__searchable__, row[1:])))
+                           for row in rows]
+                pending.add(executor.submit(send_from_worker, actions))
+                total += len(rows)
+                # keep a bounded number of chunks in flight so memory stays flat
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                if progress:
+                    progress(total, time() - started)
+            for future in pending:
+                future.result()
+        if use_alias:
+            swapping = datetime.utcnow() - lookback
+            replay(since)
+    except Exception:
+        # leave the live index alone and drop the half built one
+        if use_alias:
+            es.indices.delete(index=target)
+        raise
+
+    if use_alias:
+        es.indices.put_settings(index=target, body={'index': {'refresh_interval': '1s'}})
+        es.indices.refresh(index=target)
+        old = _swap_alias(es, alias, target)
+        replay(swapping)
+        invalidate_search([alias])
+        if not keep_old:
+            for index in old:
+                es.indices.delete(index=index)
+    return total
+
+
+def _swap_alias(es, alias, index):
+    # point alias at index in one atomic update, returns the indices it left
+    actions = []
+    old = []
+    if es.indices.exists_alias(name=alias):
+        old = list(es.indices.get_alias(name=alias))
+        actions.extend({'remove': {'index': name, 'alias': alias}} for name in old)
+    elif es.indices.exists(index=alias):
+        # the first rebuild replaces the concrete index named after the table
+        actions.append({'remove_index': {'index': alias}})
+    actions.append({'add': {'index': index, 'alias': alias}})
+    es.indices.update_aliases(body={'actions': actions})
+    return old
@@ -0,0 +1,246 @@
+import cProfile
+import hmac
+import ipaddress
+import json
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from random import random
+from threading import Lock
+from time import perf_counter, time
+from flask import g, request, abort, has_request_context, before_render_template, \
+    template_rendered, got_request_exception
+from sqlalchemy.engine import Engine
+from app import db
+
+
+class QueryCounter(object):
+    # counts the SQL statements sent through the engine while the block runs
+    # e.g. with QueryCounter() as queries: ... then assert on queries.count
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __enter__(self):
+        db.event.listen(db.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        db.event.remove(db.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+# opt-in per request instrumentation, see Instrumentation below
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+@contextmanager
+def timed(name):
+    # add the time spent in the block to the current request's timings,
+    # a no-op outside of instrumented requests
+    timings = _timings()
+    if timings is None:
+        yield
+        return
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] += perf_counter() - started
+
+
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    if _timings() is not None:
+        conn.info.setdefault('query_started', []).append(perf_counter())
+
+
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    timings = _timings()
+    if timings is not None and conn.info.get('query_started'):
+        timings['db'] += perf_counter() - conn.info['query_started'].pop()
+        timings['queries'] += 1
+
+
+def _timings():
+    if has_request_context():
+        return g.get('_timings')
+    return None
+
+
+class Metrics(object):
+    # per endpoint counters and latency histogram of this process, exported in
+    # the Prometheus text format, each gunicorn worker keeps its own
+
+    def __init__(self):
+        self.endpoints = {}
+        self._lock = Lock()
+
+    def observe(self, endpoint, status, timings, latency):
+        with self._lock:
+            metric = self.endpoints.get(endpoint)
+            if metric is None:
+                metric = self.endpoints[endpoint] = {
+                    'requests': defaultdict(int), 'latency': 0.0, 'seconds': defaultdict(float),
+                    'queries': 0, 'buckets': [0] * len(LATENCY_BUCKETS)}
+            metric['requests'][status] += 1
+            metric['latency'] += latency
+            metric['queries'] += timings['queries']
+            for name in ('db', 'es', 'template'):
+                metric['seconds'][name] += timings[name]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    metric['buckets'][i] += 1
+
+    def render(self):
+        lines = ['# TYPE blog_requests_total counter',
+                 '# TYPE blog_request_duration_seconds histogram',
+                 '# TYPE blog_sql_queries_total counter',
+                 '# TYPE blog_component_seconds_total counter']
+        with self._lock:
+            for endpoint, metric in sorted(self.endpoints.items()):
+                label = f'endpoint="{endpoint}"'
+                for status, count in sorted(metric['requests'].items()):
+                    lines.append(f'blog_requests_total{{{label},status="{status}"}} {count}')
+                total = sum(metric['requests'].values())
+                for bound, count in zip(LATENCY_BUCKETS, metric['buckets']):
+                    lines.append(f'blog_request_duration_seconds_bucket{{{label},le="{bound}"}} {count}')
+                lines.append(f'blog_request_duration_seconds_bucket{{{label},le="+Inf"}} {total}')
+                lines.append(f'blog_request_duration_seconds_sum{{{label}}} {metric["latency"]:.6f}')
+                lines.append(f'blog_request_duration_seconds_count{{{label}}} {total}')
+                lines.append(f'blog_sql_queries_total{{{label}}} {metric["queries"]}')
+                for name, seconds in sorted(metric['seconds'].items()):
+                    lines.append(f'blog_component_seconds_total{{{label},component="{name}"}} {seconds:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+class Instrumentation(object):
+    # times SQL (engine events), Elasticsearch (timed('es') in app/search.py),
+    # template rendering (flask signals) and the whole request, and reports them
+    # as a Server-Timing header, one JSON log line per request and on /metrics
+    # /metrics is only served when METRICS_TOKEN or METRICS_ALLOWED_IPS is set,
+    # to requests bearing the token or coming from an allowed network
+    # a sample of requests runs under cProfile, kept when the request was slow
+
+    def __init__(self, app):
+        self.app = app
+        self.metrics = Metrics()
+        self.profile_rate = app.config['PROFILE_SAMPLE_RATE']
+        self.profile_threshold = app.config['PROFILE_SLOW_THRESHOLD']
+        self.profile_dir = app.config['PROFILE_DIR']
+        self.metrics_token = app.config['METRICS_TOKEN']
+        self.metrics_networks = [ipaddress.ip_network(network, strict=False)
+                                 for network in app.config['METRICS_ALLOWED_IPS']]
+        # class level listeners cover every engine, replicas included
+        if not db.event.contains(Engine, 'before_cursor_execute', _before_query):
+            db.event.listen(Engine, 'before_cursor_execute', _before_query)
+            db.event.listen(Engine, 'after_cursor_execute', _after_query)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        got_request_exception.connect(self._render_failed, app)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+        if self.metrics_token or self.metrics_networks:
+            app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+
+    def _start(self):
+        g._timings = defaultdict(float, queries=0)
+        g._render_depth = 0
+        g._started = perf_counter()
+        g._profile = None
+        if self.profile_rate and random() < self.profile_rate:
+            g._profile = cProfile.Profile()
+            g._profile.enable()
+
+    def _finish(self, response):
+        timings = _timings()
+        if timings is None:
+            return response
+        latency = perf_counter() - g._started
+        if g._profile is not None:
+            g._profile.disable()
+            if latency >= self.profile_threshold:
+                self._save_profile(g._profile, latency)
+            g._profile = None
+        endpoint = request.endpoint or 'unmatched'
+        response.headers['Server-Timing'] = ', '.join([
+            f'db;dur={timings["db"] * 1000:.1f};desc="{timings["queries"]} queries"',
+            f'es;dur={timings["es"] * 1000:.1f}',
+            f'template;dur={timings["template"] * 1000:.1f}',
+            f'total;dur={latency * 1000:.1f}'])
+        self.app.logger.info(json.dumps({
+            'endpoint': endpoint, 'method': request.method, 'path': request.path,
+            'status': response.status_code, 'latency_ms': round(latency * 1000, 1),
+            'queries': timings['queries'], 'db_ms': round(timings['db'] * 1000, 1),
+            'es_ms': round(timings['es'] * 1000, 1),
+            'template_ms': round(timings['template'] * 1000, 1)}))
+        self.metrics.observe(endpoint, response.status_code, timings, latency)
+        return response
+
+    def _teardown(self, exc):
+        # requests failing with an exception skip _finish
+        if g.get('_profile') is not None:
+            g._profile.disable()
+            g._profile = None
+
+    def _metrics_view(self):
+        if not self._metrics_allowed():
+            abort(403)
+        return self.app.response_class(self.metrics.render(),
+                                       content_type='text/plain; version=0.0.4')
+
+    def _metrics_allowed(self):
+        # request.remote_addr is the proxy's address behind one, unless the
+        # deployment wraps the app in werkzeug's ProxyFix
+        if self.metrics_token:
+            scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+            if scheme.lower() == 'bearer' and hmac.compare_digest(token.encode(),
+                                                                   self.metrics_token.encode()):
+                return True
+        if self.metrics_networks and request.remote_addr:
+            try:
+                address = ipaddress.ip_address(request.remote_addr)
+            except ValueError:
+                return False
+            return any(address in network for network in self.metrics_networks)
+        return False
+
+    def _save_profile(self, profile, latency):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = f'{request.endpoint or "unmatched"}-{int(time() * 1000)}-{int(latency * 1000)}ms.prof'
+        profile.dump_stats(os.path.join(self.profile_dir, name))
+
+    def _before_render(self, app, template, context):
+        # templates render other templates (post cards), only time the outermost
+        if _timings() is not None:
+            if g._render_depth == 0:
+                g._render_started = perf_counter()
+            g._render_depth += 1
+
+    def _after_render(self, app, template, context):
+        timings = _timings()
+        if timings is not None:
+            g._render_depth -= 1
+            if g._render_depth == 0:
+                timings['template'] += perf_counter() - g._render_started
+
+    def _render_failed(self, app, exception):
+        # a template that raised never sent template_rendered, count its render
+        # so far and let the error page be timed as a render of its own
+        timings = _timings()
+        if timings is not None and g._render_depth:
+            timings['template'] += perf_counter() - g._render_started
+            g._render_depth = 0
+
+
+def create_instrumentation(app):
+    if app.config['INSTRUMENTATION']:
+        return Instrumentation(app)
+    return None
@@ -0,0 +1,109 @@
+# minimal SMTP server that accepts every message and keeps it in memory,
+# a stand-in for a real mail server in tests and local development
+#
+#   python -m app.mailserver    (listens on MAIL_PORT, with MAIL_SERVER=localhost)
+import os
+import socketserver
+import sys
+from collections import namedtuple
+from email import message_from_bytes
+from threading import Thread
+
+Envelope = namedtuple('Envelope', ['sender', 'recipients', 'message'])
+
+
+class DebugSMTPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='localhost', port=8025, echo=False):
+        super(DebugSMTPServer, self).__init__((host, port), SMTPHandler)
+        self.messages = []  # Envelope per accepted message
+        self.connections = 0
+        self.echo = echo
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        # serve from a background thread, port 0 picks a free port
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def deliver(self, envelope):
+        self.messages.append(envelope)
+        if self.echo:
+            print(f'---------- from {envelope.sender} to {", ".join(envelope.recipients)}')
+            print(envelope.message.as_string())
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    # the subset of RFC 5321 smtplib uses, without authentication or TLS
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost debugging SMTP server')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                self.reply('250-localhost', '250-8BITMIME', '250 SMTPUTF8')
+            elif verb == 'HELO':
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                sender, recipients = _address(command), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(_address(command))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                self.server.deliver(Envelope(sender, recipients, message_from_bytes(self.read_data())))
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+    def read_data(self):
+        lines = []
+        for line in self.rfile:
+            if line in (b'.\r\n', b'.\n'):
+                break
+            # undo the dot stuffing of lines starting with a period
+            lines.append(line[1:] if line.startswith(b'..') else line)
+        return b''.join(lines)
+
+    def reply(self, *lines):
+        self.wfile.write(''.join(line + '\r\n' for line in lines).encode())
+
+
+def _address(command):
+    # 'MAIL FROM:<a@b.c> SIZE=100' -> 'a@b.c'
+    return command.split(':', 1)[1].strip().split(' ')[0].strip('<>')
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1] if len(sys.argv) > 1 else os.getenv('MAIL_PORT') or 8025)
+    server = DebugSMTPServer(port=port, echo=True)
+    print(f'Debugging SMTP server listening on localhost:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -1,22 +1,26 @@
 from flask import render_template, flash, redirect, url_for, request, current_app, g
 from flask_login import current_user, login_required
 from werkzeug.urls import url_parse
-from datetime import datetime
 from app import db
 from app.main import bp
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm
 from app.models import User, Posts
+from app.timeline import query_timeline
+from app.pagination import paginate_posts, request_cursors, cursor_urls, CursorPagination
+from app.pagecache import cached_page
+from app.export import FORMATS, export_response
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        # buffered and written in batches, see app/presence.py
+        current_app.last_seen.seen(current_user)
         # g can store data that is available to all templates for life of request
         g.search_form = SearchForm()
 
 @bp.route("/")
 @bp.route("/index")
+@cached_page
 def index():
     return render_template('main/home.html')
 
@@ -25,51 +29,37 @@ def index():
 def blog():
     form = PostForm()
     if form.validate_on_submit():
-        post = Posts(body=form.post.data, author=current_user)
+        post = Posts(body=form.post.data, author=current_user.model())
         db.session.add(post)
         db.session.commit()
         flash('Your post is now live!', 'success')
         return redirect(url_for('main.blog'))
-    page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page=page,
-        per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False
-    )
     template = 'main.blog'
-    first_url = url_for(template, page=1)
-    last_url = url_for(template, page=posts.pages)
-    next_url = url_for(template, page=posts.next_num) if posts.has_next else None
-    prev_url = url_for(template, page=posts.prev_num) if posts.has_prev else None
+    if current_app.timeline:
+        # read the page of ids from the materialized timeline, then load just those posts
+        # the timeline pages by the same cursors as the other listings
+        before, after = request_cursors()
+        ids, has_prev, has_next = query_timeline(
+            current_user, current_app.config['POSTS_PER_PAGE'], before, after)
+        posts = CursorPagination(Posts.hydrate(ids), has_prev, has_next)
+        urls = cursor_urls(posts, template)
+    else:
+        posts, urls = paginate_posts(current_user.followed_posts(), Posts, template)
     return render_template('main/blog.html', 
                            form=form, 
                            posts=posts,
-                           first_url=first_url,
-                           last_url=last_url,
-                           next_url=next_url,
-                           prev_url=prev_url,
-                           template=template)
+                           template=template,
+                           **urls)
 
 @bp.route('/explore')
+@cached_page
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = Posts.query.order_by(Posts.timestamp.desc()).paginate(
-        page=page,
-        per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False
-    )
     template='main.explore' #set current page template to reuse with blog
-    first_url = url_for(template, page=1)
-    last_url = url_for(template, page=posts.pages)
-    next_url = url_for(template, page=posts.next_num) if posts.has_next else None
-    prev_url = url_for(template, page=posts.prev_num) if posts.has_prev else None
+    posts, urls = paginate_posts(Posts.listing().order_by(Posts.timestamp.desc()), Posts, template)
     return render_template('main/blog.html', 
                            posts=posts,
-                           first_url=first_url,
-                           last_url=last_url,
-                           next_url=next_url,
-                           prev_url=prev_url,
-                           template=template
+                           template=template,
+                           **urls
                            )
 
 @bp.route('/search')
@@ -90,37 +80,40 @@ def search():
 @login_required
 def user(email):
     user = User.query.filter_by(email=email).first_or_404()
-    page = request.args.get('page', 1, type=int) # get the url 'page' arg, default is page 1
-    posts = Posts.query.filter_by(user_id=user.id).order_by(Posts.timestamp.desc()).paginate(
-        page=page,
-        per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False
-    )
     template = 'main.user' #set current page template (used below and in the jinja template)
-    first_url = url_for(template, email=user.email, page=1)
-    last_url = url_for(template, email=user.email, page=posts.pages)
-    next_url = url_for(template, email=user.email, page=posts.next_num) if posts.has_next else None
-    prev_url = url_for(template, email=user.email, page=posts.prev_num) if posts.has_prev else None
+    posts, urls = paginate_posts(
+        Posts.listing().filter_by(user_id=user.id).order_by(Posts.timestamp.desc()),
+        Posts, template, email=user.email)
     form = EmptyForm() #pass the same empty form used for following/unfollowing views
     return render_template('main/user.html', 
                            user=user, 
+                           last_seen=current_app.last_seen.last_seen(user),
                            posts=posts,
-                           first_url=first_url,
-                           last_url=last_url,
-                           next_url=next_url,
-                           prev_url=prev_url,
                            template=template,
-                           form=form)
+                           form=form,
+                           **urls)
+
+@bp.route('/export/posts')
+@login_required
+def export_posts():
+    # download of all of the user's posts, ?format=csv for a spreadsheet and
+    # ?gzip=1 to compress it
+    format = request.args.get('format', 'ndjson')
+    if format not in FORMATS:
+        format = 'ndjson'
+    return export_response(format, user_id=current_user.id,
+                           compress=request.args.get('gzip', type=int) == 1, name='my-posts')
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
 def edit_profile():
     form = EditProfileForm(current_user.email)
     if form.validate_on_submit():
-        current_user.first_name = form.first_name.data
-        current_user.last_name = form.last_name.data
-        current_user.email = form.email.data
-        current_user.about_me = form.about_me.data
+        user = current_user.model() # full ORM user, current_user may be a cached snapshot
+        user.first_name = form.first_name.data
+        user.last_name = form.last_name.data
+        user.set_email(form.email.data)
+        user.about_me = form.about_me.data
         db.session.commit()
         flash('Your changes have been saved.', 'success')
         return redirect(url_for('main.edit_profile'))
@@ -143,7 +136,7 @@ def follow(email):
         if user == current_user:
             flash('You cannot follow yourself!', 'info')
             return redirect(url_for('main.user', email=email))
-        current_user.follow(user)
+        current_user.model().follow(user)
         db.session.commit()
         flash(f'You are now following {email}!', 'success')
         return redirect(url_for('main.user', email=email))
@@ -162,7 +155,7 @@ def unfollow(email):
         if user == current_user:
             flash('You cannot unfollow yourself!', 'info')
             return redirect(url_for('main.user', email=email))
-        current_user.unfollow(user)
+        current_user.model().unfollow(user)
         db.session.commit()
         flash(f'You are no longer following {email}', 'info')
         return redirect(url_for('main.user', email=email))
@@ -1,10 +1,11 @@
 import jwt
 from flask import current_app
 from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
-from werkzeug.security import generate_password_hash, check_password_hash
+from app.search import query_index, invalidate_search
+from app import timeline as timelines
 from flask_login import UserMixin
 from hashlib import md5
+from functools import lru_cache
 from datetime import datetime
 from time import time
 
@@ -16,15 +17,31 @@ class SearchableMixin(object):
         # wrap the query from search.py to replace the list of object Ids with actual objects
         # pass cls.__tablename__ as the index name
         ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
-        # initiate list for query order
-        when = []
-        # append the ids in elastic search query order
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        # return the results sorted in same order provided, e.g. in more to less relevant
-        return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)), total
+        # return the results in the rank order provided, e.g. in more to less relevant
+        return cls.hydrate(ids), total
+    
+    @classmethod
+    def hydrate(cls, ids):
+        # load objects by primary key and return them in the order of ids
+        # fully loaded objects already in the session's identity map are reused and
+        # the rest come from one IN query, the ranking is applied here in python
+        # rather than with an ORDER BY CASE the database cannot index
+        found = {}
+        for id in ids:
+            obj = db.session.identity_map.get(db.inspect(cls).identity_key_from_primary_key([id]))
+            if obj is not None and not db.inspect(obj).unloaded:
+                found[id] = obj
+        missing = [id for id in ids if id not in found]
+        if missing:
+            found.update((obj.id, obj) for obj in cls.listing().filter(cls.id.in_(missing)))
+        # ids deleted since they were indexed are skipped
+        return [found[id] for id in ids if id in found]
+    
+    @classmethod
+    def listing(cls):
+        # base query used when rendering lists of results, models override it
+        # to eager load whatever their list templates need
+        return cls.query
     
     @classmethod
     def before_commit(cls, session):
@@ -34,41 +51,163 @@ class SearchableMixin(object):
             'update': list(session.dirty),
             'delete': list(session.deleted)
         }
-    
-    @classmethod
-    def after_commit(cls, session):
-        # on db commit, apply _changes and index
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
+        if not current_app.indexer:
+            return
+        # flush now so new objects have ids, then snapshot their documents while
+        # the attributes are still loaded (commit expires them)
+        session.flush()
+        actions = []
+        for obj in session._changes['add'] + session._changes['update']:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
+                actions.append(('index', obj.__tablename__, obj.id, obj.search_document()))
         for obj in session._changes['delete']:
             if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
+                actions.append(('delete', obj.__tablename__, obj.id, None))
+        session._changes['actions'] = actions
+        if actions:
+            # embedded indices of other processes and index rebuilds catch up
+            # from this log
+            current_app.search_backend.log(session, actions)
+    
+    @classmethod
+    def after_commit(cls, session):
+        # on db commit, hand the _changes to the indexing pipeline as one batch
+        # and invalidate the cached search results of the indices they touch
+        if session._changes and session._changes.get('actions'):
+            actions = session._changes['actions']
+            invalidate_search({action[1] for action in actions})
+            current_app.indexer.put(actions)
         session._changes = None
+    
+    def search_document(self):
+        # fields sent to the search index
+        return {field: getattr(self, field) for field in self.__searchable__}
         
     @classmethod
-    def reindex(cls):
+    def reindex(cls, **kwargs):
         # helper to refresh index with data from relational side
-        # add posts in database to search index
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+        # streams the table into a fresh index, see app/indexing.py
+        from app.indexing import reindex
+        return reindex(cls, **kwargs)
 
 # setup event handlers to call before commit and after_commit
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+# keep the materialized timelines in step with posts and follows
+db.event.listen(db.session, 'after_flush', timelines.after_flush)
+db.event.listen(db.session, 'after_commit', timelines.after_commit)
+db.event.listen(db.session, 'after_soft_rollback', timelines.after_rollback)
+
+def count_posts(session, flush_context):
+    # keep User.posts_count in step with posts written in the same transaction
+    changes = {}
+    for obj in session.new:
+        if isinstance(obj, Posts):
+            changes[obj.user_id] = changes.get(obj.user_id, 0) + 1
+    for obj in session.deleted:
+        if isinstance(obj, Posts):
+            changes[obj.user_id] = changes.get(obj.user_id, 0) - 1
+    users = User.__table__
+    for user_id, delta in changes.items():
+        if user_id is not None and delta:
+            session.connection().execute(users.update().where(users.c.id == user_id).values(
+                posts_count=users.c.posts_count + delta))
+            # a loaded author would otherwise keep its old count until commit
+            author = session.identity_map.get(db.inspect(User).identity_key_from_primary_key([user_id]))
+            if author is not None:
+                session.expire(author, ['posts_count'])
+            if current_app.user_cache is not None:
+                session.info.setdefault('users', set()).add(user_id)
+
+db.event.listen(db.session, 'after_flush', count_posts)
 
-# load user from database during login
+# load user during login, from the user cache when one is configured
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    cache = current_app.user_cache
+    if cache is None:
+        return User.query.get(int(id))
+    values = cache.get(id)
+    if values is None:
+        user = User.query.get(int(id))
+        if user is None:
+            return None
+        values = {field: getattr(user, field) for field in UserSnapshot.fields}
+        cache.set(id, values)
+    return UserSnapshot(values)
+
+def invalidate_users(session):
+    # drop cached snapshots of users changed by the commit (profile edits,
+    # password resets, follows) once the new values are visible to other requests,
+    # and move their post cards to a new author version
+    ids = session.info.pop('users', None)
+    if not ids:
+        return
+    for id in ids:
+        if current_app.user_cache is not None:
+            current_app.user_cache.delete(str(id))
+        if current_app.fragment_cache is not None:
+            current_app.fragment_cache.bump(f'author:{id}')
+
+def forget_users(session, previous_transaction):
+    session.info.pop('users', None)
+
+def track_users(session, flush_context, instances):
+    # collected on every flush, the changes are no longer in session.dirty at commit
+    if current_app.user_cache is not None or current_app.fragment_cache is not None:
+        session.info.setdefault('users', set()).update(
+            obj.id for obj in list(session.dirty) + list(session.deleted)
+            if isinstance(obj, User))
+
+db.event.listen(db.session, 'before_flush', track_users)
+db.event.listen(db.session, 'after_commit', invalidate_users)
+db.event.listen(db.session, 'after_soft_rollback', forget_users)
+
+def track_pages(session, flush_context):
+    # anonymous pages list posts with their authors
+    if current_app.page_cache is not None and any(
+            isinstance(obj, (Posts, User))
+            for obj in list(session.new) + list(session.dirty) + list(session.deleted)):
+        session.info['pages'] = True
+
+def invalidate_pages(session):
+    # a new posts generation makes every cached page a miss
+    if session.info.pop('pages', None) and current_app.page_cache is not None:
+        current_app.page_cache.bump('posts')
+
+def forget_pages(session, previous_transaction):
+    session.info.pop('pages', None)
+
+db.event.listen(db.session, 'after_flush', track_pages)
+db.event.listen(db.session, 'after_commit', invalidate_pages)
+db.event.listen(db.session, 'after_soft_rollback', forget_pages)
 
 # association table with User class for followers & followed
+# the primary key serves lookups by follower (followed, is_following) and the
+# reverse index lookups by followed user (followers, timeline fan-out)
 followers = db.Table('followers',
-                     db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+                     db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                     db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
+)
+
+# materialized timeline, one row per post visible to a user (see app/timeline.py)
+timeline = db.Table('timeline',
+                    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                    db.Column('post_id', db.Integer, primary_key=True),
+                    db.Column('timestamp', db.DateTime),
+                    db.Index('ix_timeline_user_id_timestamp_post_id', 'user_id', 'timestamp', 'post_id')
+)
+
+# searchable rows changed by each commit, replayed by the embedded search
+# indices of the other processes and by index rebuilds (see app/search.py)
+# ids are never reused, a process keeps its place in the log by id
+search_changes = db.Table('search_changes',
+                          db.Column('id', db.Integer, primary_key=True),
+                          db.Column('index_name', db.String(64)),
+                          db.Column('object_id', db.Integer),
+                          db.Column('timestamp', db.DateTime, index=True),
+                          sqlite_autoincrement=True
 )
 
 class User(UserMixin, db.Model):
@@ -81,6 +220,12 @@ class User(UserMixin, db.Model):
     tagline = db.Column(db.String(120))
     about_me = db.Column(db.String(3500))
     avatar = db.Column(db.String(120))
+    # md5 of the normalized email used in gravatar urls, set by set_email
+    email_digest = db.Column(db.String(32))
+    # denormalized counts, kept in step by follow/unfollow and count_posts below
+    followers_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    followed_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    posts_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     posts = db.relationship('Posts', backref='author', lazy='dynamic')
     followed = db.relationship(
         'User', # right side relationship, left side being parent class
@@ -91,16 +236,31 @@ class User(UserMixin, db.Model):
         lazy='dynamic' #applied to left side relationship
     )
     
+    def set_email(self, email):
+        self.email = email
+        self.email_digest = md5(email.lower().encode('utf-8')).hexdigest()
+    
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = current_app.password_hasher.hash(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        hasher = current_app.password_hasher
+        if not hasher.check(self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            # stored with older parameters, upgrade it while the password is at hand
+            self.password_hash = hasher.hash(password)
+        return True
     
     def get_reset_password_token(self, expires_in=600):
+        return User.reset_password_token(self.id, expires_in)
+    
+    @staticmethod
+    def reset_password_token(user_id, expires_in=600):
         # Create JSON web token using secret key
+        # takes just the id so mail workers can sign tokens without loading users
         return jwt.encode(
-            {'reset_password': self.id,
+            {'reset_password': user_id,
              'exp': time() + expires_in},
             current_app.config['SECRET_KEY'],
             algorithm='HS256'
@@ -117,23 +277,94 @@ class User(UserMixin, db.Model):
             return
         return User.query.get(id)
     
+    def get_api_token(self, expires_in=3600):
+        # bearer token for the json api, signed like the reset tokens so checking
+        # one needs no database lookup
+        return jwt.encode(
+            {'api': self.id,
+             'exp': time() + expires_in},
+            current_app.config['SECRET_KEY'],
+            algorithm='HS256'
+        )
+    
+    @staticmethod
+    def verify_api_token(token):
+        # returns the user id of a valid token, or None
+        try:
+            return jwt.decode(token,
+                              current_app.config['SECRET_KEY'],
+                              algorithms=['HS256'])['api']
+        except (jwt.InvalidTokenError, KeyError):
+            return None
+    
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        # users built without set_email have no stored digest yet
+        digest = self.email_digest or md5(self.email.lower().encode('utf-8')).hexdigest()
+        return _avatar_url(digest, size)
     
     def is_following(self, user):
-        # used to check is user is already following
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        # used to check is user is already following, EXISTS stops at the first
+        # matching row of the primary key
+        return db.session.query(db.exists().where(db.and_(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id == user.id))).scalar()
+    
+    def following_status(self, user_ids):
+        # {user id: followed or not} for a list of users in one query per chunk,
+        # so pages rendering many follow buttons do not check them one by one
+        ids = list(user_ids)
+        followed = set()
+        for chunk in _chunks(set(ids)):
+            followed.update(db.session.execute(db.select([followers.c.followed_id]).where(
+                db.and_(followers.c.follower_id == self.id,
+                        followers.c.followed_id.in_(chunk)))).scalars())
+        return {id: id in followed for id in ids}
     
     def follow(self, user):
         # if not already following, follow target user
-        if not self.is_following(user):
-            self.followed.append(user)
+        # flushed first so users added in this transaction have ids
+        db.session.flush()
+        return self.follow_many([user.id]) > 0
     
     def unfollow(self, user):
         # if already following, unfollow target user
-        if self.is_following(user):
-            self.followed.remove(user)
+        db.session.flush()
+        return self.unfollow_many([user.id]) > 0
+    
+    def follow_many(self, user_ids):
+        # follow every user in user_ids, already followed users are skipped
+        # returns how many follows were added
+        status = self.following_status(user_ids)
+        added = [id for id, following in status.items() if not following]
+        if not added:
+            return 0
+        # a concurrent request may insert the same row first, the primary key
+        # keeps one and the insert ignores the conflict
+        # one multi-row statement per chunk, so rowcount is what was inserted
+        inserted = 0
+        for chunk in _chunks(added):
+            inserted += db.session.execute(_insert_ignore(followers).values([
+                {'follower_id': self.id, 'followed_id': id} for id in chunk])).rowcount
+        _count_follows(self.id, added, 1, inserted)
+        for id in added:
+            timelines.timeline_follow(self.id, id)
+        return inserted
+    
+    def unfollow_many(self, user_ids):
+        # returns how many follows were removed
+        status = self.following_status(user_ids)
+        removed = [id for id, following in status.items() if following]
+        if not removed:
+            return 0
+        deleted = 0
+        for chunk in _chunks(removed):
+            deleted += db.session.execute(followers.delete().where(db.and_(
+                followers.c.follower_id == self.id,
+                followers.c.followed_id.in_(chunk)))).rowcount
+        _count_follows(self.id, removed, -1, deleted)
+        for id in removed:
+            timelines.timeline_unfollow(self.id, id)
+        return deleted
     
     def followed_posts(self):
         followed_posts = Posts.query.join( # create temp table that combines posts and followers
@@ -144,17 +375,119 @@ class User(UserMixin, db.Model):
         # get users own posts
         own_posts = Posts.query.filter_by(user_id=self.id)
         # union and return result
-        return followed_posts.union(own_posts).order_by(Posts.timestamp.desc())
+        return followed_posts.union(own_posts).options(
+            db.selectinload(Posts.author)).order_by(Posts.timestamp.desc())
     
     def __repr__(self):
         return f'<User {self.email}>'
 
+    def model(self):
+        return self
+    
+    @staticmethod
+    def recount(ids=None):
+        # recompute the denormalized counts from the followers and posts tables
+        # in one UPDATE, for every user or just the given ids
+        users = User.__table__
+        statement = users.update().values(
+            followers_count=db.select([db.func.count()]).where(
+                followers.c.followed_id == users.c.id).scalar_subquery(),
+            followed_count=db.select([db.func.count()]).where(
+                followers.c.follower_id == users.c.id).scalar_subquery(),
+            posts_count=db.select([db.func.count()]).where(
+                Posts.user_id == users.c.id).scalar_subquery())
+        if ids is not None:
+            statement = statement.where(users.c.id.in_(ids))
+        return db.session.execute(statement).rowcount
+
+@lru_cache(maxsize=4096)
+def _avatar_url(digest, size):
+    # the same few sizes are rendered for every post and profile
+    return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+
+def _chunks(ids, size=500):
+    # keep IN lists under the bound parameter limits of the databases
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+def _insert_ignore(table):
+    # INSERT that skips rows violating a unique key, in each dialect's syntax
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    return table.insert()
+
+def _count_follows(follower_id, followed_ids, delta, changed):
+    # adjust the denormalized counts in SQL so concurrent follows cannot lose
+    # an update, then expire the values held by loaded users
+    # changed is how many followers rows the statements actually inserted or
+    # deleted, when a concurrent request got to some of them first it is not
+    # known which, so the counts of these users are recomputed instead
+    users = User.__table__
+    if changed == len(followed_ids):
+        db.session.execute(users.update().where(users.c.id == follower_id).values(
+            followed_count=users.c.followed_count + delta * len(followed_ids)))
+        for chunk in _chunks(followed_ids):
+            db.session.execute(users.update().where(users.c.id.in_(chunk)).values(
+                followers_count=users.c.followers_count + delta))
+    else:
+        for chunk in _chunks([follower_id] + list(followed_ids)):
+            User.recount(chunk)
+    for id in [follower_id] + list(followed_ids):
+        user = db.session.identity_map.get(db.inspect(User).identity_key_from_primary_key([id]))
+        if user is not None:
+            db.session.expire(user, ['followers_count', 'followed_count'])
+    if current_app.user_cache is not None:
+        db.session.info.setdefault('users', set()).update([follower_id] + list(followed_ids))
+
+class UserSnapshot(UserMixin):
+    # detached read-only copy of a User, built by load_user from the user cache
+    # so rendering current_user does not query the database, views that change
+    # the user call model() to get the full ORM object
+    fields = ('id', 'email', 'email_digest', 'first_name', 'last_name', 'last_seen', 'tagline', 'about_me',
+              'followers_count', 'followed_count', 'posts_count')
+    email_digest = None  # missing from snapshots cached before the column existed
+    
+    def __init__(self, values):
+        self.__dict__.update(values)
+    
+    def __eq__(self, other):
+        if isinstance(other, (User, UserSnapshot)):
+            return self.id == other.id
+        return NotImplemented
+    
+    def __hash__(self):
+        return hash(self.id)
+    
+    avatar = User.avatar
+    followed_posts = User.followed_posts
+    is_following = User.is_following
+    following_status = User.following_status
+    
+    def model(self):
+        return User.query.get(self.id)
+    
+    def __repr__(self):
+        return f'<UserSnapshot {self.email}>'
+
 class Posts(SearchableMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     __searchable__ = ['body']
+    
+    @classmethod
+    def listing(cls):
+        # post cards show the author, load all authors of a page in one SELECT
+        return cls.query.options(db.selectinload(cls.author))
 
     def __repr__(self):
         return f'Post {self.body}'
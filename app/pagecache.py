@@ -0,0 +1,45 @@
+from functools import wraps
+from hashlib import md5
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+from werkzeug.urls import url_encode
+from app import db
+from app.models import Posts
+
+
+def cached_page(view):
+    # serve anonymous GETs of a view from the page cache, with a strong ETag and
+    # Last-Modified so browsers and proxies can revalidate with a 304
+    # entries are keyed on the posts generation, bumped by invalidate_pages in
+    # app/models.py whenever posts or their authors change
+    # without a page cache the view is left alone, there is nothing to save
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = current_app.page_cache
+        # logged in users and pending flash messages get a fresh render
+        if cache is None or current_user.is_authenticated or request.method != 'GET' or \
+                session.get('_flashes'):
+            return view(*args, **kwargs)
+        # read the generation before rendering, a commit during the render
+        # then leaves the entry under the old generation
+        key = f"{cache.generation('posts')}:{request.path}?{url_encode(request.args, sort=True)}"
+        entry = cache.get(key)
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            entry = {'body': body,
+                     'content_type': response.content_type,
+                     'etag': md5(body).hexdigest(),
+                     'last_modified': db.session.query(db.func.max(Posts.timestamp)).scalar()}
+            cache.set(key, entry)
+        response = current_app.response_class(entry['body'], content_type=entry['content_type'])
+        response.set_etag(entry['etag'])
+        response.last_modified = entry['last_modified']
+        # proxies may store the page but have to revalidate it on every request,
+        # and must not hand it to a visitor with a session cookie
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response.make_conditional(request)
+    return wrapper
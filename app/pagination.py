@@ -0,0 +1,101 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from flask import current_app, request, url_for
+from app import db
+
+
+def encode_cursor(post):
+    # opaque token for a position in a (timestamp, id) ordered listing
+    raw = f'{post.timestamp.isoformat()}|{post.id}'.encode('utf-8')
+    return urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    # returns (timestamp, id), or None if the token has been tampered with
+    try:
+        raw = urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        timestamp, id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+class CursorPagination(object):
+    # keyset page of posts, stands in for flask_sqlalchemy's Pagination in templates
+    # there are no page numbers or total, only links to the neighbouring pages
+
+    def __init__(self, items, has_prev, has_next):
+        self.items = items
+        self.has_prev = has_prev and len(items) > 0
+        self.has_next = has_next and len(items) > 0
+
+    @property
+    def prev_cursor(self):
+        return encode_cursor(self.items[0]) if self.has_prev else None
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.items[-1]) if self.has_next else None
+
+
+def paginate_cursor(query, model, per_page, before=None, after=None):
+    # seek past the cursor on the (timestamp, id) key instead of using OFFSET,
+    # then fetch one extra row to learn whether another page follows
+    query = query.order_by(None)
+    newest_first = (model.timestamp.desc(), model.id.desc())
+    if after is not None:
+        timestamp, id = after
+        rows = query.filter(db.or_(
+            model.timestamp > timestamp,
+            db.and_(model.timestamp == timestamp, model.id > id))).order_by(
+            model.timestamp.asc(), model.id.asc()).limit(per_page + 1).all()
+        if len(rows) > per_page:
+            return CursorPagination(list(reversed(rows[:per_page])), True, True)
+        # reached the newest posts, serve the first page so it is always full
+    elif before is not None:
+        timestamp, id = before
+        query = query.filter(db.or_(
+            model.timestamp < timestamp,
+            db.and_(model.timestamp == timestamp, model.id < id)))
+    rows = query.order_by(*newest_first).limit(per_page + 1).all()
+    return CursorPagination(rows[:per_page], before is not None, len(rows) > per_page)
+
+
+def paginate_posts(query, model, endpoint, **url_args):
+    # paginate a newest-first listing for a view and build its navigation urls
+    # cursor mode reads before=/after= tokens, offset mode (and old ?page= links)
+    # falls back to flask_sqlalchemy's paginate
+    per_page = current_app.config['POSTS_PER_PAGE']
+    if current_app.config['PAGINATION_MODE'] != 'cursor' or 'page' in request.args:
+        page = request.args.get('page', 1, type=int)
+        posts = query.paginate(page=page, per_page=per_page, error_out=False)
+        return posts, {
+            'first_url': url_for(endpoint, page=1, **url_args),
+            'last_url': url_for(endpoint, page=posts.pages, **url_args),
+            'next_url': url_for(endpoint, page=posts.next_num, **url_args)
+                if posts.has_next else None,
+            'prev_url': url_for(endpoint, page=posts.prev_num, **url_args)
+                if posts.has_prev else None,
+        }
+    before, after = request_cursors()
+    posts = paginate_cursor(query, model, per_page, before=before, after=after)
+    return posts, cursor_urls(posts, endpoint, **url_args)
+
+
+def request_cursors():
+    # the (before, after) cursors of the request, at most one of them is set
+    before = decode_cursor(request.args.get('before', ''))
+    after = decode_cursor(request.args.get('after', '')) if before is None else None
+    return before, after
+
+
+def cursor_urls(posts, endpoint, **url_args):
+    # navigation urls of a CursorPagination, there is no last page to link to
+    return {
+        'first_url': url_for(endpoint, **url_args),
+        'last_url': None,
+        'next_url': url_for(endpoint, before=posts.next_cursor, **url_args)
+            if posts.has_next else None,
+        'prev_url': url_for(endpoint, after=posts.prev_cursor, **url_args)
+            if posts.has_prev else None,
+    }
@@ -0,0 +1,68 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from threading import BoundedSemaphore, Lock
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasher(object):
+    # hashes and checks passwords on a pool of worker processes, so a burst of
+    # logins is capped at `workers` cores instead of pinning every request worker
+    # at most max_pending more requests wait for a slot, the rest get a 503
+    # with workers = 0 hashing runs inline in the request
+
+    def __init__(self, app):
+        self.method = f"pbkdf2:{app.config['PASSWORD_HASH_ALGORITHM']}:" \
+                      f"{app.config['PASSWORD_HASH_ITERATIONS']}"
+        self.salt_length = app.config['PASSWORD_HASH_SALT_LENGTH']
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        self._slots = BoundedSemaphore(self.workers + app.config['PASSWORD_HASH_MAX_PENDING'])
+        self._lock = Lock()
+        self._pool = None
+        self._pid = None
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def check(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # hashes made with another algorithm or cost are upgraded on the next login
+        return pwhash.split('$', 1)[0] != self.method
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+                self._pid = None
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self._slots.acquire(timeout=self.timeout):
+            raise ServiceUnavailable('Too many logins at once, please try again shortly.',
+                                     retry_after=1)
+        try:
+            return self._executor().submit(fn, *args).result(timeout=self.timeout)
+        except TimeoutError:
+            raise ServiceUnavailable('Too many logins at once, please try again shortly.',
+                                     retry_after=1)
+        finally:
+            self._slots.release()
+
+    def _executor(self):
+        # pools do not survive a fork, so gunicorn workers start their own
+        # the pool processes are spawned, not forked, a fork would copy locks
+        # held by the mail and indexing threads and could deadlock on them
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
@@ -0,0 +1,151 @@
+import atexit
+import os
+from datetime import datetime, timedelta
+from threading import Lock, Timer
+from app import db
+
+
+class LastSeenTracker(object):
+    # buffers User.last_seen so requests do not each commit a write
+    # a timestamp is only recorded once per granularity seconds per user, and
+    # buffered timestamps are written in one batched UPDATE every flush_interval
+    # by a timer thread, off the request path, a failed UPDATE puts them back
+    # in the buffer for the next flush
+
+    def __init__(self, app):
+        self.app = app
+        self.granularity = timedelta(seconds=app.config['LAST_SEEN_GRANULARITY'])
+        self.flush_interval = app.config['LAST_SEEN_FLUSH_INTERVAL']
+        self.recent = {}  # user id -> last timestamp recorded by this process
+        self._lock = Lock()
+        self._timer_pid = None  # process whose flush timer is pending
+        atexit.register(self._flush_at_exit)
+
+    def seen(self, user):
+        now = datetime.utcnow()
+        with self._lock:
+            last = max([ts for ts in (self.recent.get(user.id), user.last_seen) if ts],
+                       default=None)
+            due = last is None or now - last >= self.granularity
+            if due:
+                self.recent[user.id] = now
+        if due:
+            self.record(user.id, now)
+            self._schedule_flush()
+
+    def last_seen(self, user):
+        # freshest known value, buffered or stored
+        return self.peek(user.id) or user.last_seen
+
+    def flush(self):
+        updates = self.take()
+        if updates:
+            users = db.metadata.tables['user']
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(users.update().where(users.c.id == db.bindparam('user_id'))
+                                 .values(last_seen=db.bindparam('timestamp')),
+                                 [{'user_id': id, 'timestamp': ts} for id, ts in updates.items()])
+            except Exception:
+                self.restore(updates)
+                raise
+        # forget users whose next visit would be recorded anyway
+        cutoff = datetime.utcnow() - self.granularity
+        with self._lock:
+            self.recent = {id: ts for id, ts in self.recent.items() if ts > cutoff}
+        return len(updates)
+
+    def _schedule_flush(self):
+        # one pending timer per process, threads do not survive a fork
+        with self._lock:
+            if self._timer_pid == os.getpid():
+                return
+            self._timer_pid = os.getpid()
+        timer = Timer(self.flush_interval, self._flush_in_background)
+        timer.daemon = True
+        timer.start()
+
+    def _flush_in_background(self):
+        with self._lock:
+            # visits from here on schedule the next flush
+            self._timer_pid = None
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Writing last seen timestamps failed')
+
+    def _flush_at_exit(self):
+        with self.app.app_context():
+            self.flush()
+
+
+class MemoryLastSeen(LastSeenTracker):
+    # buffer held by each worker process
+
+    def __init__(self, app):
+        super(MemoryLastSeen, self).__init__(app)
+        self.pending = {}
+
+    def record(self, user_id, timestamp):
+        with self._lock:
+            self.pending[user_id] = timestamp
+
+    def peek(self, user_id):
+        return self.pending.get(user_id)
+
+    def take(self):
+        with self._lock:
+            updates, self.pending = self.pending, {}
+        return updates
+
+    def restore(self, updates):
+        # visits recorded since the take are newer
+        with self._lock:
+            for user_id, timestamp in updates.items():
+                self.pending.setdefault(user_id, timestamp)
+
+
+class RedisLastSeen(LastSeenTracker):
+    # buffer shared by every worker in a Redis hash, one worker flushes it per interval
+
+    key = 'last_seen:pending'
+
+    def __init__(self, app):
+        super(RedisLastSeen, self).__init__(app)
+        self.redis = app.redis
+
+    def record(self, user_id, timestamp):
+        self.redis.hset(self.key, user_id, timestamp.isoformat())
+
+    def peek(self, user_id):
+        value = self.redis.hget(self.key, user_id)
+        return datetime.fromisoformat(value.decode()) if value else None
+
+    def take(self):
+        from redis.exceptions import ResponseError
+        if not self.redis.set('last_seen:flush-lock', 1, nx=True, ex=self.flush_interval):
+            return {}
+        try:
+            # move the hash aside atomically so new visits start a fresh one
+            self.redis.rename(self.key, 'last_seen:flushing')
+        except ResponseError:
+            return {}
+        pipe = self.redis.pipeline()
+        pipe.hgetall('last_seen:flushing')
+        pipe.delete('last_seen:flushing')
+        values = pipe.execute()[0]
+        return {int(id): datetime.fromisoformat(ts.decode()) for id, ts in values.items()}
+
+    def restore(self, updates):
+        # visits recorded since the take are newer
+        pipe = self.redis.pipeline()
+        for user_id, timestamp in updates.items():
+            pipe.hsetnx(self.key, user_id, timestamp.isoformat())
+        pipe.execute()
+
+
+def create_last_seen(app):
+    if app.config['LAST_SEEN_BACKEND'] == 'redis':
+        return RedisLastSeen(app)
+    return MemoryLastSeen(app)
@@ -1,33 +1,327 @@
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta
+from math import log
+from threading import Lock
+from time import time
 from flask import current_app
+from app.instrument import timed
+
+
+class SearchBackend(object):
+    # every commit logs the ids it changed to the search_changes table, the
+    # embedded indices of other processes and index rebuilds replay it
+    # entries are kept for SEARCH_CHANGE_RETENTION seconds
+
+    prune_interval = 3600
+
+    def __init__(self, app):
+        self.app = app
+        self.retention = app.config['SEARCH_CHANGE_RETENTION']
+        self.pruned = 0
+
+    def log(self, session, actions):
+        # record the ids changed by a commit, inside its transaction
+        from app.models import search_changes
+        now = datetime.utcnow()
+        session.execute(search_changes.insert(), [
+            {'index_name': index, 'object_id': id, 'timestamp': now}
+            for op, index, id, payload in actions])
+        if time() - self.pruned > self.prune_interval:
+            self.pruned = time()
+            session.execute(search_changes.delete().where(
+                search_changes.c.timestamp < now - timedelta(seconds=self.retention)))
+
+
+class ElasticsearchBackend(SearchBackend):
+    # search through the Elasticsearch client attached to the app
+
+    # documents are sent from the background indexing pipeline
+    remote = True
+
+    def add(self, index, id, payload):
+        with timed('es'):
+            self.app.elasticsearch.index(index=index, id=id, body=payload)
+
+    def remove(self, index, id):
+        with timed('es'):
+            self.app.elasticsearch.delete(index=index, id=id)
+
+    def query(self, index, query, page, per_page):
+        with timed('es'):
+            search = self.app.elasticsearch.search(
+                index=index,
+                # use multi_match to search all fields, use * to search entire index
+                body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                      'from': (page - 1) * per_page, 'size': per_page})
+        # extract the id values from the search results
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+    def bulk(self, actions):
+        body = []
+        for op, index, id, payload in actions:
+            body.append({op: {'_index': index, '_id': id}})
+            if op == 'index':
+                body.append(payload)
+        with timed('es'):
+            response = self.app.elasticsearch.bulk(body=body)
+        if not response['errors']:
+            return []
+        retry = []
+        for action, item in zip(actions, response['items']):
+            status = item[action[0]]['status']
+            # deleting a document that was never indexed is not a failure
+            if status == 429 or status >= 500:
+                retry.append(action)
+            elif status >= 400 and not (action[0] == 'delete' and status == 404):
+                self.app.logger.error('Search indexing of %s/%s failed: %s',
+                                      action[1], action[2], item[action[0]].get('error'))
+        return retry
+
+
+class InvertedIndex(object):
+    # in-memory inverted index of one table, ranked with BM25
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self.postings = defaultdict(dict)  # term -> {id: term frequency}
+        self.terms = {}  # id -> {term: term frequency}
+        self.lengths = {}  # id -> number of terms
+        self.total_length = 0
+
+    def add(self, id, text):
+        self.remove(id)
+        counts = defaultdict(int)
+        for term in tokenize(text):
+            counts[term] += 1
+        for term, tf in counts.items():
+            self.postings[term][id] = tf
+        self.terms[id] = counts
+        self.lengths[id] = sum(counts.values())
+        self.total_length += self.lengths[id]
+
+    def remove(self, id):
+        counts = self.terms.pop(id, None)
+        if counts is None:
+            return
+        for term in counts:
+            del self.postings[term][id]
+            if not self.postings[term]:
+                del self.postings[term]
+        self.total_length -= self.lengths.pop(id)
+
+    def query(self, query):
+        # return (id, score) pairs for documents matching any query term
+        n = len(self.terms)
+        if not n:
+            return []
+        avg_length = self.total_length / n
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for id, tf in postings.items():
+                scores[id] += idf * tf * (self.k1 + 1) / (
+                    tf + self.k1 * (1 - self.b + self.b * self.lengths[id] / avg_length))
+        return sorted(scores.items(), key=lambda hit: (-hit[1], -hit[0]))
+
+
+class MemoryBackend(SearchBackend):
+    # embedded search for deployments without Elasticsearch
+    # each process keeps its own index, built from the database on first use and
+    # kept current by the commit hooks, before each query the entries other
+    # processes logged since the last one are replayed from the current rows
+    # log ids are taken before commit, so one missing from a read may belong to
+    # a transaction still in flight, it is looked for again until gap_timeout
+
+    remote = False
+
+    def __init__(self, app):
+        super(MemoryBackend, self).__init__(app)
+        self.indices = {}
+        self.gap_timeout = app.config['SEARCH_CHANGE_GAP_TIMEOUT']
+        self.position = 0  # largest log id replayed
+        self.gaps = {}  # log id -> when it was found missing
+        self.synced = None
+        self._lock = Lock()
+
+    def add(self, index, id, payload):
+        with self._lock:
+            if index in self.indices:
+                self.indices[index].add(id, _text(payload))
+
+    def remove(self, index, id):
+        with self._lock:
+            if index in self.indices:
+                self.indices[index].remove(id)
+
+    def query(self, index, query, page, per_page):
+        with self._lock:
+            hits = self._load(index).query(query)
+        start = (page - 1) * per_page
+        return [id for id, score in hits[start:start + per_page]], len(hits)
+
+    def bulk(self, actions):
+        for op, index, id, payload in actions:
+            if op == 'index':
+                self.add(index, id, payload)
+            else:
+                self.remove(index, id)
+        return []
+
+    def _load(self, index):
+        # replay the change log, then build the index from the table on first use
+        if self.synced is None or time() - self.synced > self.retention / 2:
+            # entries past the position may have been pruned meanwhile, start over
+            self._reset()
+        else:
+            self._sync()
+        self.synced = time()
+        inverted = self.indices.get(index)
+        if inverted is None:
+            inverted = self.indices[index] = InvertedIndex()
+            for id, text in _rows(_searchable_model(index)):
+                inverted.add(id, text)
+        return inverted
+
+    def _reset(self):
+        # drop the indices and take the end of the log as the position, ids
+        # missing from its last gap_timeout seconds are waited for as gaps
+        # changes committed while the tables are read are replayed again later
+        from app import db
+        from app.models import search_changes
+        changes = search_changes.c
+        now = time()
+        recent = set(db.session.execute(db.select([changes.id]).where(
+            changes.timestamp >= datetime.utcnow() - timedelta(seconds=self.gap_timeout))).scalars())
+        self.indices = {}
+        if recent:
+            self.position = max(recent)
+            self.gaps = {id: now for id in range(min(recent), self.position) if id not in recent}
+        else:
+            self.position = db.session.query(db.func.max(changes.id)).scalar() or 0
+            self.gaps = {}
+
+    def _sync(self):
+        from app import db
+        from app.models import search_changes
+        changes = search_changes.c
+        now = time()
+        self.gaps = {id: seen for id, seen in self.gaps.items() if now - seen < self.gap_timeout}
+        condition = changes.id > self.position
+        if self.gaps:
+            condition = db.or_(condition, changes.id.in_(list(self.gaps)))
+        entries = db.session.execute(db.select(
+            [changes.id, changes.index_name, changes.object_id]).where(condition)).all()
+        if not entries:
+            return
+        read = {entry[0] for entry in entries}
+        top = max(read)
+        self.gaps.update((id, now) for id in range(self.position + 1, top) if id not in read)
+        for id in read:
+            self.gaps.pop(id, None)
+        self.position = max(self.position, top)
+        changed = defaultdict(set)
+        for _, index, object_id in entries:
+            if index in self.indices:
+                changed[index].add(object_id)
+        for index, ids in changed.items():
+            # the current row is indexed, or the document dropped if it is gone
+            found = dict(_rows(_searchable_model(index), ids))
+            for id in ids:
+                if id in found:
+                    self.indices[index].add(id, found[id])
+                else:
+                    self.indices[index].remove(id)
+
+
+def tokenize(text):
+    return re.findall(r'\w+', text.lower())
+
+
+def _text(payload):
+    return ' '.join(str(value) for value in payload.values() if value)
+
+
+def _rows(model, ids=None):
+    # (id, text) of every row of a searchable model, or of the given ids
+    columns = [getattr(model, field) for field in model.__searchable__]
+    query = model.query.with_entities(model.id, *columns)
+    if ids is not None:
+        query = query.filter(model.id.in_(ids))
+    return [(row[0], ' '.join(str(value) for value in row[1:] if value)) for row in query]
+
+
+def _searchable_model(index):
+    from app import db
+    for mapper in db.Model.registry.mappers:
+        model = mapper.class_
+        if getattr(model, '__tablename__', None) == index and hasattr(model, '__searchable__'):
+            return model
+    raise KeyError(index)
+
+
+def create_search_backend(app):
+    # SEARCH_BACKEND picks 'elasticsearch' or 'memory', by default Elasticsearch
+    # is used when ELASTICSEARCH_URL is set and the embedded index otherwise
+    backend = app.config['SEARCH_BACKEND'] or \
+        ('elasticsearch' if app.config['ELASTICSEARCH_URL'] else 'memory')
+    if backend == 'elasticsearch':
+        return ElasticsearchBackend(app)
+    if backend == 'memory':
+        return MemoryBackend(app)
+    return None
+
 
 def add_to_index(index, model):
-    # check if elastic search is available
-	if not current_app.elasticsearch:
-		return
-	# create a dictionary of the fields to be indexed
-	payload = {}
-	for field in model.__searchable__:
-		payload[field] = getattr(model, field)
-	current_app.elasticsearch.index(index=index, id=model.id, body=payload)
- 
+    # check if a search backend is available
+    if not current_app.search_backend:
+        return
+    current_app.search_backend.add(index, model.id, model.search_document())
+
+
 def remove_from_index(index, model):
-    # check if elastic search is available
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return
-    # delete the index
-    current_app.elasticsearch.delete(index=index, id=model.id)
-    
+    current_app.search_backend.remove(index, model.id)
+
+
 def query_index(index, query, page, per_page):
-    # check if elastic search is available
-	if not current_app.elasticsearch:
-		return [], 0
-	# search the index
-	search = current_app.elasticsearch.search(
-		index=index,
-		# use multi_match to search all fields, use * to search entire index
-		body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-			  'from': (page - 1) * per_page, 'size': per_page})
-	# extract the id values from the search results
-	ids = [int(hit['_id']) for hit in search['hits']['hits']]
-	# return the list and the total number of results
-	return ids, search['hits']['total']['value']
\ No newline at end of file
+    # return the ids of a page of hits in rank order and the total number of hits
+    if not current_app.search_backend:
+        return [], 0
+    cache = current_app.search_cache
+    if cache is None:
+        return current_app.search_backend.query(index, query, page, per_page)
+    # the index generation is part of the key, so bumping it drops every cached page
+    key = f"{index}:{cache.generation(index)}:{' '.join(query.lower().split())}:{page}:{per_page}"
+    hit = cache.get(key)
+    if hit is not None:
+        return list(hit[0]), hit[1]
+    ids, total = current_app.search_backend.query(index, query, page, per_page)
+    cache.set(key, (ids, total))
+    return ids, total
+
+
+def invalidate_search(indices):
+    # called whenever documents in these indices change
+    if current_app.search_cache is not None:
+        for index in indices:
+            current_app.search_cache.bump(index)
+
+
+def bulk_index(actions):
+    # send a batch of (op, index, id, payload) actions in one request
+    # op is 'index' or 'delete', returns the actions that should be retried
+    if not current_app.search_backend or not actions:
+        return []
+    retry = current_app.search_backend.bulk(actions)
+    # queued changes land after the commit that bumped the generation, bump it
+    # again so results cached in between are not served until they expire
+    invalidate_search({action[1] for action in actions})
+    return retry
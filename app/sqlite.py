@@ -0,0 +1,155 @@
+import os
+import re
+import sqlite3
+from threading import Lock, get_ident
+from time import perf_counter, sleep
+try:
+    import fcntl
+except ImportError:  # windows, only the threads of one process are serialized
+    fcntl = None
+
+# statements that take SQLite's write lock
+WRITE = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b', re.IGNORECASE)
+
+
+class WriteQueue(object):
+    # lets one write transaction at a time into a database file, the threads of
+    # a process queue on a lock and the worker processes on an flock of
+    # <database>.lock, waiting here is cheaper than SQLite's busy handler, which
+    # sleeps and retries until busy_timeout
+    # a writer that waited `timeout` seconds for its turn, on the lock or the
+    # flock, goes ahead anyway and leaves it to the busy handler, a thread
+    # writing on a second connection while it holds the queue does not wait
+    # for itself
+
+    poll_interval = 0.05
+
+    def __init__(self, path, timeout):
+        self.path = path + '.lock'
+        self.timeout = timeout
+        self.writes = 0
+        self.waited = 0.0  # seconds spent queueing, for benchmarks
+        self._lock = Lock()
+        self._owner = None
+        self._depth = 0
+        self._file = None
+        self._pid = None
+
+    def acquire(self):
+        if self._owner == get_ident():
+            self._depth += 1
+            return True
+        started = perf_counter()
+        if not self._lock.acquire(timeout=self.timeout):
+            return False
+        if fcntl is not None and not self._flock(started + self.timeout):
+            self._lock.release()
+            return False
+        self._owner, self._depth = get_ident(), 1
+        self.writes += 1
+        self.waited += perf_counter() - started
+        return True
+
+    def release(self):
+        # connections may be closed by another thread than the one that wrote
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+            if fcntl is not None:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._lock.release()
+
+    def _flock(self, deadline):
+        # flock has no timeout, poll it without blocking until the deadline
+        delay = 0.001
+        while True:
+            try:
+                fcntl.flock(self._lockfile(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                remaining = deadline - perf_counter()
+                if remaining <= 0:
+                    return False
+                sleep(min(delay, remaining))
+                delay = min(delay * 2, self.poll_interval)
+
+    def _lockfile(self):
+        # a descriptor inherited through a fork would share the parent's lock
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._file = open(self.path, 'a')
+        return self._file
+
+
+class Cursor(sqlite3.Cursor):
+    # joins the write queue before the first write of a transaction
+
+    def execute(self, sql, parameters=()):
+        if WRITE.match(sql):
+            self.connection.begin_write()
+        return super(Cursor, self).execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if WRITE.match(sql):
+            self.connection.begin_write()
+        return super(Cursor, self).executemany(sql, seq_of_parameters)
+
+
+class Connection(sqlite3.Connection):
+    # sqlite3 connection that applies `pragmas` when opened and holds its place
+    # in `queue` from its first write until commit, rollback or close
+    # subclassed per engine by connection_class
+
+    pragmas = ()
+    queue = None
+
+    def __init__(self, *args, **kwargs):
+        super(Connection, self).__init__(*args, **kwargs)
+        self.writing = False
+        for name, value in self.pragmas:
+            self.execute(f'PRAGMA {name}={value}').close()
+
+    def cursor(self, factory=Cursor):
+        return super(Connection, self).cursor(factory)
+
+    def begin_write(self):
+        if self.queue is not None and not self.writing:
+            self.writing = self.queue.acquire()
+
+    def commit(self):
+        try:
+            super(Connection, self).commit()
+        finally:
+            self._end_write()
+
+    def rollback(self):
+        try:
+            super(Connection, self).rollback()
+        finally:
+            self._end_write()
+
+    def close(self):
+        try:
+            super(Connection, self).close()
+        finally:
+            self._end_write()
+
+    def _end_write(self):
+        if self.writing:
+            self.writing = False
+            self.queue.release()
+
+
+def connection_class(path, config):
+    # the sqlite3 connection factory for the database file at path, from the
+    # SQLITE_* settings
+    pragmas = [(name, value) for name, value in [
+        ('journal_mode', config['SQLITE_JOURNAL_MODE']),
+        ('synchronous', config['SQLITE_SYNCHRONOUS']),
+        ('mmap_size', config['SQLITE_MMAP_SIZE']),
+        ('cache_size', config['SQLITE_CACHE_SIZE']),
+        ('busy_timeout', config['SQLITE_BUSY_TIMEOUT']),
+    ] if value is not None]
+    queue = WriteQueue(path, config['SQLITE_BUSY_TIMEOUT'] / 1000) \
+        if config['SQLITE_SERIALIZE_WRITES'] else None
+    return type('Connection', (Connection,), {'pragmas': pragmas, 'queue': queue})
@@ -0,0 +1,19 @@
+# rq job functions, run by `rq worker <queue>` outside of any request
+from app import create_app
+from app.search import bulk_index
+from app.email import send_messages as send_mail_batch
+
+app = create_app()
+app.app_context().push()
+
+
+def index_documents(actions):
+    # raising hands the job back to rq, which retries it with backoff
+    failed = bulk_index([tuple(action) for action in actions])
+    if failed:
+        raise RuntimeError(f'Search indexing failed for {len(failed)} documents')
+
+
+def send_messages(messages):
+    # messages are dicts from app.email.message_to_dict, sent over one connection
+    send_mail_batch(messages)
@@ -0,0 +1,294 @@
+from datetime import timezone
+from flask import current_app
+from app import db
+
+
+class SQLTimeline(object):
+    # timelines stored in the timeline table, one row per (owner, post)
+    # rows are ordered by the (user_id, timestamp, post_id) index so a page is a
+    # range scan
+    # each timeline keeps its newest max_length rows, it is trimmed once it grows
+    # more than a tenth past that, so a fan-out does not pay for a trim of every reader
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self.trim_at = max_length + max(max_length // 10, 1)
+
+    def add_post(self, post_id, author_id, timestamp):
+        from app.models import followers, timeline
+        # fan the post out to the author and every follower in one statement
+        readers = db.select([followers.c.follower_id]).where(
+            followers.c.followed_id == author_id).union(
+            db.select([db.literal(author_id)])).subquery()
+        # a follow committed along with the post has already pulled it in
+        rows = db.select([readers.c[0],
+                          db.literal(post_id),
+                          db.literal(timestamp, db.DateTime)]).where(~db.exists().where(db.and_(
+                              timeline.c.user_id == readers.c[0],
+                              timeline.c.post_id == post_id)))
+        with db.engine.begin() as conn:
+            conn.execute(timeline.insert().from_select(
+                ['user_id', 'post_id', 'timestamp'], rows))
+            self._trim(conn, db.select([readers.c[0]]))
+
+    def remove_post(self, post_id, author_id):
+        from app.models import followers, timeline
+        # the post is in the timelines of the author and their followers, keyed
+        # by (user_id, post_id) so each row is found through the primary key
+        readers = db.select([followers.c.follower_id]).where(
+            followers.c.followed_id == author_id).union(
+            db.select([db.literal(author_id)]))
+        with db.engine.begin() as conn:
+            conn.execute(timeline.delete().where(db.and_(timeline.c.user_id.in_(readers),
+                                                         timeline.c.post_id == post_id)))
+
+    def follow(self, user_id, followed_id):
+        from app.models import Posts, timeline
+        rows = db.select([db.literal(user_id), Posts.id, Posts.timestamp]).where(
+            Posts.user_id == followed_id)
+        with db.engine.begin() as conn:
+            # clear first so a repeated follow cannot violate the primary key
+            conn.execute(self._by_author(timeline, user_id, followed_id))
+            conn.execute(timeline.insert().from_select(
+                ['user_id', 'post_id', 'timestamp'], rows))
+            self._trim(conn, db.select([db.literal(user_id)]))
+
+    def unfollow(self, user_id, followed_id):
+        from app.models import timeline
+        with db.engine.begin() as conn:
+            conn.execute(self._by_author(timeline, user_id, followed_id))
+
+    def page(self, user_id, limit, before=None, after=None):
+        from app.models import timeline
+        query = db.select([timeline.c.post_id]).where(timeline.c.user_id == user_id)
+        if after is not None:
+            timestamp, id = after
+            query = query.where(db.or_(
+                timeline.c.timestamp > timestamp,
+                db.and_(timeline.c.timestamp == timestamp, timeline.c.post_id > id))).order_by(
+                timeline.c.timestamp.asc(), timeline.c.post_id.asc())
+        else:
+            if before is not None:
+                timestamp, id = before
+                query = query.where(db.or_(
+                    timeline.c.timestamp < timestamp,
+                    db.and_(timeline.c.timestamp == timestamp, timeline.c.post_id < id)))
+            query = query.order_by(timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+        # through the session, so GET requests read from a replica
+        return db.session.execute(query.limit(limit)).scalars().all()
+
+    def rebuild(self, user_id):
+        from app.models import Posts, followers, timeline
+        followed = db.select([followers.c.followed_id]).where(
+            followers.c.follower_id == user_id)
+        rows = db.select([db.literal(user_id), Posts.id, Posts.timestamp]).where(
+            db.or_(Posts.user_id == user_id, Posts.user_id.in_(followed)))
+        with db.engine.begin() as conn:
+            conn.execute(timeline.delete().where(timeline.c.user_id == user_id))
+            conn.execute(timeline.insert().from_select(
+                ['user_id', 'post_id', 'timestamp'], rows))
+            self._trim(conn, db.select([db.literal(user_id)]))
+
+    def _trim(self, conn, user_ids):
+        # cut the timelines of user_ids longer than trim_at back to max_length
+        # the row at an offset is found through the index, the cut is looked up
+        # per user as MySQL cannot read the table a DELETE writes
+        from app.models import timeline
+        users = user_ids.subquery()
+        row = timeline.alias()
+        overflow = db.select([row.c.post_id]).where(row.c.user_id == users.c[0]).order_by(
+            row.c.timestamp.desc(), row.c.post_id.desc()).offset(self.trim_at).limit(1)
+        full = conn.execute(db.select([users.c[0]]).where(
+            overflow.scalar_subquery().isnot(None))).scalars().all()
+        for user_id in full:
+            timestamp, post_id = conn.execute(
+                db.select([timeline.c.timestamp, timeline.c.post_id])
+                .where(timeline.c.user_id == user_id)
+                .order_by(timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+                .offset(self.max_length - 1).limit(1)).first()
+            conn.execute(timeline.delete().where(db.and_(
+                timeline.c.user_id == user_id,
+                db.or_(timeline.c.timestamp < timestamp,
+                       db.and_(timeline.c.timestamp == timestamp,
+                               timeline.c.post_id < post_id)))))
+
+    @staticmethod
+    def _by_author(timeline, user_id, author_id):
+        from app.models import Posts
+        authored = db.select([Posts.id]).where(Posts.user_id == author_id)
+        return timeline.delete().where(db.and_(timeline.c.user_id == user_id,
+                                               timeline.c.post_id.in_(authored)))
+
+
+class RedisTimeline(object):
+    # timelines stored as one sorted set per user, scored by post timestamp
+    # each set is capped at max_length entries, older posts fall off the end
+
+    def __init__(self, redis, max_length):
+        self.redis = redis
+        self.max_length = max_length
+
+    def add_post(self, post_id, author_id, timestamp):
+        from app.models import followers
+        with db.engine.connect() as conn:
+            readers = conn.execute(db.select([followers.c.follower_id]).where(
+                followers.c.followed_id == author_id)).scalars().all()
+        score = _score(timestamp)
+        pipe = self.redis.pipeline()
+        for user_id in set(readers) | {author_id}:
+            pipe.zadd(self._key(user_id), {post_id: score})
+            pipe.zremrangebyrank(self._key(user_id), 0, -self.max_length - 1)
+        pipe.execute()
+
+    def remove_post(self, post_id, author_id):
+        # only the author and their followers received the post
+        from app.models import followers
+        with db.engine.connect() as conn:
+            readers = conn.execute(db.select([followers.c.follower_id]).where(
+                followers.c.followed_id == author_id)).scalars().all()
+        pipe = self.redis.pipeline()
+        for user_id in set(readers) | {author_id}:
+            pipe.zrem(self._key(user_id), post_id)
+        pipe.execute()
+
+    def follow(self, user_id, followed_id):
+        from app.models import Posts
+        with db.engine.connect() as conn:
+            rows = conn.execute(
+                db.select([Posts.id, Posts.timestamp])
+                .where(Posts.user_id == followed_id)
+                .order_by(Posts.timestamp.desc()).limit(self.max_length)).all()
+        mapping = {post_id: _score(timestamp) for post_id, timestamp in rows}
+        if mapping:
+            pipe = self.redis.pipeline()
+            pipe.zadd(self._key(user_id), mapping)
+            pipe.zremrangebyrank(self._key(user_id), 0, -self.max_length - 1)
+            pipe.execute()
+
+    def unfollow(self, user_id, followed_id):
+        from app.models import Posts
+        with db.engine.connect() as conn:
+            ids = conn.execute(db.select([Posts.id]).where(
+                Posts.user_id == followed_id)).scalars().all()
+        if ids:
+            self.redis.zrem(self._key(user_id), *ids)
+
+    def page(self, user_id, limit, before=None, after=None):
+        # seek by score from the cursor's timestamp, then order posts that share
+        # a timestamp by id here, the set orders them as strings
+        key = self._key(user_id)
+        newest_first = after is None
+        cursor = before if newest_first else after
+        bound = '+inf' if cursor is None else _score(cursor[0])
+        ties = 0 if cursor is None else self.redis.zcount(key, bound, bound)
+        if newest_first:
+            rows = self.redis.zrevrangebyscore(key, bound, '-inf', 0, limit + ties, withscores=True)
+        else:
+            rows = self.redis.zrangebyscore(key, bound, '+inf', 0, limit + ties, withscores=True)
+        if rows and len(rows) == limit + ties:
+            # the window may end part way through the posts of one timestamp
+            last = rows[-1][1]
+            rows += self.redis.zrangebyscore(key, last, last, withscores=True)
+        entries = sorted({(score, int(post_id)) for post_id, score in rows}, reverse=newest_first)
+        if cursor is not None:
+            position = (bound, cursor[1])
+            entries = [entry for entry in entries
+                       if (entry < position if newest_first else entry > position)]
+        return [post_id for score, post_id in entries[:limit]]
+
+    def rebuild(self, user_id):
+        from app.models import followers
+        with db.engine.connect() as conn:
+            followed = conn.execute(db.select([followers.c.followed_id]).where(
+                followers.c.follower_id == user_id)).scalars().all()
+        self.redis.delete(self._key(user_id))
+        for author_id in set(followed) | {user_id}:
+            self.follow(user_id, author_id)
+
+    @staticmethod
+    def _key(user_id):
+        return f'timeline:{user_id}'
+
+
+def _score(timestamp):
+    # timestamps are naive utc datetimes
+    return timestamp.replace(tzinfo=timezone.utc).timestamp()
+
+
+def create_timeline(app):
+    # pick the timeline store configured for the app, None disables timelines
+    backend = app.config['TIMELINE_BACKEND']
+    if backend == 'sql':
+        return SQLTimeline(app.config['TIMELINE_MAX_LENGTH'])
+    if backend == 'redis':
+        return RedisTimeline(app.redis, app.config['TIMELINE_MAX_LENGTH'])
+    return None
+
+
+def _pending(session):
+    # timeline changes queued on the session until it commits
+    return session.info.setdefault('timeline', [])
+
+
+def timeline_follow(user_id, followed_id):
+    if current_app.timeline:
+        _pending(db.session).append(('follow', user_id, followed_id))
+
+
+def timeline_unfollow(user_id, followed_id):
+    if current_app.timeline:
+        _pending(db.session).append(('unfollow', user_id, followed_id))
+
+
+def query_timeline(user, per_page, before=None, after=None):
+    # return a page of post ids from the user's timeline, newest first, and
+    # whether newer and older pages exist
+    # seeks past a (timestamp, post id) cursor like paginate_cursor, so deep
+    # pages cost the same as the first and nothing is counted
+    store = current_app.timeline
+    if not store:
+        return [], False, False
+    if after is not None:
+        ids = store.page(user.id, per_page + 1, after=after)
+        if len(ids) > per_page:
+            return list(reversed(ids[:per_page])), True, True
+        # reached the newest posts, serve the first page so it is always full
+        before = None
+    ids = store.page(user.id, per_page + 1, before=before)
+    return ids[:per_page], before is not None, len(ids) > per_page
+
+
+def after_flush(session, flush_context):
+    # queue new and deleted posts alongside any follow changes, ids and
+    # timestamps are final once the rows have been flushed
+    if not current_app.timeline:
+        return
+    from app.models import Posts
+    pending = _pending(session)
+    for obj in session.new:
+        if isinstance(obj, Posts):
+            pending.append(('add', obj.id, obj.user_id, obj.timestamp))
+    for obj in session.deleted:
+        if isinstance(obj, Posts):
+            pending.append(('remove', obj.id, obj.user_id))
+
+
+def after_commit(session):
+    # apply the queued changes once the transaction is durable
+    pending = session.info.pop('timeline', None)
+    if not pending or not current_app.timeline:
+        return
+    store = current_app.timeline
+    for op in pending:
+        if op[0] == 'add':
+            store.add_post(*op[1:])
+        elif op[0] == 'remove':
+            store.remove_post(*op[1:])
+        elif op[0] == 'follow':
+            store.follow(*op[1:])
+        elif op[0] == 'unfollow':
+            store.unfollow(*op[1:])
+
+
+def after_rollback(session, previous_transaction):
+    session.info.pop('timeline', None)
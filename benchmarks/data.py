@@ -0,0 +1,241 @@
+# synthetic data and shared helpers for the benchmark suite
+#
+# generate() builds users, posts and a power-law follow graph through the models,
+# so the session hooks (counters, search indexing) run as they do in the app
+# benchmarks.micro and benchmarks.throughput build their data with it, and it
+# can also write a database to explore by hand
+# every benchmark makes its app with benchmark_app, times with measure and
+# reports through write_results
+#
+#   python -m benchmarks.data --users 1000 --posts 20000 --database /tmp/blog.db
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from statistics import mean, median
+from time import perf_counter
+from app import create_app, db
+from app.models import User, Posts
+from app.search import InvertedIndex
+from config import Config
+
+
+class BenchmarkConfig(Config):
+    TESTING = True  # no log file or error mail handlers
+    WTF_CSRF_ENABLED = False
+    CACHE_BACKEND = None
+    PAGE_CACHE_BACKEND = None
+    FRAGMENT_CACHE_BACKEND = None
+    TIMELINE_BACKEND = None
+    # searches go through the Elasticsearch backend to a LocalElasticsearch
+    SEARCH_BACKEND = 'elasticsearch'
+    SEARCH_INDEX_MODE = 'sync'
+    PASSWORD_HASH_WORKERS = 0
+    MAIL_MODE = 'sync'
+    MAIL_SUPPRESS_SEND = True
+
+
+class LocalElasticsearch(object):
+    # in-process stand-in for the Elasticsearch client, the slice of the api
+    # ElasticsearchBackend uses, ranked by the embedded BM25 index
+    # bodies are round tripped through json to account for the serialization
+    # a real client does, not for the network
+
+    def __init__(self):
+        self.indices = {}
+
+    def index(self, index, id, body):
+        body = json.loads(json.dumps(body))
+        self._index(index).add(int(id), ' '.join(str(v) for v in body.values() if v))
+
+    def delete(self, index, id):
+        self._index(index).remove(int(id))
+
+    def search(self, index, body):
+        body = json.loads(json.dumps(body))
+        hits = self._index(index).query(body['query']['multi_match']['query'])
+        start = body['from']
+        return json.loads(json.dumps({
+            'hits': {'total': {'value': len(hits)},
+                     'hits': [{'_id': str(id), '_score': score}
+                              for id, score in hits[start:start + body['size']]]}}))
+
+    def bulk(self, body):
+        body = json.loads(json.dumps(body))
+        items = []
+        lines = iter(body)
+        for line in lines:
+            op, meta = list(line.items())[0]
+            if op == 'index':
+                self.index(meta['_index'], meta['_id'], next(lines))
+            else:
+                self.delete(meta['_index'], meta['_id'])
+            items.append({op: {'status': 200}})
+        return {'errors': False, 'items': items}
+
+    def _index(self, index):
+        return self.indices.setdefault(index, InvertedIndex())
+
+
+def create_benchmark_app(path, search=True, **config):
+    # an app on the SQLite file at path with a LocalElasticsearch, config
+    # overrides BenchmarkConfig
+    # without `search` the app has no search backend, so commits skip indexing
+    # and the change log, for benchmarks that measure something else
+    settings = dict(config, SQLALCHEMY_DATABASE_URI='sqlite:///' + path)
+    app = create_app(type('Config', (BenchmarkConfig,), settings))
+    app.elasticsearch = LocalElasticsearch()
+    if not search:
+        app.search_backend = app.indexer = None
+    return app, path
+
+
+@contextmanager
+def benchmark_app(search=True, **config):
+    # create_benchmark_app on a scratch directory, removed on exit with the
+    # database and any copies, -wal, -shm or .lock files made beside it
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        yield create_benchmark_app(os.path.join(directory, 'benchmark.db'), search, **config)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def vocabulary(rng, size=2000):
+    # made up words, drawn with Zipf frequencies so common and rare search
+    # terms both exist
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = sorted({''.join(rng.choice(letters) for _ in range(rng.randint(3, 9)))
+                    for _ in range(size)})
+    rng.shuffle(words)
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    return words, weights
+
+
+def generate(users=1000, posts=20000, follows=50, alpha=1.2, seed=42, chunk_size=500):
+    # add `users` users, `posts` posts and about `follows` follows per user, in
+    # the current app context, and return the words posts are made of
+    # a few users have most of the followers: user at popularity rank r is
+    # followed with weight 1 / r ** alpha
+    rng = random.Random(seed)
+    words, weights = vocabulary(rng)
+    # one hash shared by every user, hashing thousands is not the point
+    user = User()
+    user.set_password('password')
+    password_hash = user.password_hash
+    now = datetime.utcnow()
+
+    ids = []
+    for start in range(0, users, chunk_size):
+        batch = []
+        for n in range(start, min(start + chunk_size, users)):
+            user = User(first_name=f'user{n}', last_name='bench')
+            user.set_email(f'user{n}@example.com')
+            user.password_hash = password_hash
+            batch.append(user)
+        db.session.add_all(batch)
+        db.session.commit()
+        ids.extend(user.id for user in batch)
+
+    authors = rng.choices(ids, k=posts)
+    for start in range(0, posts, chunk_size):
+        db.session.add_all([
+            Posts(body=' '.join(rng.choices(words, weights, k=rng.randint(3, 20)))[:140],
+                  user_id=author, timestamp=now - timedelta(seconds=rng.randrange(90 * 86400)))
+            for author in authors[start:start + chunk_size]])
+        db.session.commit()
+
+    ranked = ids[:]
+    rng.shuffle(ranked)
+    popularity = [1 / (rank ** alpha) for rank in range(1, len(ranked) + 1)]
+    for n, id in enumerate(ids):
+        # out degrees are skewed too, most users follow a few, some follow many
+        degree = min(int(rng.paretovariate(1.5) * follows / 3), len(ids) - 1)
+        targets = set(rng.choices(ranked, popularity, k=degree)) - {id}
+        if targets:
+            db.session.get(User, id).follow_many(targets)
+        if n % chunk_size == chunk_size - 1:
+            db.session.commit()
+    db.session.commit()
+    return words
+
+
+def measure(fn, samples, warmup=3):
+    # call fn(sample) for each sample, return latency statistics in milliseconds
+    for sample in samples[:warmup]:
+        fn(sample)
+    timings = []
+    for sample in samples:
+        start = perf_counter()
+        fn(sample)
+        timings.append((perf_counter() - start) * 1000)
+    timings.sort()
+    return {'samples': len(timings), 'mean_ms': mean(timings), 'median_ms': median(timings),
+            'p95_ms': timings[max(int(len(timings) * 0.95) - 1, 0)], 'max_ms': timings[-1],
+            'per_second': 1000 / max(mean(timings), 1e-9)}
+
+
+def environment():
+    # what a result was measured on, to tell apart runs on different commits
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'time': datetime.utcnow().isoformat() + 'Z'}
+
+
+def write_results(name, params, results, output=None):
+    # one JSON document per run, to stdout or a file
+    document = {'benchmark': name, 'environment': environment(), 'params': params,
+                'results': results}
+    text = json.dumps(document, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return document
+
+
+def add_data_arguments(parser):
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=50, help='average follows per user')
+    parser.add_argument('--alpha', type=float, default=1.2,
+                        help='exponent of the follower power law')
+    parser.add_argument('--seed', type=int, default=42)
+
+
+def generate_from_args(args):
+    start = perf_counter()
+    words = generate(args.users, args.posts, args.follows, args.alpha, args.seed)
+    edges = db.session.execute('SELECT count(*) FROM followers').scalar()
+    print(f'{args.users} users, {args.posts} posts, {edges} follows in '
+          f'{perf_counter() - start:.1f}s', file=sys.stderr)
+    return words, edges
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a database of synthetic users and posts.')
+    add_data_arguments(parser)
+    parser.add_argument('--database', required=True, help='SQLite file to create')
+    args = parser.parse_args()
+
+    app, path = create_benchmark_app(os.path.abspath(args.database))
+    with app.app_context():
+        db.create_all()
+        generate_from_args(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# benchmark of the followers table before and after the composite primary key
+#
+# builds a synthetic graph in a scratch SQLite database, times the timeline and
+# profile queries against the original keyless followers table, applies the
+# same steps as migration c4f1a7e9d2b6 and times them again, and prints both
+# runs and the speedups as JSON
+#
+#   python -m benchmarks.followers --users 10000 --edges 1000000
+import argparse
+import random
+import sys
+from time import perf_counter
+from datetime import datetime, timedelta
+from app import db
+from app.models import User, Posts, followers
+from benchmarks.data import benchmark_app, measure, write_results
+
+
+def populate(users, edges, posts_per_user, duplicates):
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    db.session.execute(User.__table__.insert(), [
+        {'id': id, 'email': f'user{id}@example.com', 'first_name': f'user{id}'}
+        for id in range(1, users + 1)])
+    db.session.execute(Posts.__table__.insert(), [
+        {'body': f'post {n} from user{id}', 'user_id': id,
+         'timestamp': now - timedelta(minutes=rng.randrange(100000))}
+        for id in range(1, users + 1) for n in range(posts_per_user)])
+    # popularity is skewed so some profiles have many followers, like a real graph
+    pairs = set()
+    while len(pairs) < edges:
+        follower = rng.randint(1, users)
+        followed = int(rng.paretovariate(0.5))
+        if followed > users:
+            followed = rng.randint(1, users)
+        if follower != followed:
+            pairs.add((follower, followed))
+    pairs = list(pairs)
+    # the keyless table let the same follow be stored more than once
+    rows = pairs + rng.sample(pairs, min(duplicates, len(pairs)))
+    db.session.execute(followers.insert(), [
+        {'follower_id': a, 'followed_id': b} for a, b in rows])
+    db.session.commit()
+    return len(rows)
+
+
+def use_legacy_table():
+    # recreate followers as migration dc2ee4208976 left it
+    db.session.execute('DROP TABLE followers')
+    db.session.execute('CREATE TABLE followers (follower_id INTEGER, followed_id INTEGER, '
+                       'FOREIGN KEY(follower_id) REFERENCES user (id), '
+                       'FOREIGN KEY(followed_id) REFERENCES user (id))')
+    db.session.commit()
+
+
+def migrate_table():
+    # same steps as migration c4f1a7e9d2b6
+    db.session.execute('ALTER TABLE followers RENAME TO followers_old')
+    db.session.commit()
+    followers.create(db.engine)
+    db.session.execute('INSERT INTO followers (follower_id, followed_id) '
+                       'SELECT DISTINCT follower_id, followed_id FROM followers_old '
+                       'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    db.session.execute('DROP TABLE followers_old')
+    db.session.commit()
+    db.session.execute('ANALYZE')
+
+
+def rolled_back(fn):
+    # end the read transaction after every sample, as a request would
+    def run(arg):
+        try:
+            fn(arg)
+        finally:
+            db.session.rollback()
+    return run
+
+
+def run_queries(users, samples, per_page):
+    rng = random.Random(7)
+    ids = [rng.randint(1, users) for _ in range(samples)]
+    # the most followed users are the slow profiles
+    popular = list(range(1, samples + 1))
+    loaded = {id: db.session.get(User, id) for id in set(ids + popular)}
+    pairs = [(loaded[a], loaded[b]) for a, b in zip(ids, popular)]
+    return {
+        'timeline page': measure(
+            rolled_back(lambda id: loaded[id].followed_posts().limit(per_page).all()), ids),
+        'profile followers': measure(
+            rolled_back(lambda id: loaded[id].followers.count()), popular),
+        'profile following': measure(rolled_back(lambda id: loaded[id].followed.count()), ids),
+        'is_following': measure(
+            rolled_back(lambda pair: pair[0].is_following(pair[1])), pairs),
+    }
+
+
+def speedups(before, after):
+    # median before over median after, per query
+    return {name: before[name]['median_ms'] / max(after[name]['median_ms'], 1e-6)
+            for name in before}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time timeline and profile queries before and after the followers keys.')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--edges', type=int, default=1000000)
+    parser.add_argument('--posts-per-user', type=int, default=5)
+    parser.add_argument('--duplicates', type=int, default=10000,
+                        help='duplicate follow rows added to the legacy table')
+    parser.add_argument('--samples', type=int, default=50)
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    with benchmark_app(search=False) as (app, _), app.app_context():
+        db.create_all()
+        use_legacy_table()
+        start = perf_counter()
+        rows = populate(args.users, args.edges, args.posts_per_user, args.duplicates)
+        print(f'{args.users} users, {rows} follow rows in {perf_counter() - start:.1f}s',
+              file=sys.stderr)
+        per_page = app.config['POSTS_PER_PAGE']
+        before = run_queries(args.users, args.samples, per_page)
+
+        start = perf_counter()
+        migrate_table()
+        migration_seconds = perf_counter() - start
+        edges = db.session.execute('SELECT count(*) FROM followers').scalar()
+        after = run_queries(args.users, args.samples, per_page)
+    write_results('followers', dict(vars(args), rows=rows, edges=edges),
+                  {'before': before, 'after': after, 'speedup': speedups(before, after),
+                   'migration_seconds': migration_seconds}, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# micro-benchmarks of the hot paths behind the blog pages
+#
+# times followed_posts, is_following, Posts.search (through the Elasticsearch
+# backend against benchmarks.data.LocalElasticsearch) and template rendering on
+# synthetic data, and prints the results as JSON to compare across commits
+#
+#   python -m benchmarks.micro --users 1000 --posts 20000 --output micro.json
+import argparse
+import random
+from flask import render_template
+from flask_sqlalchemy import Pagination
+from app import db
+from app.fragments import render_posts
+from app.models import User, Posts
+from benchmarks.data import benchmark_app, add_data_arguments, generate_from_args, \
+    measure, write_results
+
+
+def run(app, words, samples, seed):
+    rng = random.Random(seed)
+    per_page = app.config['POSTS_PER_PAGE']
+    count = db.session.query(db.func.max(User.id)).scalar()
+    users = [db.session.get(User, rng.randint(1, count)) for _ in range(samples)]
+    # the most followed users have the longest follower lists
+    popular = [id for id, in db.session.query(User.id).order_by(
+        User.followers_count.desc()).limit(samples)]
+    pairs = [(user, db.session.get(User, id)) for user, id in zip(users, popular)]
+    # common words match many posts, rare ones few
+    terms = [' '.join(rng.sample(words[:50], 1) + rng.sample(words, 1)) for _ in range(samples)]
+    page = Posts.listing().order_by(Posts.timestamp.desc()).limit(per_page).all()
+    listing = Pagination(None, 1, per_page, per_page, page)
+
+    def blog_page(_):
+        with app.test_request_context('/explore'):
+            render_template('main/blog.html', posts=listing, template='main.explore',
+                            first_url='/explore?page=1', last_url='/explore?page=1',
+                            next_url=None, prev_url=None)
+
+    def post_cards(_):
+        with app.test_request_context('/explore'):
+            render_posts(page)
+
+    results = {
+        'followed_posts': measure(
+            lambda user: user.followed_posts().limit(per_page).all(), users),
+        'followed_posts_count': measure(lambda user: user.followed_posts().count(), users),
+        'is_following': measure(lambda pair: pair[0].is_following(pair[1]), pairs),
+        'search': measure(lambda q: Posts.search(q, 1, per_page), terms),
+        'render_blog_page': measure(blog_page, range(samples)),
+        'render_post_cards': measure(post_cards, range(samples)),
+    }
+    db.session.rollback()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time model queries, search and rendering.')
+    add_data_arguments(parser)
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    with benchmark_app() as (app, _), app.app_context():
+        db.create_all()
+        words, edges = generate_from_args(args)
+        results = run(app, words, args.samples, args.seed)
+    write_results('micro', dict(vars(args), edges=edges), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
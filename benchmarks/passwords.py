@@ -0,0 +1,65 @@
+# logins per second the password hasher sustains, per pool size and core
+#
+# checks one stored hash over and over from a pool of request threads, as a
+# login storm would, for each number of hashing processes up to the core count,
+# and prints the rates as JSON
+#
+#   python -m benchmarks.passwords --iterations 260000 --seconds 5
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from app.passwords import PasswordHasher
+from benchmarks.data import BenchmarkConfig, benchmark_app, write_results
+
+
+def logins_per_second(app, workers, seconds):
+    # a rate under concurrency rather than the latency of one call, so not
+    # benchmarks.data.measure
+    app.config['PASSWORD_HASH_WORKERS'] = workers
+    hasher = PasswordHasher(app)
+    pwhash = hasher.hash('correct horse battery staple')
+    hasher.check(pwhash, 'warm up the pool')
+    deadline = perf_counter() + seconds
+
+    def logins():
+        count = 0
+        while perf_counter() < deadline:
+            hasher.check(pwhash, 'correct horse battery staple')
+            count += 1
+        return count
+
+    # twice as many request threads as hashing processes keeps the pool busy
+    threads = max(workers, 1) * 2 if workers else 1
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        total = sum(executor.map(lambda _: logins(), range(threads)))
+    elapsed = perf_counter() - started
+    hasher.close()
+    return total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure password checks per second for each hashing pool size.')
+    parser.add_argument('--iterations', type=int, default=BenchmarkConfig.PASSWORD_HASH_ITERATIONS)
+    parser.add_argument('--algorithm', default=BenchmarkConfig.PASSWORD_HASH_ALGORITHM)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    with benchmark_app(search=False, PASSWORD_HASH_ITERATIONS=args.iterations,
+                       PASSWORD_HASH_ALGORITHM=args.algorithm,
+                       PASSWORD_HASH_MAX_PENDING=1024) as (app, _), app.app_context():
+        rate = logins_per_second(app, 0, args.seconds)
+        results['inline'] = {'logins_per_second': rate, 'per_core': rate}
+        for workers in range(1, args.max_workers + 1):
+            rate = logins_per_second(app, workers, args.seconds)
+            results[str(workers)] = {'logins_per_second': rate, 'per_core': rate / workers}
+    write_results('passwords', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# concurrent readers and writers on one SQLite file, as gunicorn workers would be
+#
+# runs reader and writer processes against a copy of the same synthetic database
+# for each engine setup: the plain rollback journal, WAL with the pragmas of
+# app/sqlite.py, and WAL with the write queue, and prints throughput, latencies
+# and "database is locked" errors as JSON
+#
+#   python -m benchmarks.sqlite --readers 4 --writers 4 --seconds 10
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+from statistics import median
+from time import perf_counter
+from sqlalchemy.exc import OperationalError
+from app import db
+from app.models import User, Posts
+from benchmarks.data import create_benchmark_app, benchmark_app, add_data_arguments, \
+    generate_from_args, write_results
+
+SETUPS = {
+    'rollback_journal': {'SQLITE_PROFILE': False},
+    'wal': {'SQLITE_PROFILE': True, 'SQLITE_SERIALIZE_WRITES': False},
+    'wal_write_queue': {'SQLITE_PROFILE': True, 'SQLITE_SERIALIZE_WRITES': True},
+}
+
+
+def worker(role, path, setup, seconds, users, seed, results):
+    rng = random.Random(seed)
+    app, _ = create_benchmark_app(path, search=False, **SETUPS[setup])
+    timings, errors = [], 0
+    with app.app_context():
+        per_page = app.config['POSTS_PER_PAGE']
+        deadline = perf_counter() + seconds
+        while perf_counter() < deadline:
+            start = perf_counter()
+            try:
+                if role == 'reader':
+                    Posts.listing().order_by(Posts.timestamp.desc()).limit(per_page).all()
+                    db.session.get(User, rng.randint(1, users)).followed_posts() \
+                        .limit(per_page).all()
+                else:
+                    # a new post, then the kind of small update last_seen makes
+                    db.session.add(Posts(body='benchmark post', user_id=rng.randint(1, users)))
+                    db.session.commit()
+                    user = db.session.get(User, rng.randint(1, users))
+                    user.first_name = f'user{rng.randint(1, users)}'
+                    db.session.commit()
+                timings.append((perf_counter() - start) * 1000)
+            except OperationalError:
+                errors += 1
+            finally:
+                db.session.rollback()
+                db.session.expunge_all()
+    results.put((role, timings, errors))
+
+
+def run(path, setup, args, users):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(role, path, setup, args.seconds, users,
+                                                      args.seed + n, results))
+                 for n, role in enumerate(['reader'] * args.readers + ['writer'] * args.writers)]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    summary = {}
+    for role in ('reader', 'writer'):
+        timings = sorted(t for r, values, _ in collected if r == role for t in values)
+        errors = sum(e for r, _, e in collected if r == role)
+        summary[role + 's'] = {
+            'operations': len(timings), 'per_second': len(timings) / args.seconds,
+            'locked_errors': errors,
+            'median_ms': median(timings) if timings else None,
+            'p95_ms': timings[max(int(len(timings) * 0.95) - 1, 0)] if timings else None,
+            'max_ms': timings[-1] if timings else None}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure concurrent SQLite readers and writers per engine setup.')
+    add_data_arguments(parser)
+    parser.set_defaults(users=200, posts=2000, follows=20)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--setup', action='append', choices=list(SETUPS),
+                        help='engine setups to compare, all by default')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    # the data is made once in rollback journal mode and copied for each setup
+    with benchmark_app(search=False, SQLITE_PROFILE=False) as (app, base):
+        with app.app_context():
+            db.create_all()
+            words, edges = generate_from_args(args)
+            users = User.query.count()
+            db.session.remove()
+            db.engine.dispose()
+        results = {}
+        for setup in args.setup or list(SETUPS):
+            path = f'{base}.{setup}'
+            shutil.copy(base, path)
+            results[setup] = run(path, setup, args, users)
+            # the scratch directory goes on exit, free the space of each copy now
+            for suffix in ('', '-wal', '-shm', '.lock'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+    write_results('sqlite', dict(vars(args), edges=edges), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
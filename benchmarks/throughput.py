@@ -0,0 +1,106 @@
+# end to end throughput of the app through the WSGI test client
+#
+# builds synthetic data, then replays a mix of page requests from logged in and
+# anonymous visitors against create_app for a fixed time, from one or more
+# threads, and prints requests per second and latencies per page as JSON
+# there is no network or web server in the way, so this measures the app alone
+#
+#   python -m benchmarks.throughput --seconds 10 --threads 4 --output throughput.json
+import argparse
+import random
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from statistics import mean, median
+from time import perf_counter
+from app import db
+from app.models import User
+from benchmarks.data import benchmark_app, add_data_arguments, generate_from_args, \
+    write_results
+
+# (name, weight, logged in, url for a user id and a search term)
+MIX = [
+    ('index', 10, False, lambda id, term: '/index'),
+    ('explore', 20, False, lambda id, term: '/explore'),
+    ('explore_page', 5, False, lambda id, term: '/explore?page=3'),
+    ('blog', 30, True, lambda id, term: '/blog'),
+    ('user', 20, True, lambda id, term: f'/user/user{id - 1}@example.com'),
+    ('search', 15, True, lambda id, term: f'/search?q={term}'),
+]
+
+
+def visitor(app, users, words, seconds, seed):
+    # one thread of requests, returns {page: [latency in ms]} and failures
+    rng = random.Random(seed)
+    user_id = rng.randint(1, users)
+    member = app.test_client()
+    with member.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+    anonymous = app.test_client()
+    names, weights = zip(*[(page[0], page[1]) for page in MIX])
+    pages = {page[0]: page for page in MIX}
+    timings = defaultdict(list)
+    failures = defaultdict(int)
+    deadline = perf_counter() + seconds
+    while perf_counter() < deadline:
+        name, weight, logged_in, url = pages[rng.choices(names, weights)[0]]
+        client = member if logged_in else anonymous
+        start = perf_counter()
+        response = client.get(url(rng.randint(1, users), rng.choice(words[:200])))
+        timings[name].append((perf_counter() - start) * 1000)
+        if response.status_code != 200:
+            failures[name] += 1
+    return timings, failures
+
+
+def run(app, users, words, seconds, threads, seed):
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        runs = list(executor.map(lambda n: visitor(app, users, words, seconds, seed + n),
+                                 range(threads)))
+    elapsed = perf_counter() - started
+    timings, failures = defaultdict(list), defaultdict(int)
+    for run_timings, run_failures in runs:
+        for name, values in run_timings.items():
+            timings[name].extend(values)
+        for name, count in run_failures.items():
+            failures[name] += count
+    total = sum(len(values) for values in timings.values())
+    results = {'requests': total, 'seconds': elapsed, 'per_second': total / elapsed,
+               'failures': sum(failures.values()), 'pages': {}}
+    for name, values in sorted(timings.items()):
+        values.sort()
+        results['pages'][name] = {
+            'requests': len(values), 'failures': failures[name],
+            'per_second': len(values) / elapsed, 'mean_ms': mean(values),
+            'median_ms': median(values), 'p95_ms': values[max(int(len(values) * 0.95) - 1, 0)],
+            'max_ms': values[-1]}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure requests per second through WSGI.')
+    add_data_arguments(parser)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--cache', default=None, choices=['memory'],
+                        help='run with the in-process caches enabled')
+    parser.add_argument('--timeline', default=None, choices=['sql'],
+                        help='serve /blog from the materialized timeline')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    with benchmark_app(CACHE_BACKEND=args.cache, PAGE_CACHE_BACKEND=args.cache,
+                       FRAGMENT_CACHE_BACKEND=args.cache,
+                       TIMELINE_BACKEND=args.timeline) as (app, _):
+        with app.app_context():
+            db.create_all()
+            words, edges = generate_from_args(args)
+            # the session hooks kept the timelines current while generating
+            users = User.query.count()
+            db.session.remove()
+        results = run(app, users, words, args.seconds, args.threads, args.seed)
+    write_results('throughput', dict(vars(args), edges=edges), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
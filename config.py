@@ -7,10 +7,44 @@ class Config(object):
     # SECRET_KEY = secrets.token_urlsafe(64)
     SECRET_KEY = os.getenv('SECRET_KEY') or 'difficult-to-guess-string'
     POSTS_PER_PAGE = 3
+    # json api under /api, pages default to API_POSTS_PER_PAGE posts
+    API_POSTS_PER_PAGE = 20
+    API_MAX_PER_PAGE = 100
+    API_MAX_BULK = 100  # ids per bulk users call
+    API_TOKEN_EXPIRES = 3600
+    API_GZIP_MIN_SIZE = 500  # smaller responses are not worth compressing
+    API_GZIP_LEVEL = 6
+    # posts read per query by the streaming exports
+    EXPORT_CHUNK_SIZE = 1000
+    # 'cursor' pages listings by (timestamp, id) tokens, 'offset' by page number
+    PAGINATION_MODE = os.getenv('PAGINATION_MODE') or 'cursor'
     
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQL_ALCHEMY_TRACKMODIFICATIONS = False
+    # connection pool of each engine, except SQLite which keeps its own pools
+    DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE') or 10)
+    DATABASE_MAX_OVERFLOW = int(os.getenv('DATABASE_MAX_OVERFLOW') or 20)
+    DATABASE_POOL_TIMEOUT = 30
+    DATABASE_POOL_RECYCLE = 1800
+    DATABASE_POOL_PRE_PING = True
+    # comma separated read replica urls, GET requests read from one of them
+    # unless the client committed a change in the last sticky seconds
+    DATABASE_REPLICA_URLS = [url for url in (os.getenv('DATABASE_REPLICA_URLS') or '').split(',')
+                             if url]
+    DATABASE_REPLICA_STICKY_SECONDS = 5
+    # api clients that wrote recently, kept in Redis when REDIS_URL is set and
+    # otherwise per process, where another worker may still read from a replica
+    DATABASE_REPLICA_STICKY_CLIENTS = 10000
+    # SQLite database files are opened in WAL mode with these pragmas, and
+    # their writers take turns through a write queue, see app/sqlite.py
+    SQLITE_PROFILE = True
+    SQLITE_JOURNAL_MODE = 'wal'
+    SQLITE_SYNCHRONOUS = 'normal'
+    SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+    SQLITE_CACHE_SIZE = -64000  # negative sizes are in KiB
+    SQLITE_BUSY_TIMEOUT = 5000  # milliseconds
+    SQLITE_SERIALIZE_WRITES = True
 
     MAIL_SERVER = os.getenv('MAIL_SERVER')
     MAIL_PORT = int(os.getenv('MAIL_PORT'))
@@ -19,5 +53,104 @@ class Config(object):
     MAIL_DEFAULT_SENDER = os.getenv('MAIL_DEFAULT_SENDER')
     MAIL_USERNAME = os.getenv('MAIL_USERNAME')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
+    # passwords are hashed with pbkdf2 on a pool of PASSWORD_HASH_WORKERS processes
+    # per app worker (0 hashes inline), stored hashes made with other parameters
+    # are upgraded at login, the result must fit User.password_hash (128 chars)
+    PASSWORD_HASH_ALGORITHM = os.getenv('PASSWORD_HASH_ALGORITHM') or 'sha256'
+    PASSWORD_HASH_ITERATIONS = int(os.getenv('PASSWORD_HASH_ITERATIONS') or 260000)
+    PASSWORD_HASH_SALT_LENGTH = 16
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_MAX_PENDING = 32
+    PASSWORD_HASH_TIMEOUT = 5
+    # how outgoing mail is sent: 'sync' within the request, 'thread' from a pool
+    # of workers keeping their SMTP connections open, 'rq' through an rq queue
+    MAIL_MODE = os.getenv('MAIL_MODE') or 'thread'
+    MAIL_WORKERS = 2
+    MAIL_QUEUE_SIZE = 1000
+    MAIL_BATCH_SIZE = 50
+    MAIL_IDLE_TIMEOUT = 30
+    MAIL_MAX_RETRIES = 3
+    MAIL_RETRY_BACKOFF = 1.0
+    MAIL_QUEUE = 'blog-mail'
+    # site address used for links in emails rendered outside a request,
+    # e.g. 'https://blog.example.com/', by default the address of the request
+    # that sent the email, or SERVER_NAME for emails sent from the command line
+    MAIL_BASE_URL = os.getenv('MAIL_BASE_URL')
     ADMINS = [''] # enter email 'your-email@example.com'
-    ELASTICSEARCH_URL = os.getenv('ELASTICSEARCH_URL')
\ No newline at end of file
+    ELASTICSEARCH_URL = os.getenv('ELASTICSEARCH_URL')
+    # 'elasticsearch' or 'memory' (embedded index), defaults to elasticsearch
+    # when ELASTICSEARCH_URL is set
+    SEARCH_BACKEND = os.getenv('SEARCH_BACKEND')
+    # commits log the ids they change to the search_changes table for the
+    # embedded indices of other processes and for index rebuilds, entries are
+    # kept for SEARCH_CHANGE_RETENTION seconds, an id missing from the log is
+    # looked for again during SEARCH_CHANGE_GAP_TIMEOUT, in case its commit was
+    # late, and rebuilds replay that much log from before they started
+    SEARCH_CHANGE_RETENTION = 86400
+    SEARCH_CHANGE_GAP_TIMEOUT = 60
+    SEARCH_CACHE_SIZE = 1024
+    SEARCH_CACHE_TTL = 60
+    REDIS_URL = os.getenv('REDIS_URL')
+    # where caches live: 'memory' (per process), 'redis' (shared) or None to disable
+    CACHE_BACKEND = os.getenv('CACHE_BACKEND') or 'memory'
+
+    # User.last_seen is buffered in 'memory' (per process) or 'redis' and written
+    # in batches by a timer thread LAST_SEEN_FLUSH_INTERVAL seconds after the
+    # first buffered visit, a visit is recorded at most once per granularity seconds
+    LAST_SEEN_BACKEND = os.getenv('LAST_SEEN_BACKEND') or 'memory'
+    LAST_SEEN_GRANULARITY = 60
+    LAST_SEEN_FLUSH_INTERVAL = 30
+
+    # snapshots of logged in users, so current_user does not cost a query per request
+    USER_CACHE_SIZE = 4096
+    USER_CACHE_TTL = 30
+
+    # pages served to anonymous visitors (index, explore), dropped on every
+    # change to posts or users
+    # like post cards below, they are cached in Redis when REDIS_URL is set and
+    # not at all otherwise, 'memory' keeps pages for at most PAGE_CACHE_MEMORY_TTL
+    # seconds as other workers do not see the drop
+    PAGE_CACHE_BACKEND = os.getenv('PAGE_CACHE_BACKEND') or ('redis' if REDIS_URL else None)
+    PAGE_CACHE_SIZE = 256
+    PAGE_CACHE_TTL = 300
+    PAGE_CACHE_MEMORY_TTL = 10
+
+    # rendered post cards, a card only changes when its author edits their profile
+    # the author's new version has to reach every worker, so cards are cached
+    # in Redis when REDIS_URL is set and not at all otherwise, 'memory' only
+    # suits a single process and keeps cards for at most FRAGMENT_CACHE_MEMORY_TTL
+    # seconds
+    FRAGMENT_CACHE_BACKEND = os.getenv('FRAGMENT_CACHE_BACKEND') or \
+        ('redis' if REDIS_URL else None)
+    FRAGMENT_CACHE_SIZE = 8192
+    FRAGMENT_CACHE_TTL = 3600
+    FRAGMENT_CACHE_MEMORY_TTL = 10
+
+    # how committed changes reach Elasticsearch: 'sync' sends them within the
+    # request, 'thread' from a background thread and 'rq' through an rq queue
+    SEARCH_INDEX_MODE = os.getenv('SEARCH_INDEX_MODE') or 'thread'
+    SEARCH_INDEX_QUEUE = 'blog-indexing'
+    SEARCH_INDEX_BATCH_SIZE = 500
+    SEARCH_INDEX_FLUSH_INTERVAL = 1.0
+    SEARCH_INDEX_MAX_RETRIES = 5
+    SEARCH_INDEX_RETRY_BACKOFF = 0.5
+
+    # materialized timelines for the blog page: 'sql', 'redis' or None to
+    # fall back to the followed_posts() query
+    TIMELINE_BACKEND = os.getenv('TIMELINE_BACKEND')
+    # posts kept per timeline in either store
+    TIMELINE_MAX_LENGTH = 800
+
+    # per request SQL, search and template timings reported as Server-Timing
+    # headers, JSON log lines and on /metrics, off unless INSTRUMENTATION is set
+    INSTRUMENTATION = os.getenv('INSTRUMENTATION') is not None
+    # share of requests run under cProfile, their profiles are written to
+    # PROFILE_DIR when they took at least PROFILE_SLOW_THRESHOLD seconds
+    PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE') or 0)
+    PROFILE_SLOW_THRESHOLD = float(os.getenv('PROFILE_SLOW_THRESHOLD') or 0.5)
+    PROFILE_DIR = os.getenv('PROFILE_DIR') or os.path.join(basedir, 'profiles')
+    # /metrics is not served unless one of these is set, it then answers
+    # requests with an "Authorization: Bearer <METRICS_TOKEN>" header or from
+    # the comma separated addresses and networks of METRICS_ALLOWED_IPS
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+    METRICS_ALLOWED_IPS = [ip for ip in (os.getenv('METRICS_ALLOWED_IPS') or '').split(',') if ip]
\ No newline at end of file
@@ -0,0 +1,44 @@
+"""timeline table
+
+Revision ID: a3c9e1d4b7f2
+Revises: dc2ee4208976
+Create Date: 2026-10-18 09:12:31.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c9e1d4b7f2'
+down_revision = 'dc2ee4208976'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    with op.batch_alter_table('timeline', schema=None) as batch_op:
+        batch_op.create_index('ix_timeline_user_id_timestamp', ['user_id', 'timestamp'], unique=False)
+
+    # backfill every user's own posts plus the posts of the users they follow
+    op.execute(
+        'INSERT INTO timeline (user_id, post_id, timestamp) '
+        'SELECT user_id, id, timestamp FROM posts '
+        'UNION '
+        'SELECT followers.follower_id, posts.id, posts.timestamp FROM posts '
+        'JOIN followers ON followers.followed_id = posts.user_id'
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('timeline', schema=None) as batch_op:
+        batch_op.drop_index('ix_timeline_user_id_timestamp')
+
+    op.drop_table('timeline')
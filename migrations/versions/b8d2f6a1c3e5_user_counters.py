@@ -0,0 +1,44 @@
+"""user counters
+
+Revision ID: b8d2f6a1c3e5
+Revises: a3c9e1d4b7f2
+Create Date: 2026-10-18 11:40:08.215733
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8d2f6a1c3e5'
+down_revision = 'a3c9e1d4b7f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('followers_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('followed_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('posts_count', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill the counts of existing users, built with sqlalchemy so the quoting
+    # of the user table matches the dialect
+    user = sa.table('user', sa.column('id'), sa.column('followers_count'),
+                    sa.column('followed_count'), sa.column('posts_count'))
+    followers = sa.table('followers', sa.column('follower_id'), sa.column('followed_id'))
+    posts = sa.table('posts', sa.column('user_id'))
+    op.execute(user.update().values(
+        followers_count=sa.select([sa.func.count()]).where(
+            followers.c.followed_id == user.c.id).scalar_subquery(),
+        followed_count=sa.select([sa.func.count()]).where(
+            followers.c.follower_id == user.c.id).scalar_subquery(),
+        posts_count=sa.select([sa.func.count()]).where(
+            posts.c.user_id == user.c.id).scalar_subquery()))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('posts_count')
+        batch_op.drop_column('followed_count')
+        batch_op.drop_column('followers_count')
@@ -0,0 +1,64 @@
+"""followers primary key
+
+Revision ID: c4f1a7e9d2b6
+Revises: b8d2f6a1c3e5
+Create Date: 2026-10-18 14:03:52.718264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4f1a7e9d2b6'
+down_revision = 'b8d2f6a1c3e5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    # copy the edges across once each, dropping duplicates and half-empty rows
+    op.execute(
+        'INSERT INTO followers_new (follower_id, followed_id) '
+        'SELECT DISTINCT follower_id, followed_id FROM followers '
+        'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL'
+    )
+    op.drop_table('followers')
+    op.rename_table('followers_new', 'followers')
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.create_index('ix_followers_followed_id_follower_id', ['followed_id', 'follower_id'], unique=False)
+
+    # the counters were built from the duplicated rows
+    user = sa.table('user', sa.column('id'), sa.column('followers_count'),
+                    sa.column('followed_count'))
+    followers = sa.table('followers', sa.column('follower_id'), sa.column('followed_id'))
+    op.execute(user.update().values(
+        followers_count=sa.select([sa.func.count()]).where(
+            followers.c.followed_id == user.c.id).scalar_subquery(),
+        followed_count=sa.select([sa.func.count()]).where(
+            followers.c.follower_id == user.c.id).scalar_subquery()))
+
+
+def downgrade():
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.drop_index('ix_followers_followed_id_follower_id')
+
+    op.create_table('followers_old',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.execute(
+        'INSERT INTO followers_old (follower_id, followed_id) '
+        'SELECT follower_id, followed_id FROM followers'
+    )
+    op.drop_table('followers')
+    op.rename_table('followers_old', 'followers')
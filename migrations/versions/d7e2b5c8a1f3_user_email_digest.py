@@ -0,0 +1,37 @@
+"""user email digest
+
+Revision ID: d7e2b5c8a1f3
+Revises: c4f1a7e9d2b6
+Create Date: 2026-10-18 16:21:07.554920
+
+"""
+from hashlib import md5
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7e2b5c8a1f3'
+down_revision = 'c4f1a7e9d2b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('email_digest', sa.String(length=32), nullable=True))
+
+    # backfill the digests in python, md5 is not available in every database
+    user = sa.table('user', sa.column('id'), sa.column('email'), sa.column('email_digest'))
+    conn = op.get_bind()
+    rows = conn.execute(sa.select([user.c.id, user.c.email]).where(user.c.email.isnot(None))).all()
+    if rows:
+        conn.execute(user.update().where(user.c.id == sa.bindparam('user_id'))
+                     .values(email_digest=sa.bindparam('digest')),
+                     [{'user_id': id, 'digest': md5(email.lower().encode('utf-8')).hexdigest()}
+                      for id, email in rows])
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('email_digest')
@@ -0,0 +1,31 @@
+"""timeline keyset index
+
+Revision ID: e5a9c3f7b1d4
+Revises: d7e2b5c8a1f3
+Create Date: 2026-10-18 21:04:52.318640
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a9c3f7b1d4'
+down_revision = 'd7e2b5c8a1f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # timeline pages seek on (timestamp, post_id), the index covers the whole key
+    with op.batch_alter_table('timeline', schema=None) as batch_op:
+        batch_op.drop_index('ix_timeline_user_id_timestamp')
+        batch_op.create_index('ix_timeline_user_id_timestamp_post_id',
+                              ['user_id', 'timestamp', 'post_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('timeline', schema=None) as batch_op:
+        batch_op.drop_index('ix_timeline_user_id_timestamp_post_id')
+        batch_op.create_index('ix_timeline_user_id_timestamp', ['user_id', 'timestamp'],
+                              unique=False)
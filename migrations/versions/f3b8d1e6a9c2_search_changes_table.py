@@ -0,0 +1,36 @@
+"""search changes table
+
+Revision ID: f3b8d1e6a9c2
+Revises: e5a9c3f7b1d4
+Create Date: 2026-10-18 22:37:15.804311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8d1e6a9c2'
+down_revision = 'e5a9c3f7b1d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('search_changes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('index_name', sa.String(length=64), nullable=True),
+    sa.Column('object_id', sa.Integer(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sqlite_autoincrement=True
+    )
+    with op.batch_alter_table('search_changes', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_search_changes_timestamp'), ['timestamp'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('search_changes', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_search_changes_timestamp'))
+
+    op.drop_table('search_changes')
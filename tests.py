@@ -1,37 +1,110 @@
+from base64 import b64encode
+import csv
 from datetime import datetime, timedelta
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Posts
+from unittest import mock
+from flask import render_template_string
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash
+from app import create_app, db, fragments, cli
+from app.models import User, Posts, followers, timeline, search_changes
+from app.timeline import SQLTimeline, query_timeline
+from app.pagination import paginate_cursor, encode_cursor, decode_cursor
+from app.instrument import QueryCounter
+from app.indexing import ThreadIndexer
+from app.cache import MemoryCache
+from app.sqlite import WriteQueue, fcntl
+from app.email import send_email, SyncMailer
+from app.auth.email import (send_password_reset_email,
+                            send_password_reset_emails)
+from app.mailserver import DebugSMTPServer
 from config import Config
 
+
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    CACHE_BACKEND = None
+    PAGE_CACHE_BACKEND = None
+    FRAGMENT_CACHE_BACKEND = None
+    PASSWORD_HASH_WORKERS = 0
+
+
+class AppCase(unittest.TestCase):
+    # an app built from `config` with its tables created, in an app context
+    # settings() are applied on a subclass of `config` made for each test, so
+    # nothing set for one test is seen by the next
+    config = TestConfig
 
-class UserModelCase(unittest.TestCase):
     def setUp(self):
-        self.app = create_app(TestConfig)
+        self.app = create_app(self.test_config())
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
-        
+
     def tearDown(self):
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
-    
+
+    def settings(self):
+        # config values that differ from test to test, ports or scratch paths
+        return {}
+
+    def test_config(self, **settings):
+        settings = dict(self.settings(), **settings)
+        return type(self.config.__name__, (self.config,), settings)
+
+    def scratch_directory(self):
+        # a temporary directory removed once the test is over
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        return directory
+
+
+def commit_elsewhere(statement, id=None, log_id=None):
+    # what another process's commit of a searchable post writes: the row and a
+    # change log entry, without this process's commit hooks seeing it
+    result = db.session.execute(statement)
+    id = id or result.inserted_primary_key[0]
+    db.session.execute(search_changes.insert().values(
+        id=log_id, index_name='posts', object_id=id,
+        timestamp=datetime.utcnow()))
+    db.session.commit()
+    return id
+
+
+class UserModelCase(AppCase):
     def test_password_hashing(self):
         u = User(email='robert@example.com', first_name='robert')
         u.set_password('cat')
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
-        
+
     def test_avatar(self):
         u = User(email='john@example.com', first_name='john')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
-        
+
+    def test_avatar_uses_stored_digest(self):
+        u = User(first_name='john')
+        u.set_email('John@example.com')
+        self.assertEqual(u.email_digest, 'd4c74594d841139328695756648b6bd6')
+        with mock.patch('app.models.md5') as md5:
+            self.assertEqual(u.avatar(36), ('https://www.gravatar.com/avatar/'
+                                            'd4c74594d841139328695756648b6bd6'
+                                            '?d=identicon&s=36'))
+        md5.assert_not_called()
+
     def test_follow(self):
         u1 = User(first_name='john', email='john@example.com')
         u2 = User(first_name='susan', email='susan@example.com')
@@ -40,7 +113,7 @@ class UserModelCase(unittest.TestCase):
         db.session.commit()
         self.assertEqual(u1.followed.all(), [])
         self.assertEqual(u1.followers.all(), [])
-        
+
         u1.follow(u2)
         db.session.commit()
         self.assertTrue(u1.is_following(u2))
@@ -48,13 +121,13 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.first().first_name, 'susan')
         self.assertEqual(u2.followers.count(), 1)
         self.assertEqual(u2.followers.first().first_name, 'john')
-        
+
         u1.unfollow(u2)
         db.session.commit()
         self.assertFalse(u1.is_following(u2))
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
-        
+
     def test_follow_posts(self):
         # create four users
         u1 = User(first_name='john', email='john@example.com')
@@ -62,31 +135,31 @@ class UserModelCase(unittest.TestCase):
         u3 = User(first_name='mary', email='mary@example.com')
         u4 = User(first_name='david', email='david@example.com')
         db.session.add_all([u1, u2, u3, u4])
-        
+
         # create four posts
         now = datetime.utcnow()
-        p1 = Posts(body="post from john", 
+        p1 = Posts(body="post from john",
                    author=u1,
                    timestamp=now + timedelta(seconds=1))
-        p2 = Posts(body="post from susan", 
+        p2 = Posts(body="post from susan",
                    author=u2,
                    timestamp=now + timedelta(seconds=4))
-        p3 = Posts(body="post from mary", 
+        p3 = Posts(body="post from mary",
                    author=u3,
                    timestamp=now + timedelta(seconds=3))
-        p4 = Posts(body="post from david", 
+        p4 = Posts(body="post from david",
                    author=u4,
                    timestamp=now + timedelta(seconds=2))
         db.session.add_all([p1, p2, p3, p4])
         db.session.commit()
-        
-        #setup followers
-        u1.follow(u2) # john follows susan
-        u1.follow(u4) # john follows david
-        u2.follow(u3) # susan follows mary
-        u3.follow(u4) # mary follows david
+
+        # setup followers
+        u1.follow(u2)  # john follows susan
+        u1.follow(u4)  # john follows david
+        u2.follow(u3)  # susan follows mary
+        u3.follow(u4)  # mary follows david
         db.session.commit()
-        
+
         # check the followed posts of each user
         f1 = u1.followed_posts().all()
         f2 = u2.followed_posts().all()
@@ -96,6 +169,1233 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f2, [p2, p3])
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
-        
+
+    def test_cursor_pagination(self):
+        u1 = User(first_name='john', email='john@example.com')
+        u2 = User(first_name='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        # two posts share a timestamp so the id has to break the tie
+        posts = [Posts(body=f'post {i}', author=u1 if i % 2 else u2,
+                       timestamp=now + timedelta(seconds=min(i, 3)))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        newest_first = sorted(posts, key=lambda p: (p.timestamp, p.id),
+                              reverse=True)
+
+        for query in (Posts.query.order_by(Posts.timestamp.desc()),
+                      u1.followed_posts()):
+            # walk forward through every page, then back again
+            page = paginate_cursor(query, Posts, 2)
+            self.assertFalse(page.has_prev)
+            seen = list(page.items)
+            while page.has_next:
+                page = paginate_cursor(query, Posts, 2,
+                                       before=decode_cursor(page.next_cursor))
+                seen.extend(page.items)
+            self.assertEqual(seen, newest_first)
+            self.assertEqual(page.items, newest_first[4:])
+            page = paginate_cursor(query, Posts, 2,
+                                   after=decode_cursor(page.prev_cursor))
+            self.assertEqual(page.items, newest_first[2:4])
+            self.assertTrue(page.has_prev)
+
+        self.assertEqual(decode_cursor(encode_cursor(posts[0])),
+                         (posts[0].timestamp, posts[0].id))
+        self.assertIsNone(decode_cursor('not-a-cursor'))
+
+    def test_post_listings_load_authors_in_one_query(self):
+        users = [User(first_name=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(3)]
+        db.session.add_all(users)
+        db.session.add_all([Posts(body=f'post {i}', author=users[i % 3])
+                            for i in range(6)])
+        db.session.commit()
+        for user in users[1:]:
+            users[0].follow(user)
+        db.session.commit()
+        db.session.expire_all()
+
+        # one SELECT for the posts and one batched SELECT for all their authors
+        for query in (users[0].followed_posts(),
+                      Posts.listing().order_by(Posts.timestamp.desc())):
+            with QueryCounter() as queries:
+                emails = [post.author.email for post in query.all()]
+            self.assertEqual(len(set(emails)), 3)
+            self.assertEqual(queries.count, 2, queries.statements)
+            db.session.expire_all()
+
+        with QueryCounter() as queries:
+            response = self.app.test_client().get('/explore')
+        self.assertEqual(response.status_code, 200)
+        # without a page cache there is no ETag to hash nor Last-Modified to
+        # query
+        self.assertIsNone(response.headers.get('ETag'))
+        self.assertEqual(queries.count, 2, queries.statements)
+
+    def test_memory_search(self):
+        u = User(first_name='john', email='john@example.com')
+        p1 = Posts(body='a long walk along a short path', author=u)
+        p2 = Posts(body='walk the dog, walk the cat', author=u)
+        p3 = Posts(body='nothing to see here', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+
+        posts, total = Posts.search('walk', 1, 10)
+        self.assertEqual(total, 2)
+        # the shorter post with two hits outranks the single hit
+        self.assertEqual(posts, [p2, p1])
+        posts, total = Posts.search('Short DOG', 1, 1)
+        self.assertEqual(total, 2)
+        self.assertEqual(len(posts), 1)
+
+        # the commit hooks keep the built index current
+        p4 = Posts(body='dog days', author=u)
+        db.session.add(p4)
+        db.session.delete(p2)
+        db.session.commit()
+        posts, total = Posts.search('dog', 1, 10)
+        self.assertEqual(posts, [p4])
+
+        # commits of other processes, edits and deletes too, are replayed from
+        # the change log before the next query
+        posts_table = Posts.__table__
+        ids = [commit_elsewhere(
+            posts_table.insert().values(body='hot dog', user_id=u.id))]
+        self.assertEqual(Posts.search('dog', 1, 10)[1], 2)
+        commit_elsewhere(posts_table.update().where(Posts.id == p4.id)
+                         .values(body='cat days'), p4.id)
+        commit_elsewhere(posts_table.delete().where(Posts.id == ids[0]),
+                         ids[0])
+        self.assertEqual(Posts.search('dog', 1, 10), ([], 0))
+        self.assertEqual(Posts.search('cat', 1, 10)[1], 1)
+
+        # a commit that took its log id before another but landed after it
+        late = db.session.query(db.func.max(search_changes.c.id)).scalar() + 1
+        commit_elsewhere(
+            posts_table.insert().values(body='dog food', user_id=u.id),
+            log_id=late + 1)
+        self.assertEqual(Posts.search('dog', 1, 10)[1], 1)
+        commit_elsewhere(
+            posts_table.insert().values(body='dog walk', user_id=u.id),
+            log_id=late)
+        self.assertEqual(Posts.search('dog', 1, 10)[1], 2)
+
+    def test_hydrate_keeps_rank_and_reuses_loaded_rows(self):
+        u = User(first_name='john', email='john@example.com')
+        posts = [Posts(body=f'post {i}', author=u) for i in range(4)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        ids = [posts[2].id, posts[0].id, posts[3].id]
+
+        with QueryCounter() as queries:
+            hydrated = Posts.hydrate(ids + [999])
+        self.assertEqual(hydrated, [posts[2], posts[0], posts[3]])
+        self.assertEqual(queries.count, 2)
+        self.assertNotIn('CASE', ' '.join(queries.statements))
+
+        # a second page over the same rows is served from the identity map
+        with QueryCounter() as queries:
+            self.assertEqual(Posts.hydrate(ids[::-1]),
+                             [posts[3], posts[0], posts[2]])
+            self.assertEqual([p.author.email for p in Posts.hydrate(ids)],
+                             [u.email] * 3)
+        self.assertEqual(queries.count, 0)
+
+    def test_search_cache_invalidated_by_commits(self):
+        self.app.search_cache = MemoryCache(max_size=2, ttl=60)
+        backend_query = self.app.search_backend.query
+        calls = []
+        self.app.search_backend.query = \
+            lambda *args: calls.append(args) or backend_query(*args)
+        u = User(first_name='john', email='john@example.com')
+        db.session.add_all([u, Posts(body='dog days', author=u)])
+        db.session.commit()
+        self.assertEqual(Posts.search('dog', 1, 10)[1], 1)
+
+        # repeated queries, in any case or spacing, skip the backend
+        self.assertEqual(Posts.search('  DOG ', 1, 10)[1], 1)
+        self.assertEqual(len(calls), 1)
+
+        # a commit of another process is not seen until this one bumps the
+        # generation
+        commit_elsewhere(
+            Posts.__table__.insert().values(body='hot dog', user_id=u.id))
+        self.assertEqual(Posts.search('dog', 1, 10)[1], 1)
+        db.session.add(Posts(body='dog house', author=u))
+        db.session.commit()
+        self.assertEqual(Posts.search('dog', 1, 10)[1], 3)
+        self.assertEqual(len(calls), 2)
+
+        # least recently used pages are evicted
+        Posts.search('house', 1, 10)
+        Posts.search('days', 1, 10)
+        Posts.search('dog', 1, 10)
+        self.assertEqual(len(calls), 5)
+
+    def test_last_seen_is_buffered(self):
+        u = User(first_name='john', email='john@example.com',
+                 last_seen=datetime.utcnow() - timedelta(hours=1))
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+        # visits only touch the buffer, and only once per granularity
+        with QueryCounter() as queries:
+            client.get('/explore')
+            client.get('/explore')
+        self.assertFalse([q for q in queries.statements
+                          if q.startswith('UPDATE')])
+        tracker = self.app.last_seen
+        self.assertEqual(list(tracker.pending), [u.id])
+        seen = tracker.last_seen(u)
+        self.assertEqual(seen, tracker.pending[u.id])
+
+        # the write is left to a timer thread
+        self.assertEqual(tracker._timer_pid, os.getpid())
+
+        # a failed write keeps the timestamps for the next flush
+        failure = RuntimeError('database is down')
+        with mock.patch.object(db.engine, 'begin', side_effect=failure):
+            tracker._flush_in_background()
+        self.assertEqual(tracker.pending, {u.id: seen})
+        self.assertIsNone(tracker._timer_pid)
+
+        self.assertEqual(tracker.flush(), 1)
+        self.assertEqual(tracker.pending, {})
+        db.session.expire_all()
+        self.assertEqual(User.query.get(u.id).last_seen, seen)
+
+    def test_counters(self):
+        u1 = User(first_name='john', email='john@example.com')
+        u2 = User(first_name='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        u1.follow(u2)
+        p1 = Posts(body='post from john', author=u1)
+        p2 = Posts(body='another post from john', author=u1)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual(
+            (u1.followed_count, u1.followers_count, u1.posts_count), (1, 0, 2))
+        self.assertEqual(
+            (u2.followed_count, u2.followers_count, u2.posts_count), (0, 1, 0))
+
+        # following twice does not count twice
+        u1.follow(u2)
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u1.posts_count), (1, 1))
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u2.followers_count), (0, 0))
+
+        # recount repairs counts that drifted
+        u2.follow(u1)
+        u1.posts_count = 7
+        db.session.commit()
+        db.session.execute(User.__table__.update().values(followers_count=5))
+        self.assertEqual(User.recount(), 2)
+        db.session.commit()
+        self.assertEqual((u1.followers_count, u1.posts_count), (1, 1))
+        self.assertEqual((u2.followed_count, u2.followers_count), (1, 0))
+
+    def test_racing_follows_are_counted_once(self):
+        u1 = User(first_name='john', email='john@example.com')
+        u2 = User(first_name='susan', email='susan@example.com')
+        u3 = User(first_name='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        db.session.commit()
+
+        # a request that checked before the other committed still sees susan as
+        # not followed, its insert of that row is ignored and not counted
+        with mock.patch.object(User, 'following_status',
+                               return_value={u2.id: False, u3.id: False}):
+            self.assertEqual(u1.follow_many([u2.id, u3.id]), 1)
+        db.session.commit()
+        counts = (lambda: (u1.followed_count, u2.followers_count,
+                           u3.followers_count))
+        self.assertEqual(counts(), (2, 1, 1))
+
+        with mock.patch.object(User, 'following_status',
+                               return_value={u2.id: True, u3.id: True}):
+            u1.unfollow_many([u2.id, u3.id])
+            self.assertEqual(u1.unfollow_many([u2.id, u3.id]), 0)
+        db.session.commit()
+        self.assertEqual(counts(), (0, 0, 0))
+
+    def test_followers_rows_are_unique(self):
+        u1 = User(first_name='john', email='john@example.com')
+        u2 = User(first_name='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        u1.follow(u2)
+        db.session.commit()
+        with self.assertRaises(IntegrityError):
+            db.session.execute(followers.insert().values(
+                follower_id=u1.id, followed_id=u2.id))
+        db.session.rollback()
+        self.assertEqual(u2.followers.count(), 1)
+
+    def test_bulk_follow(self):
+        users = [User(first_name=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        u, others = users[0], users[1:]
+        ids = [other.id for other in others]
+
+        self.assertEqual(u.follow_many(ids[:2]), 2)
+        # already followed users are skipped
+        self.assertEqual(u.follow_many(ids), 2)
+        db.session.commit()
+        self.assertEqual(u.followed_count, 4)
+        self.assertEqual([other.followers_count for other in others],
+                         [1, 1, 1, 1])
+
+        self.assertEqual(u.unfollow_many(ids[1:3] + [u.id]), 2)
+        db.session.commit()
+        self.assertEqual(u.followed_count, 2)
+        self.assertEqual(u.following_status(ids),
+                         {ids[0]: True, ids[1]: False,
+                          ids[2]: False, ids[3]: True})
+        self.assertEqual(u.following_status(id for id in ids),
+                         u.following_status(ids))
+        db.session.refresh(others[0])
+        db.session.refresh(others[1])
+        with QueryCounter() as queries:
+            self.assertTrue(u.is_following(others[0]))
+            self.assertFalse(u.is_following(others[1]))
+            u.following_status(ids)
+        self.assertEqual(queries.count, 3)
+
+
+class TimelineConfig(TestConfig):
+    TIMELINE_BACKEND = 'sql'
+    POSTS_PER_PAGE = 2
+
+
+class TimelineCase(AppCase):
+    config = TimelineConfig
+
+    def test_sql_timelines_are_capped(self):
+        self.app.timeline = SQLTimeline(max_length=10)
+        u1 = User(first_name='john', email='john@example.com')
+        u2 = User(first_name='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        now = datetime.utcnow()
+        posts = [Posts(body=f'post {i}', author=u2,
+                       timestamp=now + timedelta(seconds=i))
+                 for i in range(12)]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        # a follow pulls in the newest max_length posts
+        u1.follow(u2)
+        db.session.commit()
+        newest = [p.id for p in reversed(posts)]
+        self.assertEqual(query_timeline(u1, 20)[0], newest[:10])
+
+        # fan-outs let it grow a little before it is cut back
+        posts.append(Posts(body='post 12', author=u2,
+                           timestamp=now + timedelta(seconds=12)))
+        db.session.add(posts[-1])
+        db.session.commit()
+        self.assertEqual(query_timeline(u1, 20)[0],
+                         [posts[-1].id] + newest[:10])
+        posts.append(Posts(body='post 13', author=u2,
+                           timestamp=now + timedelta(seconds=13)))
+        db.session.add(posts[-1])
+        db.session.commit()
+        self.assertEqual(query_timeline(u1, 20)[0],
+                         [p.id for p in reversed(posts)][:10])
+        self.assertEqual(
+            db.session.query(timeline).filter_by(user_id=u2.id).count(), 10)
+
+    def test_timeline_matches_followed_posts(self):
+        u1 = User(first_name='john', email='john@example.com')
+        u2 = User(first_name='susan', email='susan@example.com')
+        u3 = User(first_name='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        # posts written before the follow are pulled in by the follow itself
+        now = datetime.utcnow()
+        p1 = Posts(body="post from susan", author=u2,
+                   timestamp=now + timedelta(seconds=1))
+        db.session.add(p1)
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        # posts written after the follow are fanned out on commit
+        p2 = Posts(body="post from john", author=u1,
+                   timestamp=now + timedelta(seconds=2))
+        p3 = Posts(body="post from susan", author=u2,
+                   timestamp=now + timedelta(seconds=3))
+        p4 = Posts(body="post from mary", author=u3,
+                   timestamp=now + timedelta(seconds=4))
+        db.session.add_all([p2, p3, p4])
+        db.session.commit()
+
+        ids, has_prev, has_next = query_timeline(u1, 10)
+        self.assertEqual(ids, [p.id for p in u1.followed_posts()])
+        self.assertEqual(ids, [p3.id, p2.id, p1.id])
+        self.assertEqual((has_prev, has_next), (False, False))
+
+        # pages seek from the (timestamp, id) of the last post shown
+        self.assertEqual(query_timeline(u1, 2), ([p3.id, p2.id], False, True))
+        self.assertEqual(query_timeline(u1, 2, before=(p2.timestamp, p2.id)),
+                         ([p1.id], True, False))
+        self.assertEqual(query_timeline(u1, 2, after=(p1.timestamp, p1.id)),
+                         ([p3.id, p2.id], False, True))
+
+        # and the blog page links to them with the cursors of the other
+        # listings
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+        next_url = f'/blog?before={encode_cursor(p2)}'
+        self.assertIn(next_url, client.get('/blog').get_data(as_text=True))
+        response = client.get(next_url)
+        self.assertIn(b'post from susan', response.data)
+        self.assertNotIn(b'post from john', response.data)
+
+        # a deleted post leaves the timelines of its author's followers
+        db.session.delete(p3)
+        db.session.commit()
+        self.assertEqual(query_timeline(u1, 10),
+                         ([p2.id, p1.id], False, False))
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(query_timeline(u1, 10), ([p2.id], False, False))
+
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(query_timeline(u1, 10), ([], False, False))
+
+        # a follow committed with a post of the followed user
+        u1.follow(u3)
+        p5 = Posts(body="another post from mary", author=u3,
+                   timestamp=now + timedelta(seconds=5))
+        db.session.add(p5)
+        db.session.commit()
+        self.assertEqual(query_timeline(u1, 10)[0], [p5.id, p4.id])
+
+
+class FakeIndices(object):
+    # the slice of the indices api used by reindex
+    def __init__(self):
+        self.indices = {}
+        self.aliases = {}
+        self.settings = {}
+
+    def create(self, index, body=None):
+        self.indices[index] = {}
+        self.settings[index] = body['settings'] if body else {}
+
+    def exists(self, index):
+        return index in self.indices
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def get_alias(self, name):
+        return {self.aliases[name]: {'aliases': {name: {}}}}
+
+    def update_aliases(self, body):
+        for action in body['actions']:
+            op, args = list(action.items())[0]
+            if op == 'add':
+                self.aliases[args['alias']] = args['index']
+            elif op == 'remove':
+                del self.aliases[args['alias']]
+            elif op == 'remove_index':
+                del self.indices[args['index']]
+
+    def put_settings(self, index, body):
+        self.settings[index].update(body['index'])
+
+    def refresh(self, index):
+        pass
+
+    def delete(self, index):
+        del self.indices[index]
+
+
+class FakeElasticsearch(object):
+    # records _bulk requests, failing the first `failures` of them
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.requests = []
+        self.indices = FakeIndices()
+
+    def bulk(self, body):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('elasticsearch is down')
+        self.requests.append(body)
+        items = []
+        lines = iter(body)
+        for line in lines:
+            op, meta = list(line.items())[0]
+            index = self.indices.aliases.get(meta['_index'], meta['_index'])
+            docs = self.indices.indices.setdefault(index, {})
+            if op == 'index':
+                docs[meta['_id']] = next(lines)
+            else:
+                docs.pop(meta['_id'], None)
+            items.append({op: {'status': 200}})
+        return {'errors': False, 'items': items}
+
+
+class IndexingConfig(TestConfig):
+    ELASTICSEARCH_URL = 'http://localhost:9200'
+    SEARCH_INDEX_FLUSH_INTERVAL = 0.05
+    SEARCH_INDEX_RETRY_BACKOFF = 0
+
+
+class SearchIndexingCase(AppCase):
+    config = IndexingConfig
+
+    def setUp(self):
+        super().setUp()
+        self.app.elasticsearch = FakeElasticsearch(failures=1)
+        self.app.indexer = ThreadIndexer(self.app)
+
+    def test_commits_are_sent_as_bulk_batches(self):
+        u = User(first_name='john', email='john@example.com')
+        posts = [Posts(body=f'post {i}', author=u) for i in range(3)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        db.session.delete(posts[0])
+        db.session.commit()
+        self.assertTrue(self.app.indexer.flush(timeout=5))
+
+        # the first request failed and was retried, both commits share one
+        # batch
+        es = self.app.elasticsearch
+        self.assertEqual(len(es.requests), 1)
+        actions = [(op, line[op]['_id']) for line in es.requests[0]
+                   for op in line if op in ('index', 'delete')]
+        self.assertEqual(sorted(actions[:3]), [('index', p.id) for p in posts])
+        self.assertEqual(actions[3:], [('delete', posts[0].id)])
+
+    def test_reindex_builds_new_index_behind_alias(self):
+        u = User(first_name='john', email='john@example.com')
+        posts = [Posts(body=f'post {i}', author=u) for i in range(7)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        self.app.indexer.flush(timeout=5)
+        es = self.app.elasticsearch
+        # the live index predates aliases, it is a concrete index named after
+        # the table
+        self.assertEqual(len(es.indices.indices['posts']), 7)
+
+        progress = []
+        total = Posts.reindex(
+            chunk_size=3, workers=2,
+            progress=lambda count, elapsed: progress.append(count))
+        self.assertEqual(total, 7)
+        self.assertEqual(progress, [3, 6, 7])
+        self.assertNotIn('posts', es.indices.indices)
+        index = es.indices.aliases['posts']
+        self.assertEqual(es.indices.indices[index],
+                         {p.id: {'body': p.body} for p in posts})
+        self.assertEqual(es.indices.settings[index]['refresh_interval'], '1s')
+
+    def test_reindex_keeps_commits_made_during_the_rebuild(self):
+        u = User(first_name='john', email='john@example.com')
+        posts = [Posts(body=f'post {i}', author=u) for i in range(7)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        self.app.indexer.flush(timeout=5)
+        es = self.app.elasticsearch
+
+        # once the first chunk is read, edit a post from it, delete another and
+        # add a new one, their changes are indexed into the old index
+        added = []
+
+        def commit_during_rebuild(count, elapsed):
+            if count == 3:
+                posts[0].body = 'edited'
+                db.session.delete(posts[1])
+                added.append(Posts(body='new post', author=u))
+                db.session.add(added[0])
+                db.session.commit()
+                self.app.indexer.flush(timeout=5)
+
+        Posts.reindex(chunk_size=3, workers=1, progress=commit_during_rebuild)
+
+        docs = es.indices.indices[es.indices.aliases['posts']]
+        self.assertEqual(docs[posts[0].id], {'body': 'edited'})
+        self.assertNotIn(posts[1].id, docs)
+        self.assertEqual(docs[added[0].id], {'body': 'new post'})
+        self.assertEqual(len(docs), 7)
+
+
+class UserCacheConfig(TestConfig):
+    CACHE_BACKEND = 'memory'
+    PAGE_CACHE_BACKEND = 'memory'
+    FRAGMENT_CACHE_BACKEND = 'memory'
+    WTF_CSRF_ENABLED = False
+
+
+class UserCacheCase(AppCase):
+    config = UserCacheConfig
+
+    def test_memory_cache_generations_are_bounded(self):
+        cache = MemoryCache(max_size=2, ttl=60)
+        cache.set('a:0', 'stale')
+        first = cache.bump('a')
+        self.assertNotEqual(cache.generation('a'), 0)
+
+        # past the size the oldest generations go, and with them every entry
+        # built under a generation that is no longer kept
+        cache.bump('b')
+        cache.bump('c')
+        self.assertEqual(list(cache.generations), ['b', 'c'])
+        self.assertNotIn(cache.generation('a'), (0, first))
+        self.assertNotEqual(cache.generation('d'), 0)
+
+        # once every entry built before a bump has expired it is forgotten
+        with mock.patch('app.cache.time', return_value=time.time() + 61):
+            cache.bump('d')
+        self.assertEqual(list(cache.generations), ['d'])
+
+    def test_current_user_served_from_cache(self):
+        u1 = User(first_name='john', email='john@example.com')
+        u2 = User(first_name='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+
+        client.get('/index')
+        with QueryCounter() as queries:
+            response = client.get('/index')
+        self.assertIn(b'Hi john', response.data)
+        self.assertFalse([q for q in queries.statements if 'FROM user' in q])
+
+        # editing the profile goes through the ORM user and drops the snapshot
+        response = client.post('/edit_profile', data={
+            'first_name': 'johnny', 'email': 'john@example.com',
+            'about_me': ''})
+        self.assertEqual(response.status_code, 302)
+        self.assertIsNone(self.app.user_cache.get(str(u1.id)))
+        self.assertIn(b'Hi johnny', client.get('/index').data)
+
+        # so do follows, on both sides
+        client.post('/follow/susan@example.com')
+        self.assertTrue(User.query.get(u1.id).is_following(u2))
+        self.assertIsNone(self.app.user_cache.get(str(u1.id)))
+        response = client.get('/user/susan@example.com')
+        self.assertIn(b'Unfollow', response.data)
+
+    def test_post_cards_cached_per_author_version(self):
+        u = User(first_name='john', email='john@example.com')
+        db.session.add(u)
+        db.session.add_all([Posts(body=f'post {i}', author=u)
+                            for i in range(3)])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+        with mock.patch('app.fragments._render',
+                        wraps=fragments._render) as render:
+            first = client.get('/explore').data
+            self.assertEqual(render.call_count, 3)
+            self.assertEqual(client.get('/explore').data, first)
+            self.assertEqual(render.call_count, 3)
+
+            # a new email re-renders the cards of that author only
+            client.post('/edit_profile', data={
+                'first_name': 'john', 'email': 'johnny@example.com',
+                'about_me': ''})
+            response = client.get('/explore')
+            self.assertEqual(render.call_count, 6)
+        self.assertIn(b'johnny@example.com said:', response.data)
+        self.assertNotIn(b'john@example.com said:', response.data)
+        # other workers never see the bump, so their cards expire quickly
+        self.assertEqual(self.app.fragment_cache.ttl,
+                         self.app.config['FRAGMENT_CACHE_MEMORY_TTL'])
+
+    def test_anonymous_pages_cached_and_conditional(self):
+        u = User(first_name='john', email='john@example.com')
+        db.session.add_all([u, Posts(body='first post', author=u)])
+        db.session.commit()
+        client = self.app.test_client()
+
+        response = client.get('/explore')
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        self.assertIn(b'first post', response.data)
+        self.assertEqual(response.headers['Vary'], 'Cookie')
+        with QueryCounter() as queries:
+            self.assertEqual(client.get('/explore').data, response.data)
+            response = client.get('/explore', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            response = client.get(
+                '/explore', headers={'If-Modified-Since': last_modified})
+            self.assertEqual(response.status_code, 304)
+        self.assertEqual(queries.count, 0, queries.statements)
+
+        # a new post is a new generation, so the next visit renders again
+        db.session.add(Posts(body='second post', author=u))
+        db.session.commit()
+        response = client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'second post', response.data)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        # logged in users are not served from the cache
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        self.assertIsNone(client.get('/explore').headers.get('ETag'))
+
+
+class PasswordConfig(TestConfig):
+    PASSWORD_HASH_WORKERS = 1
+    PASSWORD_HASH_ITERATIONS = 2000
+    WTF_CSRF_ENABLED = False
+
+
+class PasswordCase(AppCase):
+    config = PasswordConfig
+
+    def test_login_rehashes_outdated_hashes(self):
+        u = User(first_name='john', email='john@example.com',
+                 password_hash=generate_password_hash('cat',
+                                                      'pbkdf2:sha256:1000'))
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+
+        response = client.post('/auth/login', data={
+            'email': 'john@example.com', 'password': 'dog'})
+        self.assertEqual(response.headers['Location'],
+                         'http://localhost/auth/login')
+        self.assertTrue(User.query.get(u.id).password_hash
+                        .startswith('pbkdf2:sha256:1000$'))
+
+        response = client.post('/auth/login', data={
+            'email': 'john@example.com', 'password': 'cat'})
+        self.assertEqual(response.headers['Location'],
+                         'http://localhost/index')
+        db.session.expire_all()
+        user = User.query.get(u.id)
+        self.assertTrue(user.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(user.check_password('cat'))
+        self.assertFalse(
+            self.app.password_hasher.needs_rehash(user.password_hash))
+
+
+def text_part(envelope):
+    for part in envelope.message.walk():
+        if part.get_content_type() == 'text/plain':
+            return part.get_payload(decode=True).decode()
+
+
+class MailConfig(TestConfig):
+    MAIL_SERVER = 'localhost'
+    MAIL_SUPPRESS_SEND = False
+    MAIL_DEFAULT_SENDER = 'no-reply@example.com'
+    MAIL_WORKERS = 1
+    WTF_CSRF_ENABLED = False
+
+
+class MailCase(AppCase):
+    config = MailConfig
+
+    def setUp(self):
+        self.server = DebugSMTPServer(port=0).start()
+        super().setUp()
+
+    def settings(self):
+        return {'MAIL_PORT': self.server.port}
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.stop()
+
+    def test_queued_mail_shares_one_connection(self):
+        for i in range(5):
+            send_email(f'message {i}', sender=None,
+                       recipients=[f'user{i}@example.com'],
+                       text_body='hello', html_body='<p>hello</p>')
+        self.assertTrue(self.app.mailer.flush(timeout=5))
+        self.assertEqual([m.message['Subject'] for m in self.server.messages],
+                         [f'message {i}' for i in range(5)])
+        self.assertEqual(self.server.connections, 1)
+
+        # the password reset view only queues the message
+        db.session.add(User(first_name='john', email='john@example.com'))
+        db.session.commit()
+        response = self.app.test_client().post(
+            '/auth/reset_password_request', data={'email': 'john@example.com'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(self.app.mailer.flush(timeout=5))
+        self.assertEqual(self.server.messages[-1].recipients,
+                         ['john@example.com'])
+        self.assertEqual(self.server.connections, 1)
+
+        # the link was built by the worker, for the requesting host
+        body = text_part(self.server.messages[-1])
+        token = re.search(r'http://localhost/auth/reset_password/(\S+)',
+                          body).group(1)
+        self.assertEqual(User.verify_reset_password_token(token).email,
+                         'john@example.com')
+        # and templates have no way to sign a token themselves
+        self.assertNotIn('reset_password_token', self.app.jinja_env.globals)
+
+    def test_sync_mail_renders_inside_the_request(self):
+        # no second request context is pushed, popping it would run the
+        # request's teardown handlers before the view has finished
+        self.app.mailer = SyncMailer(self.app)
+        torn_down = []
+        self.app.teardown_request(torn_down.append)
+        u = User(first_name='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        with self.app.test_request_context(
+                '/', base_url='https://blog.example.com/'):
+            send_password_reset_email(u)
+            self.assertEqual(torn_down, [])
+        body = text_part(self.server.messages[-1])
+        self.assertIn('https://blog.example.com/auth/reset_password/', body)
+
+    def test_bulk_reset_emails(self):
+        db.session.add_all([User(first_name=f'user{i}',
+                                 email=f'user{i}@example.com')
+                            for i in range(20)])
+        db.session.commit()
+        stats = send_password_reset_emails(User.query.order_by(User.id),
+                                           chunk_size=8)
+        self.assertEqual((stats['emails'], stats['failed']), (20, 0))
+        self.assertGreater(stats['per_second'], 0)
+        self.assertEqual(sorted(m.recipients[0] for m in self.server.messages),
+                         sorted(f'user{i}@example.com' for i in range(20)))
+        self.assertIn('Dear user3,', [text_part(m).splitlines()[0]
+                                      for m in self.server.messages])
+
+
+class InstrumentationConfig(TestConfig):
+    INSTRUMENTATION = True
+    PROFILE_SAMPLE_RATE = 1
+    PROFILE_SLOW_THRESHOLD = 0
+    METRICS_TOKEN = 'metrics-secret'
+    METRICS_ALLOWED_IPS = ['10.0.0.0/8']
+
+
+class InstrumentationCase(AppCase):
+    config = InstrumentationConfig
+
+    def settings(self):
+        return {'PROFILE_DIR': self.scratch_directory()}
+
+    def test_request_timings(self):
+        u = User(first_name='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        db.session.add_all([Posts(body=f'post {i}', author=u)
+                            for i in range(3)])
+        db.session.commit()
+        client = self.app.test_client()
+
+        response = client.get('/explore')
+        timing = response.headers['Server-Timing']
+        queries = int(re.search(r'db;dur=[\d.]+;desc="(\d+) queries"',
+                                timing).group(1))
+        self.assertGreater(queries, 0)
+        self.assertIn('template;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+        # every request was sampled and over the zero threshold
+        profiles = os.listdir(self.app.config['PROFILE_DIR'])
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith('main.explore-'))
+
+        metrics = client.get(
+            '/metrics', headers={'Authorization': 'Bearer metrics-secret'}
+        ).get_data(as_text=True)
+        self.assertIn('blog_requests_total'
+                      '{endpoint="main.explore",status="200"} 1', metrics)
+        self.assertIn('blog_sql_queries_total'
+                      f'{{endpoint="main.explore"}} {queries}', metrics)
+        self.assertIn('blog_request_duration_seconds_count'
+                      '{endpoint="main.explore"} 1', metrics)
+
+    def test_failed_render_is_timed(self):
+        def fail():
+            time.sleep(0.01)
+            raise RuntimeError('broken template')
+
+        self.app.config['PROPAGATE_EXCEPTIONS'] = False
+        self.app.add_url_rule(
+            '/broken', 'broken',
+            lambda: render_template_string('{{ fail() }}', fail=fail))
+        self.app.register_error_handler(
+            500, lambda e: (render_template_string('error'), 500))
+
+        response = self.app.test_client().get('/broken')
+        self.assertEqual(response.status_code, 500)
+        # the render that raised counts, the error page is not nested under it
+        timing = response.headers['Server-Timing']
+        rendering = re.search(r'template;dur=([\d.]+)', timing).group(1)
+        self.assertGreaterEqual(float(rendering), 10)
+
+    def test_metrics_access(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/metrics').status_code, 403)
+        response = client.get('/metrics',
+                              headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(response.status_code, 403)
+        response = client.get('/metrics',
+                              environ_base={'REMOTE_ADDR': '10.1.2.3'})
+        self.assertEqual(response.status_code, 200)
+
+        # without a token or allowed networks there is no /metrics at all
+        app = create_app(self.test_config(METRICS_TOKEN=None,
+                                          METRICS_ALLOWED_IPS=[]))
+        self.assertEqual(app.test_client().get('/metrics').status_code, 404)
+
+
+class ReplicaConfig(TestConfig):
+    WTF_CSRF_ENABLED = False
+
+
+class ReplicaCase(AppCase):
+    # a primary and a replica as two SQLite files, nothing replicates between
+    # them so each page shows where it read from
+    config = ReplicaConfig
+
+    def settings(self):
+        path = self.scratch_directory()
+        return {
+            'SQLALCHEMY_DATABASE_URI':
+                'sqlite:///' + os.path.join(path, 'primary.db'),
+            'DATABASE_REPLICA_URLS':
+                ['sqlite:///' + os.path.join(path, 'replica.db')]}
+
+    def setUp(self):
+        super().setUp()
+        self.replica = db.get_engine(self.app, bind='replica0')
+        db.Model.metadata.create_all(self.replica)
+
+    def tearDown(self):
+        db.Model.metadata.drop_all(self.replica)
+        super().tearDown()
+
+    def test_reads_go_to_replica_until_a_write(self):
+        u = User(first_name='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        with self.replica.begin() as conn:
+            conn.execute(User.__table__.insert(), {
+                'id': u.id, 'first_name': 'john', 'email': 'john@example.com'})
+            conn.execute(Posts.__table__.insert(), {
+                'body': 'replicated post', 'user_id': u.id,
+                'timestamp': datetime.utcnow()})
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+        self.assertIn(b'replicated post', client.get('/explore').data)
+
+        # the post is written to the primary and the redirect reads it back
+        # from there
+        response = client.post('/blog', data={'post': 'fresh post'},
+                               follow_redirects=True)
+        self.assertIn(b'fresh post', response.data)
+        self.assertNotIn(b'replicated post', response.data)
+        self.assertEqual([p.body for p in Posts.query], ['fresh post'])
+
+        # once the sticky period is over reads go back to the replica
+        with client.session_transaction() as session:
+            session['_primary_until'] = 0
+        response = client.get('/explore')
+        self.assertIn(b'replicated post', response.data)
+        self.assertNotIn(b'fresh post', response.data)
+
+    def test_timeline_reads_go_to_replica(self):
+        self.app.timeline = SQLTimeline(self.app.config['TIMELINE_MAX_LENGTH'])
+        u = User(first_name='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        with self.replica.begin() as conn:
+            conn.execute(User.__table__.insert(), {
+                'id': u.id, 'first_name': 'john', 'email': 'john@example.com'})
+            post_id = conn.execute(Posts.__table__.insert(), {
+                'body': 'replicated post', 'user_id': u.id,
+                'timestamp': datetime.utcnow()}).inserted_primary_key[0]
+            conn.execute(timeline.insert(), {
+                'user_id': u.id, 'post_id': post_id,
+                'timestamp': datetime.utcnow()})
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        self.assertIn(b'replicated post', client.get('/blog').data)
+
+    def test_api_writes_stick_to_primary(self):
+        # token clients have no session cookie, their user is remembered
+        # instead
+        u1 = User(first_name='john', email='john@example.com')
+        u2 = User(first_name='susan', email='susan@example.com')
+        u1.set_password('cat')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        with self.replica.begin() as conn:
+            conn.execute(User.__table__.insert(), [
+                {'id': u.id, 'first_name': u.first_name, 'email': u.email}
+                for u in (u1, u2)])
+        client = self.app.test_client(use_cookies=False)
+        credentials = b64encode(b'john@example.com:cat').decode()
+        token = client.post('/api/tokens', headers={
+            'Authorization': f'Basic {credentials}'})
+        auth = {'Authorization': f"Bearer {token.get_json()['token']}"}
+
+        def following():
+            response = client.get(f'/api/users/{u2.id}', headers=auth)
+            return response.get_json()['following']
+
+        self.assertFalse(following())
+        response = client.post(f'/api/users/{u2.id}/follow', headers=auth)
+        self.assertNotIn('Set-Cookie', response.headers)
+        self.assertTrue(following())
+
+        # once the client is forgotten it reads the replica again
+        self.app.sticky_clients.delete(f'user:{u1.id}')
+        self.assertFalse(following())
+
+
+class SQLiteCase(AppCase):
+    def settings(self):
+        path = os.path.join(self.scratch_directory(), 'blog.db')
+        return {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path}
+
+    def test_pragmas(self):
+        def pragma(name):
+            return db.session.execute(f'PRAGMA {name}').scalar()
+
+        self.assertEqual(pragma('journal_mode'), 'wal')
+        self.assertEqual(pragma('synchronous'), 1)  # normal
+        self.assertEqual(pragma('busy_timeout'), 5000)
+
+    def test_concurrent_writers_take_turns(self):
+        u = User(first_name='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        errors = []
+
+        def write(n):
+            with self.app.app_context():
+                try:
+                    for i in range(20):
+                        db.session.add(Posts(body=f'post {n}.{i}',
+                                             user_id=u.id))
+                        db.session.commit()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(Posts.query.count(), 80)
+        connection = db.engine.raw_connection()
+        self.assertGreaterEqual(connection.connection.queue.writes, 81)
+        connection.close()
+
+    @unittest.skipIf(fcntl is None, 'no flock')
+    def test_write_queue_gives_up_on_a_held_file_lock(self):
+        path = os.path.join(self.scratch_directory(), 'queue.db')
+        queue = WriteQueue(path, 0.1)
+        # another process in a long transaction holds the file lock
+        with open(path + '.lock', 'a') as other:
+            fcntl.flock(other, fcntl.LOCK_EX)
+            self.assertFalse(queue.acquire())
+            # the thread lock was let go, so sibling threads are not stuck
+            self.assertFalse(queue._lock.locked())
+            fcntl.flock(other, fcntl.LOCK_UN)
+        self.assertTrue(queue.acquire())
+        queue.release()
+        queue._file.close()
+
+
+class ApiConfig(TestConfig):
+    API_GZIP_MIN_SIZE = 100
+
+
+class ApiCase(AppCase):
+    config = ApiConfig
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+
+    def token(self, email, password):
+        credentials = b64encode(f'{email}:{password}'.encode()).decode()
+        response = self.client.post('/api/tokens', headers={
+            'Authorization': f'Basic {credentials}'})
+        self.assertEqual(response.status_code, 200)
+        return {'Authorization': f"Bearer {response.get_json()['token']}"}
+
+    def test_timeline_follow_and_pages(self):
+        u1 = User(first_name='john', email='john@example.com')
+        u2 = User(first_name='susan', email='susan@example.com')
+        u1.set_password('cat')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        db.session.add_all([Posts(body=f'post {i}', author=u2,
+                                  timestamp=now + timedelta(seconds=i))
+                            for i in range(5)])
+        db.session.commit()
+
+        self.assertEqual(self.client.get('/api/timeline').status_code, 401)
+        self.assertEqual(self.client.post('/api/tokens').status_code, 401)
+        auth = self.token('john@example.com', 'cat')
+        response = self.client.get('/api/timeline', headers=auth)
+        self.assertEqual(response.get_json()['posts'], [])
+
+        response = self.client.post(f'/api/users/{u2.id}/follow', headers=auth)
+        self.assertEqual(response.get_json(), {'id': u2.id, 'following': True})
+        response = self.client.post(f'/api/users/{u1.id}/follow', headers=auth)
+        self.assertEqual(response.status_code, 400)
+
+        # cursor pages of two, newest first, authors sent once per page
+        bodies = []
+        url = '/api/timeline?limit=2'
+        with QueryCounter() as queries:
+            while url:
+                data = self.client.get(url, headers=auth).get_json()
+                bodies.extend(post['body'] for post in data['posts'])
+                self.assertEqual(list(data['users']), [str(u2.id)])
+                url = data['next']
+        self.assertEqual(bodies, [f'post {i}' for i in reversed(range(5))])
+        # only the columns the api sends are read
+        self.assertFalse([q for q in queries.statements
+                          if 'password_hash' in q])
+
+        data = self.client.get(f'/api/users?ids={u2.id},{u1.id},99',
+                               headers=auth).get_json()
+        self.assertEqual([(u['id'], u.get('following'))
+                          for u in data['users']],
+                         [(u2.id, True), (u1.id, None)])
+        self.assertEqual(data['missing'], [99])
+        self.assertEqual(data['users'][0]['posts_count'], 5)
+
+        self.client.delete(f'/api/users/{u2.id}/follow', headers=auth)
+        response = self.client.get(f'/api/users/{u2.id}', headers=auth)
+        self.assertFalse(response.get_json()['following'])
+
+    def test_etag_and_gzip(self):
+        u = User(first_name='john', email='john@example.com')
+        db.session.add_all([Posts(body=f'post {i}', author=u)
+                            for i in range(5)])
+        db.session.commit()
+
+        response = self.client.get('/api/explore',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        data = json.loads(gzip.decompress(response.data))
+        self.assertEqual(len(data['posts']), 5)
+
+        response = self.client.get('/api/explore', headers={
+            'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+
+class TimelineApiConfig(ApiConfig):
+    TIMELINE_BACKEND = 'sql'
+
+
+class TimelineApiCase(ApiCase):
+    # the api tests again, with the timeline served from the timeline store
+    config = TimelineApiConfig
+
+    def test_timeline_reads_the_store(self):
+        u1 = User(first_name='john', email='john@example.com')
+        u2 = User(first_name='susan', email='susan@example.com')
+        u1.set_password('cat')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        db.session.add(Posts(body='post from susan', author=u2))
+        db.session.commit()
+        auth = self.token('john@example.com', 'cat')
+
+        with QueryCounter() as queries:
+            data = self.client.get('/api/timeline', headers=auth).get_json()
+        self.assertEqual([post['body'] for post in data['posts']],
+                         ['post from susan'])
+        self.assertTrue([q for q in queries.statements
+                         if 'FROM timeline' in q])
+        self.assertFalse([q for q in queries.statements
+                          if 'FROM followers' in q])
+
+
+class ExportConfig(TestConfig):
+    EXPORT_CHUNK_SIZE = 2
+
+
+class ExportCase(AppCase):
+    config = ExportConfig
+
+    def test_export_posts(self):
+        u1 = User(first_name='john', email='john@example.com')
+        u2 = User(first_name='susan', email='susan@example.com')
+        db.session.add_all(
+            [Posts(body=f'john {i}', author=u1) for i in range(3)] +
+            [Posts(body=f'susan {i}, "quoted"', author=u2) for i in range(2)])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+
+        # the account download only has the user's own posts, streamed in
+        # chunks
+        response = client.get('/export/posts')
+        self.assertTrue(response.is_streamed)
+        self.assertIn('my-posts.ndjson',
+                      response.headers['Content-Disposition'])
+        lines = [json.loads(line)
+                 for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([(p['author'], p['body']) for p in lines],
+                         [('john@example.com', f'john {i}') for i in range(3)])
+
+        response = client.get('/export/posts?format=csv&gzip=1')
+        self.assertEqual(response.mimetype, 'application/gzip')
+        text = gzip.decompress(response.data).decode()
+        rows = list(csv.reader(text.splitlines()))
+        self.assertEqual(rows[0], ['id', 'timestamp', 'author', 'body'])
+        self.assertEqual([row[3] for row in rows[1:]],
+                         [f'john {i}' for i in range(3)])
+
+        # the whole corpus from the command line
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(
+            args=['posts', 'export', '--format', 'csv'])
+        rows = list(csv.reader(result.output.splitlines()))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[-1][3], 'susan 1, "quoted"')
+
+
 if __name__ == '__main__':
-    unittest.main(verbosity=2)
\ No newline at end of file
+    unittest.main(verbosity=2)